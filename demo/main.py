@@ -14,6 +14,7 @@
 
 import math
 import datetime
+import itertools
 from dotenv import dotenv_values
 
 import streamlit as st
@@ -24,7 +25,7 @@ import google.auth
 
 from graph2nosql.databases.firestore_kg import FirestoreKG
 
-from graphrag_lite.KGraphQuery import GlobalQueryGCP
+from graphrag_lite.KGraphQuery import GlobalQueryGCP, LocalQueryGCP
 from graphrag_lite.IngestionSession import IngestionSession
 from graphrag_lite.PreprocessingSession import PreprocessingSession
 
@@ -78,7 +79,7 @@ class DocPreview:
         st.image("./img/PDF_file_icon.png", width=50)
         # st.button('delete', key=f'delete_{doc_name}', on_click=delete_file, args=[doc_name])
 
-def main(client_query:str, model_name: str) -> None:  
+def main(client_query:str, model_name: str, search_mode: str = "Global") -> None:  
 
     with st.spinner('Processing... This might take a minute or two.'):
 
@@ -98,13 +99,19 @@ def main(client_query:str, model_name: str) -> None:
             community_collection_id=community_coll_id
         )
 
-        global_query = GlobalQueryGCP(secrets, fskg)
-        final_response = global_query(user_query=client_query)
+        if search_mode == "Local":
+            kg_query = LocalQueryGCP(secrets, fskg)
+        else:
+            kg_query = GlobalQueryGCP(secrets, fskg)
+        response_stream = kg_query.stream(user_query=client_query)
+
+        # block on retrieval until the model produces its first chunk
+        first_chunk = next(response_stream, "")
 
         # df = pd.DataFrame({"Sources": sources})
         # st.dataframe(df)
 
-    st.write(final_response)
+    st.write_stream(itertools.chain([first_chunk], response_stream))
 
     return None
 
@@ -195,9 +202,12 @@ with st.form("transcript_submission_form"):
 
     client_query = st.text_input("Question:")
 
+    search_mode = str(st.radio('Search mode', ('Global', 'Local'), horizontal=True,
+                               help='Local search answers questions about specific entities from their graph neighborhood.'))
+
     # model_name = str(st.selectbox('Which Model would you like to ask?', ('gemini-1.5-flash','gemini-1.5-pro'),placeholder='gemini-1.5-pro'))
 
     button = st.form_submit_button('Ask', help=None, on_click=None, args=None, kwargs=None, type="primary", disabled=False, use_container_width=False)
 
     if button:
-        main(client_query=client_query, model_name="model_name")
\ No newline at end of file
+        main(client_query=client_query, model_name="model_name", search_mode=search_mode)
\ No newline at end of file
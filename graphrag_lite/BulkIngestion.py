@@ -0,0 +1,256 @@
+# Copyright 2024 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+from dotenv import dotenv_values
+
+from graphrag_lite.IngestionLedger import IngestionLedger
+from graphrag_lite.IngestionSession import IngestionSession
+from graphrag_lite.PreprocessingSession import PreprocessingSession
+from graphrag_lite.Observability import obs_context
+from graphrag_lite.TokenBudget import process_ledger
+from graph2nosql.graph2nosql.graph2nosql import NoSQLKnowledgeGraph
+from graph2nosql.databases.firestore_kg import FirestoreKG
+
+
+# end of input marker of the document queue
+_DONE = object()
+
+
+def discover_documents(source: str) -> Iterator[tuple[str, str]]:
+    """
+    Yields (document name, file path) of all PDFs to ingest.
+
+    source is either a directory, walked recursively in sorted order, or a manifest file with one
+    path per line (relative to the manifest, blank lines and # comments are ignored). The name is
+    the path relative to the directory / manifest with "/" replaced, the raw uploads bucket is flat.
+    """
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for file_name in sorted(files):
+                if file_name.lower().endswith(".pdf"):
+                    path = os.path.join(root, file_name)
+                    yield os.path.relpath(path, source).replace(os.sep, "_"), path
+        return
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    with open(source, encoding="utf-8") as manifest:
+        for line in manifest:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            path = line if os.path.isabs(line) else os.path.join(base_dir, line)
+            yield os.path.relpath(path, base_dir).replace(os.sep, "_"), path
+
+
+class BulkIngestionStats:
+    """Thread safe progress counters of a bulk ingestion run with throughput rates."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.start = time.monotonic()
+        self.start_tokens = self._tokens()
+        self.documents = 0
+        self.skipped = 0
+        self.failed = 0
+        self.pages = 0
+
+    @staticmethod
+    def _tokens() -> int:
+        totals = process_ledger().totals()
+        return int(totals["prompt_tokens"] + totals["output_tokens"])
+
+    def record(self, pages: int = 0, skipped: bool = False, failed: bool = False) -> None:
+        with self._lock:
+            if skipped:
+                self.skipped += 1
+            elif failed:
+                self.failed += 1
+            else:
+                self.documents += 1
+                self.pages += pages
+
+    def snapshot(self) -> Dict[str, Any]:
+        minutes = max(time.monotonic() - self.start, 1e-9) / 60
+        tokens = self._tokens() - self.start_tokens
+        with self._lock:
+            return {"documents": self.documents, "skipped": self.skipped, "failed": self.failed,
+                    "pages": self.pages, "tokens": tokens, "minutes": minutes,
+                    "docs_per_min": self.documents / minutes,
+                    "pages_per_min": self.pages / minutes,
+                    "tokens_per_min": tokens / minutes}
+
+    def report(self) -> str:
+        s = self.snapshot()
+        lines = [f"+++++ {s['documents']} docs ingested, {s['skipped']} skipped, {s['failed']} failed "
+                 f"in {s['minutes']:.1f} min: {s['docs_per_min']:.1f} docs/min, "
+                 f"{s['pages_per_min']:.1f} pages/min, {s['tokens_per_min']:.0f} tokens/min +++++"]
+        for name, timing in obs_context.timing_summary().items():
+            if name.startswith("ingestion.") and timing["count"]:
+                lines.append(f"{name[len('ingestion.'):]:<14} n={timing['count']:<6} p50={timing['p50']:.2f}s "
+                             f"p95={timing['p95']:.2f}s p99={timing['p99']:.2f}s max={timing['max']:.2f}s")
+        return "\n".join(lines)
+
+
+class BulkIngestion:
+    """
+    Ingests a directory or manifest of PDFs with max_documents documents in flight.
+
+    All documents share one IngestionSession and one IngestionBatch, so the graph is post-processed
+    once at the end (and every finalize_every seconds during the run) instead of once per document.
+    The upload, OCR and extraction stages are limited globally across all documents in flight,
+    extraction stays single threaded by default as it merges nodes in the shared graph. With
+    INGEST_STREAMING=true OCR and extraction of a part run as one stage, max_streams (by default
+    max_ocr) limits the parts that are streamed at the same time.
+
+    Runs resume through the ingestion ledger: documents that were completely ingested before are
+    skipped, interrupted documents continue from their part checkpoints. The ledger is kept per
+    graph_target (by default the graph configured in .env, see IngestionLedger). Progress with docs/min,
+    pages/min, tokens/min and per stage latency percentiles is printed every report_interval seconds.
+    """
+
+    def __init__(self, graph_db: NoSQLKnowledgeGraph,
+                 ledger_dir: str,
+                 max_documents: int = 4,
+                 max_pages_per_file: int = 15,
+                 max_uploads: int = 8,
+                 max_ocr: int = 8,
+                 max_extractions: int = 1,
+                 max_streams: Optional[int] = None,
+                 report_interval: float = 30.0,
+                 finalize_every: Optional[float] = 1800.0,
+                 ingestion: Optional[IngestionSession] = None,
+                 graph_target: Optional[str] = None) -> None:
+        self.max_documents = max_documents
+        self.max_pages_per_file = max_pages_per_file
+        self.report_interval = report_interval
+        self.finalize_every = finalize_every
+
+        self.ledger = IngestionLedger(ledger_dir=ledger_dir, graph_target=graph_target)
+        self.ingestion = ingestion or IngestionSession(graph_db=graph_db)
+        self.preprocessing = PreprocessingSession(
+            graph_db=graph_db,
+            ingestion=self.ingestion,
+            ledger=self.ledger,
+            stage_limits={"upload": threading.Semaphore(max_uploads),
+                          "ocr": threading.Semaphore(max_ocr),
+                          "extraction": threading.Semaphore(max_extractions),
+                          # streamed parts are OCR'd and extracted in one stage
+                          "stream": threading.Semaphore(max_ocr if max_streams is None else max_streams)})
+        self.stats = BulkIngestionStats()
+
+    def __call__(self, documents: Iterable[tuple[str, str]]) -> Dict[str, Any]:
+        """Ingests all (document name, file path) documents and returns the final throughput stats."""
+        self.stats = BulkIngestionStats()
+        document_queue: queue.Queue = queue.Queue(maxsize=self.max_documents)
+        stop_reporting = threading.Event()
+
+        def work() -> None:
+            while True:
+                item = document_queue.get()
+                if item is _DONE:
+                    return
+                self._ingest_document(*item)
+
+        def report() -> None:
+            while not stop_reporting.wait(self.report_interval):
+                print(self.stats.report())
+
+        reporter = threading.Thread(target=report, name="bulk-ingestion-report", daemon=True)
+        reporter.start()
+        with self.ingestion.batch(max_delay_seconds=self.finalize_every):
+            workers = [threading.Thread(target=work, name=f"bulk-ingestion-{i}", daemon=True)
+                       for i in range(max(1, self.max_documents))]
+            for t in workers:
+                t.start()
+            try:
+                for name, path in documents:
+                    document_queue.put((name, path))
+            finally:
+                for _ in workers:
+                    document_queue.put(_DONE)
+                for t in workers:
+                    t.join()
+        stop_reporting.set()
+
+        print(self.stats.report())
+        return self.stats.snapshot()
+
+    def _ingest_document(self, name: str, path: str) -> None:
+        start = time.perf_counter()
+        try:
+            # the PDF is streamed from disk, it is never loaded into memory as a whole
+            with open(path, "rb") as f:
+                results = self.preprocessing(new_file_name=name,
+                                             max_pages_per_file=self.max_pages_per_file,
+                                             file_to_ingest=f)
+            if not results:
+                self.stats.record(skipped=True)
+                return
+            failed = any(r.error is not None for r in results)
+            self.stats.record(pages=sum(r.pages for r in results), failed=failed)
+        except Exception as e:
+            print(f"+++++ Document {name} failed: {e!r} +++++")
+            self.stats.record(failed=True)
+        obs_context.record_timing("ingestion.document", time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk ingestion of a directory or manifest of PDFs.")
+    parser.add_argument("source", help="directory with PDFs or manifest file with one PDF path per line")
+    parser.add_argument("--ledger-dir", default=os.environ.get("INGEST_LEDGER_DIR", ".ingestion_ledger"),
+                        help="ingestion ledger used to skip and resume documents")
+    parser.add_argument("--max-documents", type=int, default=4, help="documents in flight")
+    parser.add_argument("--max-pages-per-file", type=int, default=15)
+    parser.add_argument("--max-uploads", type=int, default=8, help="concurrent uploads across all documents")
+    parser.add_argument("--max-ocr", type=int, default=8, help="concurrent OCR requests across all documents")
+    parser.add_argument("--max-extractions", type=int, default=1,
+                        help="concurrent extractions across all documents")
+    parser.add_argument("--max-streams", type=int, default=None,
+                        help="concurrent streamed parts across all documents with INGEST_STREAMING=true "
+                             "(default --max-ocr)")
+    parser.add_argument("--report-interval", type=float, default=30.0, help="seconds between progress reports")
+    parser.add_argument("--finalize-every", type=float, default=1800.0,
+                        help="seconds after which pending post-processing runs during the load")
+    args = parser.parse_args()
+
+    secrets = dotenv_values(".env")
+
+    fskg = FirestoreKG(
+        gcp_project_id=str(secrets["GCP_PROJECT_ID"]),
+        gcp_credential_file=str(secrets["GCP_CREDENTIAL_FILE"]),
+        firestore_db_id=str(secrets["FIRESTORE_DB_ID"]),
+        node_collection_id=str(secrets["NODE_COLL_ID"]),
+        edges_collection_id=str(secrets["EDGES_COLL_ID"]),
+        community_collection_id=str(secrets["COMM_COLL_ID"]),
+    )
+
+    bulk = BulkIngestion(graph_db=fskg,
+                         ledger_dir=args.ledger_dir,
+                         max_documents=args.max_documents,
+                         max_pages_per_file=args.max_pages_per_file,
+                         max_uploads=args.max_uploads,
+                         max_ocr=args.max_ocr,
+                         max_extractions=args.max_extractions,
+                         max_streams=args.max_streams,
+                         report_interval=args.report_interval,
+                         finalize_every=args.finalize_every)
+    bulk(discover_documents(args.source))
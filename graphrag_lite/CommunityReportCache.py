@@ -0,0 +1,164 @@
+# Copyright 2024 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+from typing import Optional
+
+from graph2nosql.databases.firestore_kg import FirestoreKG
+from graph2nosql.datamodel import data_model
+
+
+class CommunityReportSnapshot:
+    """
+    Process-level in-memory snapshot of all community reports of one community collection.
+
+    The snapshot is loaded with one full collection read and afterwards kept in sync by a
+    Firestore change listener. While the listener is running the snapshot is not reloaded,
+    the ttl only forces a full reload when listening is disabled or the listener stopped or
+    failed, in which case the listener is attached again. Reports that are requested but missing from the
+    snapshot are fetched with one bulk read instead of one read per community.
+    """
+
+    _instances: dict[tuple[str, str], "CommunityReportSnapshot"] = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, fskg: FirestoreKG,
+                 comm_coll_id: str,
+                 ttl_seconds: float = 600,
+                 listen_for_changes: bool = True) -> None:
+        self.fskg = fskg
+        self.comm_coll_id = comm_coll_id
+        self.ttl_seconds = ttl_seconds
+        self.listen_for_changes = listen_for_changes
+
+        self._lock = threading.RLock()
+        self._reports: dict[str, data_model.CommunityData] = {}
+        self._loaded_at: Optional[float] = None
+        self._listener = None
+        self._listener_failed = False
+
+    @classmethod
+    def for_collection(cls, fskg: FirestoreKG,
+                       database_id: str,
+                       comm_coll_id: str,
+                       ttl_seconds: float = 600,
+                       listen_for_changes: bool = True) -> "CommunityReportSnapshot":
+        """Returns the process wide snapshot for the given community collection, creating it on first use."""
+        key = (database_id, comm_coll_id)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(fskg=fskg,
+                                          comm_coll_id=comm_coll_id,
+                                          ttl_seconds=ttl_seconds,
+                                          listen_for_changes=listen_for_changes)
+            return cls._instances[key]
+
+    def reports(self) -> list[data_model.CommunityData]:
+        """Returns all community reports, reloading the snapshot only when it is empty or stale."""
+        with self._lock:
+            if self._is_stale():
+                self._refresh()
+            return list(self._reports.values())
+
+    def get_reports(self, community_ids: list[str]) -> list[data_model.CommunityData]:
+        """
+        Looks up community reports by community id (the report title) in the order given.
+
+        Ids missing from the snapshot (cold start, reports written after the last sync) are
+        fetched from Firestore in one bulk read and added to the snapshot.
+        """
+        with self._lock:
+            if self._is_stale():
+                self._refresh()
+            missing_ids = [c for c in community_ids if c not in self._reports]
+
+        if missing_ids:
+            fetched = self._bulk_fetch(missing_ids)
+            with self._lock:
+                self._reports.update(fetched)
+
+        reports = []
+        with self._lock:
+            for c in community_ids:
+                if c in self._reports:
+                    reports.append(self._reports[c])
+                else:
+                    print(f"Warning: Community '{c}' not found in community collection. Skipping.")
+        return reports
+
+    def invalidate(self) -> None:
+        """Drops the snapshot so the next access reloads the full collection."""
+        with self._lock:
+            self._loaded_at = None
+
+    def _is_stale(self) -> bool:
+        if self._loaded_at is None:
+            return True
+        if self._listener_running():
+            # the listener keeps the snapshot in sync, no reload needed
+            return False
+        return time.time() - self._loaded_at > self.ttl_seconds
+
+    def _listener_running(self) -> bool:
+        if self._listener is None or self._listener_failed:
+            return False
+        # Firestore closes the watch after non-recoverable stream errors
+        return getattr(self._listener, "is_active", True)
+
+    def _refresh(self) -> None:
+        """Reloads the full community collection and (re)attaches the change listener."""
+        coll = self.fskg.db.collection(self.comm_coll_id)
+        self._reports = {
+            doc.id: data_model.CommunityData.__from_dict__(doc.to_dict()) for doc in coll.stream()}
+        self._loaded_at = time.time()
+        print(f"Community report snapshot loaded with {len(self._reports)} reports.")
+
+        if self.listen_for_changes and not self._listener_running():
+            if self._listener is not None:
+                try:
+                    self._listener.unsubscribe()
+                except Exception as e:
+                    print(f"Warning: Could not detach stopped community change listener: {e}")
+                self._listener = None
+            try:
+                self._listener = coll.on_snapshot(self._on_collection_change)
+                self._listener_failed = False
+            except Exception as e:
+                # without listener the snapshot is only refreshed by ttl
+                print(f"Warning: Could not attach community change listener: {e}")
+                self.listen_for_changes = False
+
+    def _bulk_fetch(self, community_ids: list[str]) -> dict[str, data_model.CommunityData]:
+        """Fetches several community documents in one batched read."""
+        coll = self.fskg.db.collection(self.comm_coll_id)
+        doc_refs = [coll.document(c) for c in community_ids]
+        return {doc.id: data_model.CommunityData.__from_dict__(doc.to_dict())
+                for doc in self.fskg.db.get_all(doc_refs) if doc.exists}
+
+    def _on_collection_change(self, col_snapshot, changes, read_time) -> None:
+        """Firestore listener callback applying added, modified and removed reports to the snapshot."""
+        with self._lock:
+            try:
+                for change in changes:
+                    if change.type.name == "REMOVED":
+                        self._reports.pop(change.document.id, None)
+                    else:
+                        self._reports[change.document.id] = data_model.CommunityData.__from_dict__(
+                            change.document.to_dict())
+            except Exception as e:
+                # the snapshot may have missed changes, fall back to ttl reloads until the listener is reattached
+                print(f"Warning: Community change listener failed: {e}")
+                self._listener_failed = True
+        return None
@@ -1,5 +1,7 @@
 
 from graphrag_lite.LLMSession import LLMSession
+from graphrag_lite.TokenBudget import BudgetExceeded
+from graphrag_lite.ModelRouter import default_model_router, valid_json_response
 import graphrag_lite.prompts as prompts
 
 from graph2nosql.graph2nosql.graph2nosql import NoSQLKnowledgeGraph
@@ -8,22 +10,24 @@ from graph2nosql.datamodel import data_model
 
 from .async_utils.mq import PubSubMQ
 
-from typing import Any
+from typing import Any, ContextManager, Optional
 
 import networkx as nx
 from google.cloud.firestore_v1.vector import Vector
 
 import re
+import contextlib
 import numbers
+import hashlib
 import html
 from collections.abc import Mapping
 import matplotlib.pyplot as plt
-from langfuse.decorators import observe, langfuse_context
+from graphrag_lite.Observability import observe, obs_context
 from dotenv import dotenv_values
 
 
 class GraphExtractor:
-    def __init__(self, graph_db) -> None:
+    def __init__(self, graph_db, merge_lock: Optional[ContextManager] = None) -> None:
         self.tuple_delimiter = "<|>"
         self.record_delimiter = "##"
         self.completion_delimiter = "<|COMPLETE|>"
@@ -37,14 +41,25 @@ class GraphExtractor:
         )
 
         self.graph_db = graph_db
+        # held while results are merged into the graph, so extractors running in parallel on the
+        # same graph do not interleave their read-modify-write node merges
+        self.merge_lock = merge_lock if merge_lock is not None else contextlib.nullcontext()
 
-        self.llm = LLMSession(system_message=self.graph_extraction_system,
-                              model_name="gemini-1.5-pro-001")
+        self.router = default_model_router()
+        # one chat session per routed model
+        self._extraction_llms: dict[str, LLMSession] = {}
+        self.llm = self._extraction_llm("gemini-1.5-pro-001")
+
+    def _extraction_llm(self, model_name: str) -> LLMSession:
+        if model_name not in self._extraction_llms:
+            self._extraction_llms[model_name] = LLMSession(system_message=self.graph_extraction_system,
+                                                           model_name=model_name)
+        return self._extraction_llms[model_name]
 
     @observe()
     def __call__(self, text_input: str, max_extr_rounds: int = 5) -> None:
 
-        langfuse_context.update_current_trace(
+        obs_context.update_current_trace(
             name="Graph Extractor",
             public=False
         )
@@ -56,34 +71,51 @@ class GraphExtractor:
 
         print("+++++ Init Graph Extraction +++++")
 
-        init_extr_result = self.llm.generate_chat(
-            client_query_string=input_prompt, temperature=0, top_p=0)
+        def extract(model_name: str) -> tuple[LLMSession, str]:
+            llm = self._extraction_llm(model_name)
+            # every extraction is its own conversation
+            llm.reset_chat()
+            return llm, llm.generate_chat(
+                client_query_string=input_prompt, temperature=0, top_p=0, stage="extraction")
+
+        # an extraction without a single entity is re-run on the larger model,
+        # gleaning continues the conversation of whichever model answered
+        model_name = self.router.route("extraction", input_tokens=LLMSession.estimate_tokens(input_prompt))
+        llm, init_extr_result = self.router.call_with_escalation(
+            "extraction", model_name, extract,
+            validate=lambda result: '"entity"' in result[1])
         print(f"Init result: {init_extr_result}")
 
         for round_i in range(max_extr_rounds):
 
             print(f"+++++ Contd. Graph Extraction round {round_i} +++++")
 
-            round_response = self.llm.generate_chat(
-                client_query_string=prompts.CONTINUE_PROMPT, temperature=0, top_p=0)
-            init_extr_result += round_response or ""
+            try:
+                round_response = llm.generate_chat(
+                    client_query_string=prompts.CONTINUE_PROMPT, temperature=0, top_p=0, stage="gleaning")
+                init_extr_result += round_response or ""
 
-            print(f"Round response: {round_response}")
+                print(f"Round response: {round_response}")
 
-            if round_i >= max_extr_rounds - 1:
-                break
+                if round_i >= max_extr_rounds - 1:
+                    break
 
-            completion_check = self.llm.generate_chat(
-                client_query_string=prompts.LOOP_PROMPT, temperature=0, top_p=0)
+                completion_check = llm.generate_chat(
+                    client_query_string=prompts.LOOP_PROMPT, temperature=0, top_p=0, stage="gleaning")
+            except BudgetExceeded as e:
+                # keep what was extracted so far
+                print(f"+++++ Stop gleaning after round {round_i}: {e} +++++")
+                break
 
             if "YES" not in completion_check:
                 print(
                     f"+++++ Complete with completion check after round {round_i} +++++")
                 break
 
-        langfuse_context.flush()
+        obs_context.flush()
 
-        self._process_fskg(results={0: init_extr_result})
+        with self.merge_lock:
+            self._process_fskg(results={0: init_extr_result})
 
     def _construct_extractor_input(self, input_text: str) -> str:
         formatted_extraction_input = prompts.GRAPH_EXTRACTION_INPUT.format(
@@ -358,8 +390,12 @@ class GraphExtractor:
         # generate communities based on cleaned graph
         comms = kg.get_louvain_communities()
 
-        for c in comms:
-            comm_data = self.async_generate_comm_report(comm_members=c)
+        for i, c in enumerate(comms):
+            try:
+                comm_data = self.async_generate_comm_report(comm_members=c)
+            except BudgetExceeded as e:
+                print(f"Stopping community report generation after {i}/{len(comms)} reports: {e}")
+                break
             kg.store_community(community=comm_data)
             print(comm_data)
         return None
@@ -403,14 +439,11 @@ class GraphExtractor:
             A CommunityData object containing the generated report information.
         """
 
-        langfuse_context.update_current_trace(
+        obs_context.update_current_trace(
             name=f"Community Report Generation",
             public=False
         )
 
-        llm = LLMSession(system_message=prompts.COMMUNITY_REPORT_SYSTEM,
-                         model_name="gemini-1.5-flash-001")
-
         comm_nodes = []
         comm_edges = []
         for n in comm_members:
@@ -473,12 +506,24 @@ class GraphExtractor:
             "required": ["title", "summary", "rating", "rating_explanation", "findings"]
         }
 
-        comm_report = llm.generate(client_query_string=prompts.COMMUNITY_REPORT_QUERY.format(
+        report_query = prompts.COMMUNITY_REPORT_QUERY.format(
             entities=comm_nodes,
             relationships=comm_edges,
             response_mime_type="application/json",
             response_schema=response_schema
-        ))
+        )
+
+        def generate_report(model_name: str) -> str:
+            llm = LLMSession.get(system_message=prompts.COMMUNITY_REPORT_SYSTEM, model_name=model_name)
+            return llm.generate(client_query_string=report_query, stage="reports")
+
+        # malformed or empty reports are regenerated on the larger model
+        model_name = self.router.route("reports",
+                                       input_tokens=LLMSession.estimate_tokens(report_query),
+                                       community_size=len(comm_members))
+        comm_report = self.router.call_with_escalation(
+            "reports", model_name, generate_report,
+            validate=lambda report: valid_json_response(report, required_keys=["title", "summary", "findings"]))
 
         comm_report_dict = self.llm.parse_json_response(comm_report)
 
@@ -501,8 +546,8 @@ class GraphExtractor:
 
 
 class GCPGraphExtractor(GraphExtractor):
-    def __init__(self, graph_db):
-        super().__init__(graph_db)
+    def __init__(self, graph_db, merge_lock: Optional[ContextManager] = None):
+        super().__init__(graph_db, merge_lock=merge_lock)
         self.secrets = dotenv_values(".env")
 
     def comm_async_report(self, kg: NoSQLKnowledgeGraph) -> None:
@@ -516,7 +561,7 @@ class GCPGraphExtractor(GraphExtractor):
             kg: The NoSQLKnowledgeGraph object representing the knowledge graph.
         """
 
-        langfuse_context.update_current_trace(
+        obs_context.update_current_trace(
             name="Async Community Report Generation",
             public=False
         )
@@ -535,6 +580,57 @@ class GCPGraphExtractor(GraphExtractor):
         print(f"{len(comms)} Community report requests submitted.")
         return None
 
+    def update_node_description_embeddings(self, write_batch_size: int = 400) -> None:
+        """Embeds node titles & descriptions for local search and stores them in the node embedding collection.
+
+        Embeddings live in a separate collection (doc id = node uid) so node updates in the knowledge graph
+        never drop them. Only nodes whose title or description changed since the last run are re-embedded,
+        and embeddings of nodes that no longer exist are deleted.
+        """
+        db = self.graph_db.db
+        node_coll = db.collection(str(self.secrets["NODE_COLL_ID"]))
+        emb_coll = db.collection(node_embedding_collection_id(self.secrets))
+
+        stored_hashes = {doc.id: (doc.to_dict() or {}).get("description_hash")
+                         for doc in emb_coll.select(["description_hash"]).stream()}
+
+        node_texts = {}
+        for doc in node_coll.stream():
+            node = doc.to_dict()
+            node_texts[doc.id] = f"{node.get('node_title', doc.id)}: {node.get('node_description', '')}"
+
+        changed_uids = [uid for uid, text in node_texts.items()
+                        if stored_hashes.get(uid) != self._text_hash(text)]
+        removed_uids = [uid for uid in stored_hashes if uid not in node_texts]
+
+        embeddings = self.llm.embed_texts(texts=[node_texts[uid] for uid in changed_uids])
+
+        writes = [(uid, {"node_uid": uid,
+                         "description_hash": self._text_hash(node_texts[uid]),
+                         "description_embedding": Vector(emb)})
+                  for uid, emb in zip(changed_uids, embeddings)]
+        writes.extend([(uid, None) for uid in removed_uids])
+
+        for i in range(0, len(writes), write_batch_size):
+            batch = db.batch()
+            for uid, data in writes[i:i + write_batch_size]:
+                if data is None:
+                    batch.delete(emb_coll.document(uid))
+                else:
+                    batch.set(emb_coll.document(uid), data)
+            batch.commit()
+
+        print(f"Node description embeddings: {len(changed_uids)} updated, {len(removed_uids)} removed.")
+        return None
+
+    def _text_hash(self, text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def node_embedding_collection_id(secrets: dict) -> str:
+    """Collection holding the node description embeddings used by local search."""
+    return str(secrets.get("NODE_EMB_COLL_ID") or f"{secrets['NODE_COLL_ID']}-description-embeddings")
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,121 @@
+# Copyright 2024 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import threading
+import time
+from typing import BinaryIO, Dict
+
+import PyPDF2
+from google.cloud import documentai  # type: ignore
+
+
+class FakeDocumentAIClient:
+    """
+    Local stand-in for documentai.DocumentProcessorServiceClient for benchmarks and CI.
+
+    process_document answers with the text layer of every page of the request's PDF (a placeholder
+    for pages without one) as a Document with per page text anchors, like the OCR processor.
+    Every request takes latency seconds plus page_latency seconds per page, and the client counts
+    its requests and the highest number of requests it served concurrently.
+    """
+
+    def __init__(self, latency: float = 0.0, page_latency: float = 0.0) -> None:
+        self.latency = latency
+        self.page_latency = page_latency
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.pages = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @staticmethod
+    def processor_version_path(project: str, location: str, processor: str, processor_version: str) -> str:
+        return (f"projects/{project}/locations/{location}/processors/{processor}"
+                f"/processorVersions/{processor_version}")
+
+    def process_document(self, request: documentai.ProcessRequest) -> documentai.ProcessResponse:
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            pdf_reader = PyPDF2.PdfReader(io.BytesIO(request.raw_document.content))
+            text = ""
+            pages = []
+            for page_num, page in enumerate(pdf_reader.pages, start=1):
+                page_text = (page.extract_text() or "").strip() or f"[OCR text of page {page_num}]"
+                segment = documentai.Document.TextAnchor.TextSegment(start_index=len(text),
+                                                                     end_index=len(text) + len(page_text))
+                text += page_text + "\n"
+                pages.append(documentai.Document.Page(
+                    page_number=page_num,
+                    layout=documentai.Document.Page.Layout(
+                        text_anchor=documentai.Document.TextAnchor(text_segments=[segment]))))
+            time.sleep(self.latency + self.page_latency * len(pages))
+            with self._lock:
+                self.pages += len(pages)
+            return documentai.ProcessResponse(document=documentai.Document(text=text, pages=pages))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+class _FakeBlob:
+    def __init__(self, client: "FakeStorageClient", bucket_name: str, name: str) -> None:
+        self.client = client
+        self.bucket_name = bucket_name
+        self.name = name
+
+    def upload_from_file(self, file_obj: BinaryIO) -> None:
+        size = 0
+        # read in chunks like the resumable upload does
+        for chunk in iter(lambda: file_obj.read(1 << 20), b""):
+            size += len(chunk)
+        self.client._store(self.bucket_name, self.name, size)
+
+    def upload_from_filename(self, filename: str) -> None:
+        with open(filename, "rb") as f:
+            self.upload_from_file(f)
+
+
+class _FakeBucket:
+    def __init__(self, client: "FakeStorageClient", name: str) -> None:
+        self.client = client
+        self.name = name
+
+    def blob(self, blob_name: str) -> _FakeBlob:
+        return _FakeBlob(self.client, self.name, blob_name)
+
+
+class FakeStorageClient:
+    """
+    Local stand-in for storage.Client for benchmarks and CI.
+
+    Uploads are read completely and only their sizes are kept (uploads maps "bucket/blob" to bytes),
+    every upload takes latency seconds.
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.uploads: Dict[str, int] = {}
+
+    def bucket(self, bucket_name: str) -> _FakeBucket:
+        return _FakeBucket(self, bucket_name)
+
+    def _store(self, bucket_name: str, blob_name: str, size: int) -> None:
+        time.sleep(self.latency)
+        with self._lock:
+            self.uploads[f"{bucket_name}/{blob_name}"] = size
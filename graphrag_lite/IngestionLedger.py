@@ -0,0 +1,161 @@
+# Copyright 2024 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import BinaryIO, Optional, Union
+
+from dotenv import dotenv_values
+
+
+# per part ingestion stages in pipeline order, "merged" means included in a finalized graph post-processing
+STAGES = ("uploaded", "ocr", "extracted", "merged")
+
+# .env settings identifying the graph that documents are ingested into
+GRAPH_TARGET_KEYS = ("GCP_PROJECT_ID", "FIRESTORE_DB_ID", "NODE_COLL_ID", "EDGES_COLL_ID", "COMM_COLL_ID")
+
+
+def configured_graph_target() -> str:
+    """The graph the process ingests into, from the Firestore project, database and collections in .env."""
+    secrets = dotenv_values(".env")
+    return "/".join(str(secrets.get(key) or "") for key in GRAPH_TARGET_KEYS)
+
+
+class IngestionLedger:
+    """
+    Local record of ingested documents and document parts, keyed by content hash.
+
+    Every part records which ingestion stages it completed and keeps its OCR text as an artifact,
+    so a re-run after a crash resumes where it stopped and re-ingesting a corpus skips all parts
+    that are already in the graph. Documents are recorded once all their parts are merged,
+    identical content uploaded under another name is recognized by its hash.
+
+    Ingested means ingested into one graph: every graph_target (by default the Firestore database
+    and collections configured in .env) keeps its own ledger in a subdirectory of ledger_dir, so a
+    ledger directory shared by several graphs never skips documents of another graph.
+    """
+
+    def __init__(self, ledger_dir: str, graph_target: Optional[str] = None) -> None:
+        self.graph_target = graph_target if graph_target is not None else configured_graph_target()
+        target_dir = os.path.join(ledger_dir, hashlib.sha256(self.graph_target.encode("utf-8")).hexdigest()[:16])
+        self.artifact_dir = os.path.join(target_dir, "artifacts")
+        os.makedirs(self.artifact_dir, exist_ok=True)
+        with open(os.path.join(target_dir, "graph_target.txt"), "w", encoding="utf-8") as f:
+            f.write(self.graph_target)
+        self.ledger_path = os.path.join(target_dir, "ingestion_ledger.sqlite")
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.ledger_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "doc_hash TEXT PRIMARY KEY, name TEXT NOT NULL, num_parts INTEGER NOT NULL, completed_at REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS parts ("
+            "part_hash TEXT PRIMARY KEY, name TEXT NOT NULL, stages TEXT NOT NULL, updated_at REAL NOT NULL)")
+        self._conn.commit()
+
+    @staticmethod
+    def content_hash(content: Union[bytes, BinaryIO]) -> str:
+        """sha256 of PDF bytes or of a seekable binary file object, which is read in chunks and rewound."""
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            return hashlib.sha256(content).hexdigest()
+        digest = hashlib.sha256()
+        content.seek(0)
+        for chunk in iter(lambda: content.read(1 << 20), b""):
+            digest.update(chunk)
+        content.seek(0)
+        return digest.hexdigest()
+
+    # ----- documents -----
+
+    def completed_document(self, doc_hash: str) -> Optional[str]:
+        """Name the document content was completely ingested under, None if it was not."""
+        with self._lock:
+            row = self._conn.execute("SELECT name FROM documents WHERE doc_hash = ?", (doc_hash,)).fetchone()
+        return row[0] if row else None
+
+    def complete_document(self, doc_hash: str, name: str, num_parts: int) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (doc_hash, name, num_parts, completed_at) VALUES (?, ?, ?, ?)",
+                (doc_hash, name, num_parts, time.time()))
+            self._conn.commit()
+
+    # ----- parts -----
+
+    def part_stages(self, part_hash: str) -> set[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT stages FROM parts WHERE part_hash = ?", (part_hash,)).fetchone()
+        return set(json.loads(row[0])) if row else set()
+
+    def mark_stage(self, part_hash: str, name: str, stage: str) -> None:
+        if stage not in STAGES:
+            raise ValueError(f"Unknown ingestion stage {stage}.")
+        with self._lock:
+            row = self._conn.execute("SELECT stages FROM parts WHERE part_hash = ?", (part_hash,)).fetchone()
+            stages = set(json.loads(row[0])) if row else set()
+            stages.add(stage)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO parts (part_hash, name, stages, updated_at) VALUES (?, ?, ?, ?)",
+                (part_hash, name, json.dumps(sorted(stages)), time.time()))
+            self._conn.commit()
+
+    # ----- artifacts -----
+
+    def _artifact_path(self, part_hash: str, kind: str) -> str:
+        return os.path.join(self.artifact_dir, f"{part_hash}.{kind}.txt")
+
+    def store_text(self, part_hash: str, kind: str, text: str) -> None:
+        path = self._artifact_path(part_hash, kind)
+        # write and rename, a crash never leaves a truncated artifact behind
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+    def load_text(self, part_hash: str, kind: str) -> Optional[str]:
+        path = self._artifact_path(part_hash, kind)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+
+    def stats(self) -> dict:
+        with self._lock:
+            documents = self._conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+            rows = self._conn.execute("SELECT stages FROM parts").fetchall()
+        stage_counts = {stage: 0 for stage in STAGES}
+        for (stages,) in rows:
+            for stage in json.loads(stages):
+                stage_counts[stage] += 1
+        return {"documents": documents, "parts": len(rows), **stage_counts}
+
+
+_default_ledgers: dict[tuple[str, str], IngestionLedger] = {}
+_default_ledger_lock = threading.Lock()
+
+
+def default_ingestion_ledger() -> Optional[IngestionLedger]:
+    """Process wide ingestion ledger of the configured graph, only enabled when INGEST_LEDGER_DIR is set."""
+    ledger_dir = os.environ.get("INGEST_LEDGER_DIR")
+    if not ledger_dir:
+        return None
+    key = (ledger_dir, configured_graph_target())
+    with _default_ledger_lock:
+        if key not in _default_ledgers:
+            _default_ledgers[key] = IngestionLedger(ledger_dir=ledger_dir, graph_target=key[1])
+        return _default_ledgers[key]
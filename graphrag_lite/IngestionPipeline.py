@@ -0,0 +1,307 @@
+# Copyright 2024 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import BinaryIO, Callable, ContextManager, Iterable, Optional, Union
+
+from graphrag_lite.IngestionSession import IngestionSession, open_pdf
+from graphrag_lite.IngestionLedger import IngestionLedger, default_ingestion_ledger
+from graphrag_lite.Observability import obs_context
+
+
+# end of input marker passed through the stage queues
+_DONE = object()
+
+# a part is passed downstream as bytes or as a seekable binary file object
+PdfPart = Union[bytes, BinaryIO]
+
+
+@dataclass
+class PartResult:
+    """Outcome of one document part in the ingestion pipeline."""
+
+    name: str
+    index: int
+    part_hash: str = ""
+    document_string: Optional[str] = None
+    error: Optional[BaseException] = None
+    # seconds spent in every stage
+    timings: dict[str, float] = field(default_factory=dict)
+    # stages skipped because the ingestion ledger recorded them as completed
+    skipped: list[str] = field(default_factory=list)
+    # pages of the document in this part, set by PreprocessingSession
+    pages: int = 0
+
+
+class IngestionPipeline:
+    """
+    Pipelined ingestion of the parts of a split document.
+
+    Parts flow through an upload, an OCR and an extraction stage. Every stage has its own worker
+    pool and the stages are connected by bounded queues, so part N+1 is uploaded and OCR'd while
+    part N is extracted and a fast splitter blocks instead of buffering the whole document.
+    Upload and OCR of a part run in parallel branches (OCR does not need the stored copy), only
+    extraction waits for the OCR text.
+    The parts are ingested in one IngestionBatch, so graph wide post-processing (community reports,
+    embeddings, visualization) runs once after the last part is extracted instead of once per part.
+
+    Extraction writes to the shared graph with read-modify-write node merges, so it runs on one
+    worker by default. Every part is extracted under its own token budget, a failed or over budget
+    part is reported in its PartResult and does not stop the other parts.
+
+    With an ingestion ledger (by default enabled through INGEST_LEDGER_DIR) every completed stage
+    of a part is checkpointed under the part's content hash: re-runs skip uploads, OCR and
+    extraction that already happened, and reuse the stored OCR text.
+
+    stage_limits caps the parts in a stage across all pipelines sharing the semaphores, e.g. to
+    bound the OCR requests and keep extraction single threaded when many documents are ingested
+    concurrently into the same graph.
+
+    Parts are PDF bytes or seekable binary file objects, file parts are closed as soon as both
+    branches are done with them so temporary part files do not outlive their part.
+
+    If the ingestion session streams (INGEST_STREAMING=true), OCR and extraction are one "stream"
+    stage on ocr_workers workers instead: the pages of a part are extracted in chunks while its
+    later pages are still OCR'd (see IngestionSession.stream_extract), the graph merges of all
+    chunks are serialized by the session.
+    """
+
+    def __init__(self, ingestion: IngestionSession,
+                 upload_workers: int = 4,
+                 ocr_workers: int = 4,
+                 extraction_workers: int = 1,
+                 queue_size: int = 4,
+                 ledger: Optional[IngestionLedger] = None,
+                 stage_limits: Optional[dict[str, threading.Semaphore]] = None) -> None:
+        self.ingestion = ingestion
+        self.ledger = ledger if ledger is not None else default_ingestion_ledger()
+        self.stage_limits = stage_limits or {}
+        self.upload_workers = upload_workers
+        self.ocr_workers = ocr_workers
+        self.extraction_workers = extraction_workers
+        self.queue_size = queue_size
+
+    def __call__(self, parts: Iterable[tuple[str, PdfPart]],
+                 async_comm_reports: bool = True,
+                 ingest_local_file: bool = False,
+                 max_tokens: Optional[int] = None,
+                 max_cost_usd: Optional[float] = None,
+                 document_hash: Optional[str] = None,
+                 document_name: Optional[str] = None) -> list[PartResult]:
+        """
+        Ingests all (file name, pdf bytes or file) parts and post-processes the graph once.
+
+        parts may be a generator, it is consumed as the pipeline makes room for new parts.
+        With document_hash the ledger records the document as ingested once all its parts are
+        post-processed (inside a joined batch at the end of the outer batch).
+
+        Returns:
+            One PartResult per part in input order.
+        """
+        start = time.perf_counter()
+
+        upload_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        ocr_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        extraction_queue: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        results: list[PartResult] = []
+
+        def branch_input(file_to_ingest: PdfPart) -> ContextManager:
+            # upload and OCR read the same part concurrently, each through its own handle
+            return contextlib.nullcontext(file_to_ingest) if ingest_local_file else open_pdf(file_to_ingest)
+
+        def upload(result: PartResult, file_to_ingest: PdfPart) -> None:
+            if self._completed(result, "uploaded"):
+                return
+            with branch_input(file_to_ingest) as pdf_file:
+                self.ingestion.upload(new_file_name=result.name, file_to_ingest=pdf_file,
+                                      ingest_local_file=ingest_local_file)
+            self._checkpoint(result, "uploaded")
+
+        def ocr(result: PartResult, file_to_ingest: PdfPart) -> None:
+            result.document_string = self._stored_ocr_text(result)
+            if result.document_string is not None:
+                return
+            with branch_input(file_to_ingest) as pdf_file:
+                result.document_string = self.ingestion.ocr(new_file_name=result.name, file_to_ingest=pdf_file,
+                                                             ingest_local_file=ingest_local_file)
+            if self.ledger is not None:
+                self.ledger.store_text(result.part_hash, "ocr", result.document_string)
+            self._checkpoint(result, "ocr")
+
+        def extract(result: PartResult, file_to_ingest: PdfPart) -> None:
+            if self._completed(result, "extracted"):
+                # extracted before a crash but never post-processed
+                if not self._completed(result, "merged"):
+                    batch.mark_dirty()
+                return
+            with self.ingestion.document_budget(name=result.name, max_tokens=max_tokens,
+                                                max_cost_usd=max_cost_usd) as budget:
+                try:
+                    self.ingestion.extract(document_string=result.document_string or "")
+                finally:
+                    print(budget.ledger.summary())
+            self._checkpoint(result, "extracted")
+
+        def stream(result: PartResult, file_to_ingest: PdfPart) -> None:
+            if self._completed(result, "extracted"):
+                if not self._completed(result, "merged"):
+                    batch.mark_dirty()
+                return
+            stored = self._stored_ocr_text(result)
+            pages: list[str] = []
+            with self.ingestion.document_budget(name=result.name, max_tokens=max_tokens,
+                                                max_cost_usd=max_cost_usd) as budget:
+                try:
+                    if stored is not None:
+                        self.ingestion.stream_extract([stored])
+                    else:
+                        with branch_input(file_to_ingest) as pdf_file:
+                            self.ingestion.stream_extract(
+                                self.ingestion.page_texts(new_file_name=result.name, file_to_ingest=pdf_file,
+                                                          ingest_local_file=ingest_local_file),
+                                pages_read=pages)
+                finally:
+                    print(budget.ledger.summary())
+            if stored is None:
+                result.document_string = "\n".join(pages)
+                if self.ledger is not None:
+                    self.ledger.store_text(result.part_hash, "ocr", result.document_string)
+                self._checkpoint(result, "ocr")
+            else:
+                result.document_string = stored
+            self._checkpoint(result, "extracted")
+
+        # finalizes once all parts are through, only if any part was extracted
+        with self.ingestion.batch(async_comm_reports=async_comm_reports,
+                                  max_tokens=max_tokens, max_cost_usd=max_cost_usd) as batch:
+            # a part is done once it left both branches, the upload and the ocr / extraction one
+            open_branches: dict[int, int] = {}
+            branches_lock = threading.Lock()
+
+            def branch_done(item: tuple[PartResult, PdfPart]) -> None:
+                result, file_to_ingest = item
+                with branches_lock:
+                    open_branches[result.index] -= 1
+                    done = open_branches[result.index] == 0
+                if done and hasattr(file_to_ingest, "close"):
+                    file_to_ingest.close()
+
+            stages = [self._start_stage("upload", upload, upload_queue, None, self.upload_workers, branch_done)]
+            if self.ingestion.streaming:
+                stages.append(self._start_stage("stream", stream, ocr_queue, None, self.ocr_workers, branch_done))
+            else:
+                stages += [
+                    self._start_stage("ocr", ocr, ocr_queue, extraction_queue, self.ocr_workers),
+                    self._start_stage("extraction", extract, extraction_queue, None, self.extraction_workers,
+                                      branch_done),
+                ]
+
+            try:
+                for index, (name, file_to_ingest) in enumerate(parts):
+                    result = PartResult(name=name, index=index,
+                                        part_hash=IngestionLedger.content_hash(file_to_ingest))
+                    results.append(result)
+                    with branches_lock:
+                        open_branches[index] = 2
+                    upload_queue.put((result, file_to_ingest))
+                    ocr_queue.put((result, file_to_ingest))
+            finally:
+                # parts already in flight are finished even if splitting fails
+                self._finish_stages(stages, [upload_queue, ocr_queue, extraction_queue])
+
+            failed = [r for r in results if r.error is not None]
+            for r in failed:
+                print(f"+++++ Part {r.name} failed: {r.error!r} +++++")
+
+            def merged() -> None:
+                # every extracted part is now part of the post-processed graph
+                for result in results:
+                    if result.error is None:
+                        self._checkpoint(result, "merged")
+                # a document with failed parts is resumed from its part checkpoints on the next run
+                if self.ledger is not None and document_hash is not None and not failed:
+                    self.ledger.complete_document(document_hash, name=document_name or results[0].name,
+                                                  num_parts=len(results))
+
+            batch.after_finalize(merged)
+
+        print(f"+++++ Ingested {len(results) - len(failed)}/{len(results)} parts "
+              f"in {time.perf_counter() - start:.1f}s +++++")
+        return results
+
+    def _completed(self, result: PartResult, stage: str) -> bool:
+        """True if the ledger recorded the stage for the part's content, the stage is then skipped."""
+        if self.ledger is None or stage not in self.ledger.part_stages(result.part_hash):
+            return False
+        result.skipped.append(stage)
+        return True
+
+    def _stored_ocr_text(self, result: PartResult) -> Optional[str]:
+        """OCR text of the part kept by the ledger, None if the part still has to be OCR'd."""
+        if not self._completed(result, "ocr"):
+            return None
+        text = self.ledger.load_text(result.part_hash, "ocr")
+        if text is None:
+            result.skipped.remove("ocr")
+        return text
+
+    def _checkpoint(self, result: PartResult, stage: str) -> None:
+        if self.ledger is not None:
+            self.ledger.mark_stage(result.part_hash, result.name, stage)
+
+    def _start_stage(self, name: str,
+                     fn: Callable[[PartResult, PdfPart], None],
+                     in_queue: queue.Queue,
+                     out_queue: Optional[queue.Queue],
+                     workers: int,
+                     on_done: Optional[Callable[[tuple[PartResult, PdfPart]], None]] = None) -> list[threading.Thread]:
+        """Starts the worker pool of a stage, failed parts skip the remaining stages, on_done gets parts leaving a last stage."""
+
+        def work() -> None:
+            while True:
+                item = in_queue.get()
+                if item is _DONE:
+                    return
+                result, file_to_ingest = item
+                if result.error is None:
+                    with self.stage_limits.get(name) or contextlib.nullcontext():
+                        stage_start = time.perf_counter()
+                        try:
+                            fn(result, file_to_ingest)
+                        except Exception as e:
+                            result.error = e
+                        result.timings[name] = time.perf_counter() - stage_start
+                    obs_context.record_timing(f"ingestion.{name}", result.timings[name])
+                if out_queue is not None:
+                    out_queue.put(item)
+                elif on_done is not None:
+                    on_done(item)
+
+        threads = [threading.Thread(target=work, name=f"ingestion-{name}-{i}", daemon=True)
+                   for i in range(max(1, workers))]
+        for t in threads:
+            t.start()
+        return threads
+
+    def _finish_stages(self, stages: list[list[threading.Thread]], queues: list[queue.Queue]) -> None:
+        """Drains the stages in order: once all workers of a stage are done, the next stage gets its end markers."""
+        for threads, in_queue in zip(stages, queues):
+            for _ in threads:
+                in_queue.put(_DONE)
+            for t in threads:
+                t.join()
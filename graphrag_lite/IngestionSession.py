@@ -18,6 +18,15 @@ import os
 import json
 from dotenv import dotenv_values
 import io
+import concurrent.futures
+import contextlib
+import contextvars
+import queue
+import threading
+import time
+from typing import Any, BinaryIO, Callable, ContextManager, Iterable, Iterator, Optional, Union
+
+import PyPDF2
 
 from google.api_core.client_options import ClientOptions
 from google.cloud import documentai  # type: ignore
@@ -32,17 +41,216 @@ import google.auth
 # from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 from graphrag_lite.GraphExtractor import GraphExtractor, GCPGraphExtractor
+from graphrag_lite.TokenBudget import TokenBudget, BudgetExceeded
 from graph2nosql.graph2nosql.graph2nosql import NoSQLKnowledgeGraph
 from graph2nosql.databases.firestore_kg import FirestoreKG
+from graphrag_lite.Observability import obs_context
+from graphrag_lite.IngestionClients import FakeDocumentAIClient, FakeStorageClient
+from graphrag_lite.OCRCache import PageOCRCache, default_page_ocr_cache
+from graphrag_lite.TextChunker import sliding_window_chunks
+
+
+# end of input marker of the chunk queue of stream_extract
+_DONE = object()
+
+# serializes reading nameless file objects that are shared by concurrent readers
+_shared_read_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def open_pdf(file_to_ingest: Union[bytes, BinaryIO]) -> Iterator[Union[bytes, BinaryIO]]:
+    """
+    The PDF in a form that can be read concurrently with other readers of file_to_ingest.
+
+    Bytes are passed as they are, files on disk are reopened with their own read position and
+    other file objects are read into bytes.
+    """
+    if isinstance(file_to_ingest, (bytes, bytearray, memoryview)):
+        yield file_to_ingest
+        return
+    name = getattr(file_to_ingest, "name", None)
+    if isinstance(name, str) and os.path.isfile(name):
+        with open(name, "rb") as f:
+            yield f
+        return
+    with _shared_read_lock:
+        file_to_ingest.seek(0)
+        content = file_to_ingest.read()
+    yield content
+
+
+class IngestionBatch:
+    """
+    Defers the graph wide post-processing of an IngestionSession to one finalize per batch.
+
+    While the batch is active (as context manager) extractions only mark the graph dirty and
+    post_process calls are deferred. Leaving the batch finalizes once: community reports,
+    embeddings and the graph visualization run over the whole graph a single time, and not at
+    all if nothing was extracted. Ingesting k documents in one batch walks the graph once instead
+    of k times.
+
+    With debounce_seconds the batch also finalizes in the background once no document was
+    extracted for that long, with max_delay_seconds at the latest that long after the graph first
+    became dirty, so long running bulk loads keep reports and embeddings reasonably fresh.
+    after_finalize registers work that has to wait until the changes so far are post-processed.
+    """
+
+    def __init__(self, ingestion: "IngestionSession",
+                 async_comm_reports: bool = True,
+                 debounce_seconds: Optional[float] = None,
+                 max_delay_seconds: Optional[float] = None,
+                 max_tokens: Optional[int] = None,
+                 max_cost_usd: Optional[float] = None) -> None:
+        self.ingestion = ingestion
+        self.async_comm_reports = async_comm_reports
+        self.debounce_seconds = debounce_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.max_tokens = max_tokens
+        self.max_cost_usd = max_cost_usd
+
+        self.dirty = False
+        self.finalize_count = 0
+        self._dirty_since: Optional[float] = None
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self._finalize_lock = threading.Lock()
+        self._finalizing = False
+        self._after_finalize: list[Callable[[], None]] = []
+
+    def __enter__(self) -> "IngestionBatch":
+        self.ingestion._batch = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.ingestion._batch = None
+        self._cancel_timer()
+        self.finalize()
+        return None
+
+    def mark_dirty(self, async_comm_reports: Optional[bool] = None) -> None:
+        """Records a change of the graph and (re)schedules the debounced finalize."""
+        with self._lock:
+            if async_comm_reports is not None:
+                self.async_comm_reports = async_comm_reports
+            self.dirty = True
+            now = time.monotonic()
+            if self._dirty_since is None:
+                self._dirty_since = now
+            self._schedule(now)
+
+    def _schedule(self, now: float) -> None:
+        if self.debounce_seconds is None and self.max_delay_seconds is None:
+            return
+        delays = []
+        if self.debounce_seconds is not None:
+            delays.append(self.debounce_seconds)
+        if self.max_delay_seconds is not None:
+            delays.append(max(0.0, self._dirty_since + self.max_delay_seconds - now))
+        delay = min(delays)
+
+        # a running max delay timer is not pushed back by new changes
+        if self._timer is not None:
+            if self.debounce_seconds is None:
+                return
+            self._timer.cancel()
+        self._timer = threading.Timer(delay, self.finalize)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _cancel_timer(self) -> None:
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def after_finalize(self, fn: Callable[[], None]) -> None:
+        """Calls fn once all changes marked so far are post-processed, right away if none are pending."""
+        with self._lock:
+            if self.dirty or self._finalizing:
+                self._after_finalize.append(fn)
+                return
+        fn()
+
+    def _run_after_finalize(self, callbacks: list[Callable[[], None]]) -> None:
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception as e:
+                print(f"Warning: after finalize callback failed: {e}")
+
+    def finalize(self) -> bool:
+        """
+        Runs the graph wide post-processing if the graph changed since the last finalize.
+
+        If it fails or runs out of budget the graph stays dirty and the after finalize callbacks stay
+        queued for the next finalize, an exhausted budget returns False instead of raising.
+        """
+        with self._finalize_lock:
+            with self._lock:
+                if not self.dirty:
+                    return False
+                self.dirty = False
+                self._dirty_since = None
+                self._timer = None
+                self._finalizing = True
+                async_comm_reports = self.async_comm_reports
+                callbacks, self._after_finalize = self._after_finalize, []
+
+            print("+++++ Graph post-processing +++++")
+            budget = self.ingestion.document_budget(name="post-processing", max_tokens=self.max_tokens,
+                                                    max_cost_usd=self.max_cost_usd)
+            try:
+                with obs_context.timed("ingestion.post_process"), budget:
+                    self.ingestion._run_post_process(async_comm_reports=async_comm_reports)
+            except Exception as e:
+                # the changes are still not post-processed (also when the budget ran out part way),
+                # the next finalize retries them and the after finalize callbacks wait for it
+                with self._lock:
+                    self._finalizing = False
+                    self.dirty = True
+                    self._after_finalize = callbacks + self._after_finalize
+                if isinstance(e, BudgetExceeded):
+                    print(f"+++++ Graph post-processing stopped: {e} +++++")
+                    print(budget.ledger.summary())
+                    return False
+                raise
+            print(budget.ledger.summary())
+            self.finalize_count += 1
+
+            with self._lock:
+                self._finalizing = False
+                # callbacks registered during post-processing are covered by it unless new changes came in
+                if not self.dirty:
+                    callbacks, self._after_finalize = callbacks + self._after_finalize, []
+            self._run_after_finalize(callbacks)
+            return True
 
 
 class IngestionSession:
-    def __init__(self, graph_db: NoSQLKnowledgeGraph):
+    def __init__(self, graph_db: NoSQLKnowledgeGraph,
+                 docai_client: Optional[Any] = None,
+                 storage_client: Optional[Any] = None,
+                 page_ocr_cache: Optional[PageOCRCache] = None):
+        """
+        The Document AI and Cloud Storage clients are created once per session and shared by all
+        uploads and OCR requests, the service account in GCP_CREDENTIAL_FILE is only loaded when a
+        real client is created. Stand-ins can be passed as docai_client / storage_client, or
+        INGEST_CLIENTS=fake in .env uses the local FakeDocumentAIClient and FakeStorageClient with
+        FAKE_INGEST_LATENCY seconds per request. INGEST_MAX_OCR_REQUESTS (default 8) bounds the
+        concurrent OCR requests of the session.
+
+        OCR text is cached per page in page_ocr_cache (by default enabled through OCR_CACHE_DIR).
+
+        With INGEST_STREAMING=true documents are OCR'd and extracted as a stream (see stream_extract),
+        chunked by INGEST_CHUNK_TOKENS (default 1200) with INGEST_CHUNK_OVERLAP_TOKENS (default 100),
+        extracted by INGEST_STREAM_EXTRACTION_WORKERS (default 2) threads per document and OCR'd in
+        requests of INGEST_STREAM_OCR_PAGES pages (default 4), at most INGEST_STREAM_OCR_LOOKAHEAD
+        requests (default 2) ahead of extraction.
+        """
         self.secrets = dotenv_values(".env")
 
-        self.credentials, _ = google.auth.load_credentials_from_file(
-            self.secrets["GCP_CREDENTIAL_FILE"]
-        )
+        # loaded with the first real client, stand-ins do not need a service account file
+        self._credentials: Optional[Any] = None
         self.project_id = str(self.secrets["GCP_PROJECT_ID"])
 
         self.docai_processor_id = str(self.secrets['DOCUMENT_AI_PROCESSOR_ID'])
@@ -50,42 +258,472 @@ class IngestionSession:
             self.secrets["DOCUMENT_AI_PROCESSOR_VERSION"])
         self.gcp_multiregion = str(self.secrets["GCP_MULTIREGION"])
 
+        # pages with a good text layer are read locally instead of being sent to OCR
+        self.text_layer_fast_path = str(self.secrets.get("OCR_TEXT_LAYER") or "true").lower() == "true"
+        self.min_text_layer_chars = int(self.secrets.get("OCR_TEXT_LAYER_MIN_CHARS") or 100)
+        self.page_ocr_cache = page_ocr_cache if page_ocr_cache is not None else default_page_ocr_cache()
+
+        self.streaming = str(self.secrets.get("INGEST_STREAMING") or "false").lower() == "true"
+        self.chunk_tokens = int(self.secrets.get("INGEST_CHUNK_TOKENS") or 1200)
+        self.chunk_overlap_tokens = int(self.secrets.get("INGEST_CHUNK_OVERLAP_TOKENS") or 100)
+        self.stream_extraction_workers = int(self.secrets.get("INGEST_STREAM_EXTRACTION_WORKERS") or 2)
+        self.stream_ocr_pages = int(self.secrets.get("INGEST_STREAM_OCR_PAGES") or 4)
+        self.stream_ocr_lookahead = int(self.secrets.get("INGEST_STREAM_OCR_LOOKAHEAD") or 2)
+
+        if docai_client is None and storage_client is None \
+                and str(self.secrets.get("INGEST_CLIENTS") or "gcp").lower() == "fake":
+            latency = float(self.secrets.get("FAKE_INGEST_LATENCY") or 0.0)
+            docai_client = FakeDocumentAIClient(latency=latency)
+            storage_client = FakeStorageClient(latency=latency)
+        self._docai_clients: dict[str, Any] = {}
+        self._docai_client_override = docai_client
+        self._storage_client = storage_client
+        self._clients_lock = threading.Lock()
+        self._ocr_slots = threading.BoundedSemaphore(int(self.secrets.get("INGEST_MAX_OCR_REQUESTS") or 8))
+
         self.graph_db = graph_db
+        # extractions of the session run in parallel, their merges into the graph one at a time
+        self._merge_lock = threading.Lock()
+        # active IngestionBatch deferring post-processing, see batch()
+        self._batch: Optional[IngestionBatch] = None
+
+    def docai_client(self, location: str) -> Any:
+        """Document AI client of the location's endpoint, created on first use."""
+        if self._docai_client_override is not None:
+            return self._docai_client_override
+        with self._clients_lock:
+            client = self._docai_clients.get(location)
+            if client is None:
+                client = documentai.DocumentProcessorServiceClient(
+                    credentials=self._load_credentials(),
+                    client_options=ClientOptions(
+                        api_endpoint=f"{location}-documentai.googleapis.com"
+                    ),
+                )
+                self._docai_clients[location] = client
+            return client
+
+    def storage_client(self) -> Any:
+        """Cloud Storage client, created on first use."""
+        with self._clients_lock:
+            if self._storage_client is None:
+                self._storage_client = storage.Client(credentials=self._load_credentials())
+            return self._storage_client
+
+    def _load_credentials(self) -> Any:
+        # called under _clients_lock
+        if self._credentials is None:
+            self._credentials, _ = google.auth.load_credentials_from_file(self.secrets["GCP_CREDENTIAL_FILE"])
+        return self._credentials
+
+    def batch(self, **kwargs) -> ContextManager[IngestionBatch]:
+        """
+        Context manager deferring graph wide post-processing to one finalize, see IngestionBatch.
+
+        Inside an active batch the active batch is joined (kwargs are ignored) and finalizes once at its end.
+        """
+        if self._batch is not None:
+            return contextlib.nullcontext(self._batch)
+        return IngestionBatch(ingestion=self, **kwargs)
 
     def __call__(self, new_file_name: str,
                  file_to_ingest=None,
                  ingest_local_file: bool = False,
-                 async_comm_reports=True) -> str:
+                 async_comm_reports=True,
+                 max_tokens: Optional[int] = None,
+                 max_cost_usd: Optional[float] = None) -> str:
+        """
+        Uploads, OCRs and extracts one PDF into the knowledge graph.
+
+        All model calls of the document are charged to one token budget (max_tokens, max_cost_usd,
+        defaulting to DOC_MAX_TOKENS and DOC_MAX_COST_USD in .env). Once the budget runs low calls are
+        downgraded to the cheaper model, once it is exhausted ingestion of the document stops gracefully.
+
+        The raw PDF is uploaded while it is OCR'd, OCR does not need the stored copy. With streaming
+        enabled extraction starts with the first pages while later pages are still OCR'd.
+        The steps are also available one by one (upload, ocr, extract, post_process) for the
+        IngestionPipeline, which runs them for many parts of a document concurrently.
+        Inside an active batch() the graph wide post-processing is deferred to the end of the batch.
+        """
+        budget = self.document_budget(name=new_file_name, max_tokens=max_tokens, max_cost_usd=max_cost_usd)
+
+        def branch_input() -> ContextManager:
+            # local files are opened by path in every step
+            return contextlib.nullcontext() if ingest_local_file else open_pdf(file_to_ingest)
+
+        def upload() -> None:
+            with branch_input() as pdf_file:
+                self.upload(new_file_name=new_file_name, file_to_ingest=pdf_file, ingest_local_file=ingest_local_file)
+
+        print("+++++ Upload raw PDF and Document OCR... +++++")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingestion-upload") as executor:
+            uploaded = executor.submit(contextvars.copy_context().run, upload)
+            if self.streaming:
+                print("+++++ Streaming OCR text into Graph Extraction +++++")
+                pages: list[str] = []
+                with budget:
+                    try:
+                        with branch_input() as pdf_file:
+                            extracted = self.stream_extract(
+                                self.page_texts(new_file_name=new_file_name, file_to_ingest=pdf_file,
+                                                ingest_local_file=ingest_local_file),
+                                pages_read=pages)
+                        if extracted:
+                            self.post_process(async_comm_reports=async_comm_reports)
+                    except BudgetExceeded as e:
+                        print(f"+++++ Graph Ingestion stopped: {e} +++++")
+                        print(budget.ledger.summary())
+                        uploaded.result()
+                        return "\n".join(pages)
+                uploaded.result()
+                print(budget.ledger.summary())
+                print("+++++ Graph Ingestion Done. +++++")
+                return "\n".join(pages)
+            with branch_input() as pdf_file:
+                document_string = self.ocr(new_file_name=new_file_name, file_to_ingest=pdf_file,
+                                           ingest_local_file=ingest_local_file)
+            uploaded.result()
+        
+        print("+++++ Extracting Graph Data +++++")
+        with budget:
+            try:
+                if self.extract(document_string=document_string):
+                    self.post_process(async_comm_reports=async_comm_reports)
+            except BudgetExceeded as e:
+                print(f"+++++ Graph Ingestion stopped: {e} +++++")
+                print(budget.ledger.summary())
+                return document_string
+
+        print(budget.ledger.summary())
+        print("+++++ Graph Ingestion Done. +++++")
+        return document_string
 
-        print("+++++ Upload raw PDF... +++++")
+    def document_budget(self, name: str,
+                        max_tokens: Optional[int] = None,
+                        max_cost_usd: Optional[float] = None) -> TokenBudget:
+        """Token budget of one document, limits default to DOC_MAX_TOKENS and DOC_MAX_COST_USD in .env."""
+        if max_tokens is None and self.secrets.get("DOC_MAX_TOKENS"):
+            max_tokens = int(self.secrets["DOC_MAX_TOKENS"])
+        if max_cost_usd is None and self.secrets.get("DOC_MAX_COST_USD"):
+            max_cost_usd = float(self.secrets["DOC_MAX_COST_USD"])
+        return TokenBudget(name=name, max_tokens=max_tokens, max_cost_usd=max_cost_usd)
+
+    def upload(self, new_file_name: str, file_to_ingest=None, ingest_local_file: bool = False) -> None:
+        """Stores the raw PDF (bytes or a binary file object) in the raw uploads bucket."""
         self._store_raw_upload(
             new_file_name=new_file_name, file_to_ingest=file_to_ingest, ingest_local_file=ingest_local_file)
 
-        print("+++++ Document OCR... +++++")
-        document_string = self._ocr_pdf(
+    def ocr(self, new_file_name: str, file_to_ingest=None, ingest_local_file: bool = False) -> str:
+        """
+        Returns the text of the PDF.
+
+        Born-digital pages are read from the PDF's own text layer. Only scanned pages and pages with
+        an unusable text layer are sent to Document AI OCR, all in one request, and the page texts
+        are merged back in page order. Pages OCR'd before (in any part of any split) are taken from
+        the page OCR cache. Without the fast path (OCR_TEXT_LAYER=false in .env) every page is OCR'd,
+        if the PDF can not be read locally the whole document is OCR'd in one request.
+
+        file_to_ingest may be the PDF bytes or a seekable binary file object (e.g. a spooled split
+        part), only the pages sent to OCR are read into memory as a whole.
+        """
+        if ingest_local_file:
+            with open(new_file_name, "rb") as f:
+                return self.ocr(new_file_name=new_file_name, file_to_ingest=f)
+        pdf_file = file_to_ingest
+
+        page_texts = self._local_page_texts(pdf_file, page_by_page=self.page_ocr_cache is not None)
+        if page_texts is None:
+            return self._ocr_whole_pdf(new_file_name, pdf_file)
+
+        ocr_pages = [i for i, text in enumerate(page_texts) if text is None]
+        print(f"{len(page_texts) - len(ocr_pages)}/{len(page_texts)} pages read from the text layer, "
+              f"{len(ocr_pages)} pages sent to OCR")
+        if ocr_pages:
+            for page_num, text in zip(ocr_pages, self._ocr_pages(new_file_name, pdf_file, ocr_pages)):
+                page_texts[page_num] = text
+        return "\n".join(text or "" for text in page_texts)
+
+    def page_texts(self, new_file_name: str, file_to_ingest=None, ingest_local_file: bool = False) -> Iterator[str]:
+        """
+        Yields the text of every page of the PDF in page order, each as soon as it is available.
+
+        Like ocr, but text layer pages are yielded right away and the pages that need OCR are sent in
+        requests of stream_ocr_pages pages. Up to stream_ocr_lookahead requests run ahead of the
+        page the consumer is at, a consumer that falls behind holds further OCR requests back.
+        A PDF that can not be read locally is OCR'd as a whole and yielded as one text.
+        """
+        if ingest_local_file:
+            with open(new_file_name, "rb") as f:
+                yield from self.page_texts(new_file_name=new_file_name, file_to_ingest=f)
+            return
+        pdf_file = file_to_ingest
+
+        texts = self._local_page_texts(pdf_file, page_by_page=True)
+        if texts is None:
+            yield self._ocr_whole_pdf(new_file_name, pdf_file)
+            return
+
+        ocr_pages = [i for i, text in enumerate(texts) if text is None]
+        print(f"{len(texts) - len(ocr_pages)}/{len(texts)} pages read from the text layer, "
+              f"{len(ocr_pages)} pages streamed through OCR")
+        step = max(1, self.stream_ocr_pages)
+        requests = [ocr_pages[i:i + step] for i in range(0, len(ocr_pages), step)]
+        request_of = {page_num: r for r, page_nums in enumerate(requests) for page_num in page_nums}
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.stream_ocr_lookahead),
+                                                         thread_name_prefix="ingestion-ocr-stream")
+        pending: dict[int, concurrent.futures.Future] = {}
+        submitted = 0
+
+        def submit_until(r: int) -> None:
+            nonlocal submitted
+            while submitted < len(requests) and submitted < r + max(1, self.stream_ocr_lookahead):
+                pending[submitted] = executor.submit(self._ocr_page_request, new_file_name, pdf_file,
+                                                     requests[submitted])
+                submitted += 1
+
+        try:
+            # the first requests run while the text layer pages before them are consumed
+            submit_until(0)
+            for page_num in range(len(texts)):
+                if texts[page_num] is None:
+                    r = request_of[page_num]
+                    submit_until(r)
+                    for ocr_page, text in zip(requests[r], pending.pop(r).result()):
+                        texts[ocr_page] = text
+                yield texts[page_num] or ""
+                texts[page_num] = None
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _local_page_texts(self, pdf_file: Union[bytes, BinaryIO],
+                          page_by_page: bool) -> Optional[list[Optional[str]]]:
+        """
+        Page texts read from the text layer, None for pages that need OCR.
+
+        None if the whole document is OCR'd in one request: when it can not be read locally, or
+        without the fast path unless page_by_page.
+        """
+        if self.text_layer_fast_path:
+            return self._text_layer_pages(pdf_file)
+        if not page_by_page:
+            return None
+        # every page needs OCR, but page by page (e.g. so cached pages are reused)
+        num_pages = self._page_count(pdf_file)
+        return None if num_pages is None else [None] * num_pages
+
+    def _ocr_whole_pdf(self, new_file_name: str, pdf_file: Union[bytes, BinaryIO]) -> str:
+        return self._ocr_pdf(
             processor_id=self.docai_processor_id,
             processor_version=self.docai_processor_version,
             location=self.gcp_multiregion,
             file_path=new_file_name,
-            file_to_ingest=file_to_ingest,
-            ingest_local_file=ingest_local_file)
-        
-        print("+++++ Extracting Graph Data +++++")
+            file_to_ingest=self._pdf_bytes(pdf_file))
+
+    def _ocr_page_request(self, new_file_name: str, pdf_file: Union[bytes, BinaryIO], page_nums: list[int]) -> list[str]:
+        # concurrent requests of one stream read the PDF through their own handles
+        with open_pdf(pdf_file) as source:
+            return self._ocr_pages(new_file_name, source, page_nums)
+
+    @staticmethod
+    def _pdf_stream(file_to_ingest: Union[bytes, BinaryIO]) -> BinaryIO:
+        """Seekable stream at the start of the PDF, PDF bytes are wrapped without copying them."""
+        if isinstance(file_to_ingest, (bytes, bytearray, memoryview)):
+            return io.BytesIO(file_to_ingest)
+        file_to_ingest.seek(0)
+        return file_to_ingest
+
+    @classmethod
+    def _pdf_bytes(cls, file_to_ingest: Union[bytes, BinaryIO]) -> bytes:
+        """PDF bytes for requests that need the whole document in memory."""
+        if isinstance(file_to_ingest, bytes):
+            return file_to_ingest
+        return cls._pdf_stream(file_to_ingest).read()
+
+    def _text_layer_pages(self, pdf_file: Union[bytes, BinaryIO]) -> Optional[list[Optional[str]]]:
+        """Text of every page with a usable text layer, None for pages that need OCR (or for an unreadable PDF)."""
+        try:
+            pdf_reader = PyPDF2.PdfReader(self._pdf_stream(pdf_file))
+            return [self._usable_text_layer(page.extract_text() or "") for page in pdf_reader.pages]
+        except Exception as e:
+            print(f"Warning: Text layer not readable, OCR'ing the whole document: {e}")
+            return None
+
+    def _usable_text_layer(self, text: str) -> Optional[str]:
+        """Returns the text of a page if its text layer is good enough to skip OCR, otherwise None."""
+        stripped = text.strip()
+        if not stripped or len(stripped) < self.min_text_layer_chars:
+            # scanned pages have no (or only a tiny) text layer
+            return None
+
+        # broken font encodings extract as symbols, (cid:123) escapes or replacement characters
+        readable = sum(c.isalnum() or c.isspace() or c in ".,;:!?'\"()[]-%/&$€@#+*=" for c in stripped)
+        if readable / len(stripped) < 0.85 or stripped.count("\ufffd") + stripped.count("(cid:") > len(stripped) / 100:
+            return None
+
+        # text layers without word spacing or with one character per line are not worth extracting from
+        words = stripped.split()
+        average_word_length = sum(len(w) for w in words) / len(words)
+        if not 2 <= average_word_length <= 15:
+            return None
+        return text
+
+    def _page_count(self, pdf_file: Union[bytes, BinaryIO]) -> Optional[int]:
+        try:
+            return len(PyPDF2.PdfReader(self._pdf_stream(pdf_file)).pages)
+        except Exception as e:
+            print(f"Warning: PDF not readable, OCR'ing the whole document: {e}")
+            return None
+
+    def _ocr_pages(self, new_file_name: str, pdf_file: Union[bytes, BinaryIO], page_nums: list[int]) -> list[str]:
+        """
+        OCRs the given pages of a PDF and returns their texts in order.
+
+        Pages found in the page OCR cache are not OCR'd again, the others are sent in one
+        Document AI request and cached.
+        """
+        pdf_reader = PyPDF2.PdfReader(self._pdf_stream(pdf_file))
+
+        texts: dict[int, str] = {}
+        page_keys: dict[int, str] = {}
+        if self.page_ocr_cache is not None:
+            processor = f"{self.docai_processor_id}/{self.docai_processor_version}"
+            page_keys = {page_num: PageOCRCache.page_key(pdf_reader, page_num, processor) for page_num in page_nums}
+            cached = self.page_ocr_cache.get_many(list(page_keys.values()))
+            texts = {page_num: cached[key] for page_num, key in page_keys.items() if key in cached}
+            print(f"{len(texts)}/{len(page_nums)} OCR pages taken from the page cache")
+
+        missing = [page_num for page_num in page_nums if page_num not in texts]
+        if missing:
+            ocr_texts, per_page = self._ocr_uncached_pages(new_file_name, pdf_reader, missing)
+            texts.update(zip(missing, ocr_texts))
+            if self.page_ocr_cache is not None and per_page:
+                self.page_ocr_cache.put_many({page_keys[page_num]: text for page_num, text in zip(missing, ocr_texts)})
+        return [texts.get(page_num, "") for page_num in page_nums]
+
+    def _ocr_uncached_pages(self, new_file_name: str, pdf_reader: PyPDF2.PdfReader,
+                            page_nums: list[int]) -> tuple[list[str], bool]:
+        """OCRs the given pages with one Document AI request, returns their texts and whether they could be told apart."""
+        pdf_writer = PyPDF2.PdfWriter()
+        for page_num in page_nums:
+            pdf_writer.add_page(pdf_reader.pages[page_num])
+        tmp = io.BytesIO()
+        pdf_writer.write(tmp)
+
+        document = self._ocr_document(
+            processor_id=self.docai_processor_id,
+            processor_version=self.docai_processor_version,
+            location=self.gcp_multiregion,
+            file_path=new_file_name,
+            file_to_ingest=tmp.getvalue())
+
+        page_texts = [self._layout_text(document, page.layout) for page in document.pages]
+        if len(page_texts) != len(page_nums):
+            # keep the text even if it can not be attributed to single pages
+            return [document.text] + [""] * (len(page_nums) - 1), False
+        return page_texts, True
+
+    @staticmethod
+    def _layout_text(document: documentai.Document, layout) -> str:
+        return "".join(document.text[int(segment.start_index):int(segment.end_index)]
+                       for segment in layout.text_anchor.text_segments)
+
+    def extract(self, document_string: str, max_extr_rounds: int = 1) -> bool:
+        """Extracts and saves the nodes and edges of one document text, returns False if there was no text."""
+        if not document_string.strip():
+            return False
+        extractor = GCPGraphExtractor(graph_db=self.graph_db, merge_lock=self._merge_lock)
+        extractor(text_input=document_string, max_extr_rounds=max_extr_rounds)
+        if self._batch is not None:
+            self._batch.mark_dirty()
+        return True
+
+    def stream_extract(self, pages: Iterable[str], pages_read: Optional[list[str]] = None) -> bool:
+        """
+        Extracts a stream of page texts (e.g. page_texts) chunk by chunk, returns False if there was no text.
+
+        Pages are cut into overlapping chunks of chunk_tokens tokens, every chunk is extracted as soon
+        as it is complete while later pages are still read, by stream_extraction_workers threads
+        whose results are merged into the graph one at a time. The chunk queue is bounded, so the
+        pages are not read further ahead than the extraction can follow. The first failed chunk
+        stops the stream, its exception is raised once the chunks in flight are extracted.
+
+        pages_read collects the pages consumed from pages, also if extraction fails.
+        """
+        def read_pages() -> Iterator[str]:
+            for text in pages:
+                if pages_read is not None:
+                    pages_read.append(text)
+                yield text
+
+        workers_count = max(1, self.stream_extraction_workers)
+        chunk_queue: queue.Queue = queue.Queue(maxsize=workers_count)
+        errors: list[Exception] = []
+        extracted: list[bool] = []
+
+        def work() -> None:
+            while True:
+                chunk = chunk_queue.get()
+                if chunk is _DONE:
+                    return
+                if errors:
+                    continue
+                try:
+                    extracted.append(self.extract(document_string=chunk))
+                except Exception as e:
+                    errors.append(e)
+
+        # every worker runs in a copy of the caller's context, e.g. its document budget
+        workers = [threading.Thread(target=contextvars.copy_context().run, args=(work,),
+                                    name=f"ingestion-chunk-extraction-{i}", daemon=True)
+                   for i in range(workers_count)]
+        for t in workers:
+            t.start()
+        chunks = sliding_window_chunks(read_pages(), chunk_tokens=self.chunk_tokens,
+                                       overlap_tokens=self.chunk_overlap_tokens)
+        try:
+            for chunk in chunks:
+                if errors:
+                    break
+                chunk_queue.put(chunk)
+        finally:
+            chunks.close()
+            # a page generator stops its OCR requests right away, not once it is garbage collected
+            if hasattr(pages, "close"):
+                pages.close()
+            for _ in workers:
+                chunk_queue.put(_DONE)
+            for t in workers:
+                t.join()
+        if errors:
+            raise errors[0]
+        return any(extracted)
+
+    def post_process(self, async_comm_reports: bool = True) -> None:
+        """
+        Graph wide steps after extraction: community reports, embeddings and the graph visualization.
+
+        Deferred to the end of the active batch, if any.
+        """
+        if self._batch is not None:
+            self._batch.mark_dirty(async_comm_reports=async_comm_reports)
+            return None
+        self._run_post_process(async_comm_reports=async_comm_reports)
+        return None
+
+    def _run_post_process(self, async_comm_reports: bool = True) -> None:
         extractor = GCPGraphExtractor(graph_db=self.graph_db)
-        extractor(text_input=document_string, max_extr_rounds=1) # extracts and saves nodes and edges
 
         # Trigger community report generation as asyncronous or periodical operation
         if async_comm_reports == True:
             extractor.comm_async_report(kg=self.graph_db)
         elif async_comm_reports == False: 
             extractor.generate_comm_reports(kg=self.graph_db)
-    
+
         extractor.update_node_embeddings()
+        extractor.update_node_description_embeddings()
         self.graph_db.visualize_graph(filename="./visualize_kg.png")
 
-        print("+++++ Graph Ingestion Done. +++++")
-        return document_string
-
     def _process_document(
         self,
         location: str,
@@ -98,12 +736,7 @@ class IngestionSession:
         ingest_local_file: bool = False,
     ) -> documentai.Document:
 
-        client = documentai.DocumentProcessorServiceClient(
-            credentials=self.credentials,
-            client_options=ClientOptions(
-                api_endpoint=f"{location}-documentai.googleapis.com"
-            ),
-        )
+        client = self.docai_client(location)
 
         # file_path = file_path.getvalue()
 
@@ -127,7 +760,8 @@ class IngestionSession:
             process_options=process_options,
         )
 
-        result = client.process_document(request=request)
+        with self._ocr_slots:
+            result = client.process_document(request=request)
 
         return result.document
 
@@ -140,6 +774,26 @@ class IngestionSession:
                  file_to_ingest=None,
                  ingest_local_file: bool = False) -> str:
 
+        document = self._ocr_document(
+            processor_id=processor_id,
+            processor_version=processor_version,
+            file_path=file_path,
+            location=location,
+            mime_type=mime_type,
+            file_to_ingest=file_to_ingest,
+            ingest_local_file=ingest_local_file)
+
+        return document.text
+
+    def _ocr_document(self,
+                      processor_id: str,
+                      processor_version: str,
+                      file_path: str,
+                      location: str,
+                      mime_type: str = "application/pdf",
+                      file_to_ingest=None,
+                      ingest_local_file: bool = False) -> documentai.Document:
+
         process_options = documentai.ProcessOptions(
             ocr_config=documentai.OcrConfig(
                 enable_native_pdf_parsing=True,
@@ -165,13 +819,13 @@ class IngestionSession:
             ingest_local_file=ingest_local_file,
         )
 
-        return document.text
+        return document
 
     def _store_raw_upload(
         self, new_file_name: str, file_to_ingest, ingest_local_file: bool = False
     ) -> None:
         # store raw uploaded pdf in gcs
-        storage_client = storage.Client(credentials=self.credentials)
+        storage_client = self.storage_client()
         bucket = storage_client.bucket(self.secrets["RAW_PDFS_BUCKET_NAME"])
         print(new_file_name)
 
@@ -188,8 +842,8 @@ class IngestionSession:
         if ingest_local_file:
             blob.upload_from_filename(new_file_name)
         else:
-            file_contents = io.BytesIO(file_to_ingest)
-            blob.upload_from_file(file_contents)
+            # file objects (split parts spilled to disk) are streamed to the bucket as they are
+            blob.upload_from_file(self._pdf_stream(file_to_ingest))
 
         return None
 
@@ -1,25 +1,32 @@
 from dataclasses import dataclass
 from pyparsing import abstractmethod
-from typing import Any
+from typing import Any, Iterator, Optional
 import json
 from dotenv import dotenv_values
 import time
 from operator import attrgetter
 import os
+import uuid
 
 import google.auth
 from google.cloud import pubsub_v1
+from google.cloud.firestore_v1.vector import Vector
+from google.cloud.firestore_v1.base_vector_query import DistanceMeasure
 
 import firebase_admin
 from firebase_admin import firestore
 
-from langfuse.decorators import observe, langfuse_context
+from graphrag_lite.Observability import observe, obs_context
 
 from graph2nosql.databases.firestore_kg import FirestoreKG
 from graph2nosql.datamodel import data_model
 
 import graphrag_lite.prompts as prompts
 from graphrag_lite.LLMSession import LLMSession
+from graphrag_lite.TokenBudget import TokenBudget, BudgetExceeded, budgeted_context_tokens, budgeted_model, budgeted_stream
+from graphrag_lite.ModelRouter import default_model_router, classify_query
+from graphrag_lite.CommunityReportCache import CommunityReportSnapshot
+from graphrag_lite.GraphExtractor import node_embedding_collection_id
 
 
 @dataclass
@@ -30,14 +37,45 @@ class CommunityAnswerRequest:
 
     community_report: data_model.CommunityData
     user_query: str
+    query_id: str
 
     def __to_dict__(self):
         return {
             "community_report": self.community_report.__to_dict__(),
-            "user_query": self.user_query
+            "user_query": self.user_query,
+            "query_id": self.query_id
         }
 
 
+@dataclass
+class CommunityBatchAnswerRequest:
+    """
+    Dataclass describing a Workload request that asks for intermediate user query answers of several communities in one structured LLM call.
+    """
+
+    community_reports: list[data_model.CommunityData]
+    user_query: str
+    query_id: str
+
+    def __to_dict__(self):
+        return {
+            "community_reports": [map_report_dict(c) for c in self.community_reports],
+            "user_query": self.user_query,
+            "query_id": self.query_id
+        }
+
+
+def map_report_dict(community_report: data_model.CommunityData) -> dict:
+    """Community report fields the map stage answers from, without embeddings and node lists."""
+    return {
+        "title": community_report.title,
+        "summary": community_report.summary,
+        "rating": community_report.rating,
+        "rating_explanation": community_report.rating_explanation,
+        "findings": community_report.findings
+    }
+
+
 @dataclass
 class IntermediateCommRespose:
     community: str
@@ -60,20 +98,69 @@ class IntermediateCommRespose:
             )
 
 
+BUDGET_EXHAUSTED_ANSWER = "The query could not be answered within its token budget."
+
+
 class KGraphGlobalQuery:
-    def __init__(self) -> None:
+    def __init__(self, max_context_tokens: int = 8000,
+                 map_batch_tokens: int = 0,
+                 max_map_batch_size: int = 10,
+                 max_query_tokens: Optional[int] = None,
+                 max_query_cost_usd: Optional[float] = None) -> None:
         # initialized with info on mq, knowledge graph, shared nosql state
-        pass
+        # token budget of the analyst reports packed into the reduce prompt
+        self.max_context_tokens = max_context_tokens
+        # map stage batching: 0 sends one request per community, otherwise reports are packed up to this many tokens per request
+        self.map_batch_tokens = map_batch_tokens
+        self.max_map_batch_size = max_map_batch_size
+        # token budget of the model calls made by this process for one query (map stage calls run in the workers)
+        self.max_query_tokens = max_query_tokens
+        self.max_query_cost_usd = max_query_cost_usd
+        self.router = default_model_router()
 
     @observe()
     def __call__(self, user_query: str) -> str:
+        """Answers the user query with a global map-reduce over all community reports."""
+        with TokenBudget(name=user_query, max_tokens=self.max_query_tokens, max_cost_usd=self.max_query_cost_usd):
+            try:
+                llm, final_query_string = self._prepare_reduce(user_query=user_query)
+                final_response = llm.generate(client_query_string=final_query_string, stage="reduce")
+            except BudgetExceeded as e:
+                print(e)
+                return BUDGET_EXHAUSTED_ANSWER
+        return final_response
+
+    @observe()
+    def stream(self, user_query: str) -> Iterator[str]:
+        """
+        Answers the user query like __call__ but yields the reduce stage answer incrementally.
+
+        The map stage still has to complete before the first chunk is yielded.
+        """
+        budget = TokenBudget(name=user_query, max_tokens=self.max_query_tokens, max_cost_usd=self.max_query_cost_usd)
+        yield from budgeted_stream(budget, self._reduce_stream(user_query=user_query))
+
+    def _reduce_stream(self, user_query: str) -> Iterator[str]:
+        try:
+            llm, final_query_string = self._prepare_reduce(user_query=user_query)
+            yield from llm.generate_stream(client_query_string=final_query_string, stage="reduce")
+        except BudgetExceeded as e:
+            print(e)
+            yield BUDGET_EXHAUSTED_ANSWER
+
+    @observe()
+    def _prepare_reduce(self, user_query: str) -> tuple[LLMSession, str]:
+        """Runs the map stage and returns the reduce llm session together with the final query string."""
 
         # orchestration method taking natural language user query to produce and return final answer to client
         comm_report_list = self._get_comm_reports()
 
+        # every request gets its own id so identical or concurrent queries never share intermediate results
+        query_id = uuid.uuid4().hex
+
         # pair user query with existing community reports
         query_msg_list = self._context_builder(
-            user_query=user_query, comm_report_list=comm_report_list)
+            user_query=user_query, query_id=query_id, comm_report_list=comm_report_list)
 
         # send pairs to pubsub queue for work scheduling
         for msg in query_msg_list:
@@ -82,7 +169,7 @@ class KGraphGlobalQuery:
 
         # periodically query shared state to check for processing compeltion & get intermediate responses
         intermediate_response_list = self._check_shared_state(
-            user_query=user_query)
+            query_id=query_id, expected_responses=len(comm_report_list))
 
         # based on helpfulness build final context
         sorted_final_responses = self._filter_and_sort_responses(intermediate_response_list=intermediate_response_list)
@@ -90,29 +177,38 @@ class KGraphGlobalQuery:
         # get full community reports for the selected communities
         comm_report_list = self._get_communities_reports(sorted_final_responses)
 
+        # pack intermediate responses and report sections into the reduce token budget,
+        # shrunk to what the query budget can still pay for
+        reduce_model_name = self.router.route("reduce", query_type=classify_query(user_query))
+        max_context_tokens = budgeted_context_tokens(self.max_context_tokens,
+                                                     model_name=budgeted_model(reduce_model_name))
+        final_context = self._build_final_context(sorted_final_responses=sorted_final_responses,
+                                                  comm_report_list=comm_report_list,
+                                                  max_context_tokens=max_context_tokens)
+
         # generate & return final response based on final context community repors and nodes.
         final_response_system = prompts.GLOBAL_SEARCH_REDUCE_SYSTEM.format(
             response_type="Detailled and wholistic in academic style analysis of the given information in at least 8-10 sentences across 2-3 paragraphs.")
         
-        langfuse_context.update_current_trace(
+        obs_context.update_current_trace(
                 name="Global Query Reduce",
                 public=False
             )
 
-        llm = LLMSession(
+        llm = LLMSession.get(
             system_message=final_response_system,
-            model_name="gemini-1.5-pro-001"
+            model_name=reduce_model_name,
+            priority="interactive"
         )
 
         final_query_string = prompts.GLOBAL_SEARCH_REDUCE_QUERY.format(
-            report_data=comm_report_list,
+            report_data=final_context,
             user_query=user_query
         )
-        final_response = llm.generate(client_query_string=final_query_string)
-        return final_response
+        return llm, final_query_string
 
     @abstractmethod
-    def _send_to_mq(self, message: CommunityAnswerRequest):
+    def _send_to_mq(self, message: CommunityAnswerRequest | CommunityBatchAnswerRequest):
         # method to send to message queue for async work scheduling
         pass
 
@@ -122,11 +218,12 @@ class KGraphGlobalQuery:
         pass
 
     @abstractmethod
-    def _check_shared_state(self, user_query: str,
+    def _check_shared_state(self, query_id: str,
+                            expected_responses: int,
                             max_attempts: int = 6,
                             sleep_time: int = 10) -> list[IntermediateCommRespose]:
         # method to check shared state for query result
-        # method to query shared state for intermediate responses for one given user query
+        # method to query shared state for intermediate responses for one given query request
         pass
 
     @abstractmethod
@@ -134,18 +231,116 @@ class KGraphGlobalQuery:
         """Get Community reports for final context building depending on selected KG storage."""
         pass
 
-    def _context_builder(self, user_query: str, comm_report_list: list[data_model.CommunityData]) -> list[CommunityAnswerRequest]:
+    def _context_builder(self, user_query: str, query_id: str,
+                         comm_report_list: list[data_model.CommunityData]) -> list[CommunityAnswerRequest] | list[CommunityBatchAnswerRequest]:
         # given a user query pulls community reports and sends (query, community) objects for distributed LLM inference
+        if self.map_batch_tokens > 0:
+            return self._batch_context_builder(user_query=user_query, query_id=query_id,
+                                               comm_report_list=comm_report_list)
+
         comm_answer_request_list = [CommunityAnswerRequest(
-            community_report=c, user_query=user_query) for c in comm_report_list]
+            community_report=c, user_query=user_query, query_id=query_id) for c in comm_report_list]
         return comm_answer_request_list
 
-    def _build_final_context(self, user_query: str, report: data_model.CommunityData):
-        # method to generate final context based on helpfulness of top intermediate responses
-        # final context includes community info for most helpful based on int responses
-        # final context might also include node descriptions of the community members
+    def _batch_context_builder(self, user_query: str, query_id: str,
+                               comm_report_list: list[data_model.CommunityData]) -> list[CommunityBatchAnswerRequest]:
+        """
+        Packs community reports into batched map requests of at most map_batch_tokens prompt tokens
+        and max_map_batch_size reports. Reports larger than the token budget get a request of their own.
+        """
+        batches: list[list[data_model.CommunityData]] = []
+        batch, batch_tokens = [], 0
+        for c in comm_report_list:
+            report_tokens = LLMSession.estimate_tokens(json.dumps(map_report_dict(c)))
+            if batch and (batch_tokens + report_tokens > self.map_batch_tokens or len(batch) >= self.max_map_batch_size):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(c)
+            batch_tokens += report_tokens
+        if batch:
+            batches.append(batch)
+
+        print(f"{len(comm_report_list)} community reports packed into {len(batches)} map requests")
+        return [CommunityBatchAnswerRequest(community_reports=b, user_query=user_query, query_id=query_id)
+                for b in batches]
+
+    def _build_final_context(self,
+                             sorted_final_responses: list[IntermediateCommRespose],
+                             comm_report_list: list[data_model.CommunityData],
+                             max_context_tokens: int = 8000,
+                             max_findings: int = 5,
+                             max_finding_chars: int = 600) -> str:
+        """
+        Packs the selected intermediate responses and their community reports into the reduce context.
 
-        return ""
+        Sections are added in score order until the token budget is used up. A section that does not fit
+        in full is retried with fewer findings before packing stops. Embeddings, node lists and other
+        bookkeeping fields of the community reports are never part of the context.
+
+        Args:
+            sorted_final_responses: Intermediate responses sorted by score in descending order.
+            comm_report_list: Community reports of the selected communities.
+            max_context_tokens: Token budget of the packed context.
+            max_findings: Maximum number of findings included per community report.
+            max_finding_chars: Findings explanations are truncated to this many characters.
+
+        Returns:
+            The analyst reports section of the reduce prompt.
+        """
+        reports_by_title = {r.title: r for r in comm_report_list}
+
+        context_sections = []
+        used_tokens = 0
+        for response in sorted_final_responses:
+            report = reports_by_title.get(response.community)
+            findings = self._trim_findings(report, max_findings=max_findings,
+                                           max_finding_chars=max_finding_chars)
+
+            # drop findings one by one until the section fits the remaining budget
+            for num_findings in range(len(findings), -1, -1):
+                section = self._format_context_section(response=response, report=report,
+                                                       findings=findings[:num_findings])
+                section_tokens = LLMSession.estimate_tokens(section)
+                if used_tokens + section_tokens <= max_context_tokens:
+                    break
+            else:
+                break
+
+            context_sections.append(section)
+            used_tokens += section_tokens
+
+        print(f"Final context: {len(context_sections)}/{len(sorted_final_responses)} reports, ~{used_tokens} tokens")
+        return "\n\n".join(context_sections)
+
+    def _trim_findings(self, report: data_model.CommunityData | None,
+                       max_findings: int,
+                       max_finding_chars: int) -> list[str]:
+        """Formats the first findings of a community report as bullet points with truncated explanations."""
+        if report is None or not report.findings:
+            return []
+
+        trimmed_findings = []
+        for finding in report.findings[:max_findings]:
+            if not isinstance(finding, dict) or not finding:
+                continue
+            explanation = str(finding.get("explanation", ""))
+            if len(explanation) > max_finding_chars:
+                explanation = explanation[:max_finding_chars].rsplit(" ", 1)[0] + " ..."
+            trimmed_findings.append(f"- {finding.get('summary', '')}: {explanation}")
+        return trimmed_findings
+
+    def _format_context_section(self, response: IntermediateCommRespose,
+                                report: data_model.CommunityData | None,
+                                findings: list[str]) -> str:
+        """Renders one analyst report section of the reduce context."""
+        lines = [f"----- Analyst Report: {response.community} (importance score: {response.score}) -----",
+                 f"Analyst response: {response.response}"]
+        if report is not None:
+            lines.append(f"Community summary: {report.summary}")
+            if findings:
+                lines.append("Key findings:")
+                lines.extend(findings)
+        return "\n".join(lines)
 
     def _filter_and_sort_responses(self,
                                    intermediate_response_list: list[IntermediateCommRespose],
@@ -176,8 +371,19 @@ class KGraphGlobalQuery:
 
 
 class GlobalQueryGCP(KGraphGlobalQuery):
-    def __init__(self, secrets: dict, fskg: FirestoreKG) -> None:
-        super().__init__()
+    def __init__(self, secrets: dict, fskg: FirestoreKG,
+                 max_context_tokens: int = 8000,
+                 map_batch_tokens: Optional[int] = None,
+                 max_map_batch_size: Optional[int] = None,
+                 max_query_tokens: Optional[int] = None,
+                 max_query_cost_usd: Optional[float] = None) -> None:
+        # map stage batching defaults to MAP_BATCH_TOKENS / MAP_BATCH_SIZE from the environment or .env
+        settings = {**secrets, **os.environ}
+        super().__init__(max_context_tokens=max_context_tokens,
+                         map_batch_tokens=int(settings.get("MAP_BATCH_TOKENS", 0)) if map_batch_tokens is None else map_batch_tokens,
+                         max_map_batch_size=int(settings.get("MAP_BATCH_SIZE", 10)) if max_map_batch_size is None else max_map_batch_size,
+                         max_query_tokens=max_query_tokens,
+                         max_query_cost_usd=max_query_cost_usd)
 
         self.secrets = secrets
 
@@ -192,13 +398,19 @@ class GlobalQueryGCP(KGraphGlobalQuery):
 
         self.fskg = fskg
 
+        # community reports are served from a process wide snapshot instead of per query reads
+        self.comm_snapshot = CommunityReportSnapshot.for_collection(
+            fskg=self.fskg,
+            database_id=str(self.secrets["FIRESTORE_DB_ID"]),
+            comm_coll_id=str(self.secrets["COMM_COLL_ID"]))
+
         if not firebase_admin._apps:
             credentials = firebase_admin.credentials.Certificate(
                 str(self.secrets["GCP_CREDENTIAL_FILE"])
             )
             app = firebase_admin.initialize_app(credentials)
 
-    def _send_to_mq(self, message: CommunityAnswerRequest) -> None:
+    def _send_to_mq(self, message: CommunityAnswerRequest | CommunityBatchAnswerRequest) -> None:
         """Publishes one message to a Pub/Sub topic."""
         publisher = pubsub_v1.PublisherClient(credentials=self.gcp_credentials)
         topic_path = publisher.topic_path(
@@ -221,54 +433,316 @@ class GlobalQueryGCP(KGraphGlobalQuery):
 
     def _get_comm_reports(self) -> list[data_model.CommunityData]:
         """
-        Get Full List of communtiy reports from firebase Knowledge Graph Store
+        Get Full List of communtiy reports from the in-memory community report snapshot
         """
-        comm_coll = str(self.secrets["COMM_COLL_ID"])
-        docs = self.fskg.db.collection(comm_coll)
-        return [data_model.CommunityData.__from_dict__(doc.to_dict()) for doc in docs.stream()]
+        return self.comm_snapshot.reports()
 
-    def _check_shared_state(self, user_query: str,
+    def _check_shared_state(self, query_id: str,
+                            expected_responses: int,
                             max_attempts: int = 6,
                             sleep_time: int = 15) -> list[IntermediateCommRespose]:
         """
-        Periodically checks for the existence of a document with user_query as id. 
+        Periodically counts the intermediate responses stored for one query request.
+
+        Every community response is its own document in the responses subcollection of the query
+        request, so polling is a single count aggregation and the documents are only read once
+        the quorum of 90% of the expected responses is reached.
 
         Args:
-            user_query (str): The ID of the document to look for.
-            max_attempts (int, optional): Maximum number of attempts to check. Defaults to 10.
-            sleep_time (int, optional): Time to sleep between attempts in seconds. Defaults to 2.
+            query_id (str): The id of the query request.
+            expected_responses (int): Number of community responses requested for this query.
+            max_attempts (int, optional): Maximum number of attempts to check. Defaults to 6.
+            sleep_time (int, optional): Time to sleep between attempts in seconds. Defaults to 15.
 
         Returns:
-            Dict: The document data if found, otherwise raises timeout error.
+            List of intermediate responses if the quorum is reached, otherwise raises timeout error.
         """
         query_db = firestore.Client(project=self.project_id,  # type: ignore
                               credentials=self.gcp_credentials,
                               database=str(self.secrets["QUERY_FS_DB_ID"]))
-        
-        comm_list = self.fskg.list_communities()
+
+        responses_coll = query_db.collection(
+            str(self.secrets["QUERY_FS_INT__RESPONSE_COLL"])).document(query_id).collection("responses")
 
         time.sleep(5)
         for attempt in range(max_attempts):
-            doc_ref = query_db.collection(
-                str(self.secrets["QUERY_FS_INT__RESPONSE_COLL"])).document(user_query)
-            doc_snapshot = doc_ref.get()
-            if doc_snapshot.exists:
-                num_stored_responses = len(doc_snapshot.to_dict().keys())
-                if num_stored_responses >= len(comm_list) * 0.9:
-                    responses = doc_snapshot.to_dict()
-                    comms = responses.keys()
-                    return [IntermediateCommRespose.from_dict(responses[c]) for c in comms]
-                else:
-                    print(f"Attempt {attempt+1}/{max_attempts}: Document not found, sleeping for {sleep_time} seconds...")
-                    time.sleep(sleep_time)
-            else:
-                print(f"Attempt {attempt+1}/{max_attempts}: Document not found, sleeping for {sleep_time} seconds...")
-                time.sleep(sleep_time)
+            num_stored_responses = int(responses_coll.count().get()[0][0].value)
+            if num_stored_responses >= expected_responses * 0.9:
+                return [IntermediateCommRespose.from_dict(doc.to_dict()) for doc in responses_coll.stream()]
+            print(f"Attempt {attempt+1}/{max_attempts}: {num_stored_responses}/{expected_responses} responses stored, sleeping for {sleep_time} seconds...")
+            time.sleep(sleep_time)
 
-        raise TimeoutError(f"Document with ID '{user_query}' not found after {max_attempts} attempts.")
+        raise TimeoutError(f"Responses for query request '{query_id}' incomplete after {max_attempts} attempts.")
 
     def _get_communities_reports(self, sorted_final_responses: list) -> list[data_model.CommunityData]: 
-        return [self.fskg.get_community(r.community) for r in sorted_final_responses]
+        return self.comm_snapshot.get_reports([r.community for r in sorted_final_responses])
+
+class KGraphLocalQuery:
+    """
+    Entity-centric local search: answers pointed questions from the graph neighborhood of the
+    entities closest to the query with one LLM call instead of a map-reduce over all communities.
+    """
+
+    def __init__(self,
+                 max_context_tokens: int = 8000,
+                 top_k_entities: int = 10,
+                 max_hops: int = 2,
+                 max_nodes: int = 60,
+                 hop_decay: float = 0.5,
+                 max_line_chars: int = 1000,
+                 max_query_tokens: Optional[int] = None,
+                 max_query_cost_usd: Optional[float] = None) -> None:
+        self.max_context_tokens = max_context_tokens
+        self.top_k_entities = top_k_entities
+        self.max_hops = max_hops
+        self.max_nodes = max_nodes
+        self.hop_decay = hop_decay
+        self.max_line_chars = max_line_chars
+        self.max_query_tokens = max_query_tokens
+        self.max_query_cost_usd = max_query_cost_usd
+        self.router = default_model_router()
+
+    @observe()
+    def __call__(self, user_query: str) -> str:
+        """Answers the user query from the local neighborhood of the most similar entities."""
+        with TokenBudget(name=user_query, max_tokens=self.max_query_tokens, max_cost_usd=self.max_query_cost_usd):
+            try:
+                llm, local_query_string = self._prepare_local(user_query=user_query)
+                return llm.generate(client_query_string=local_query_string, stage="local")
+            except BudgetExceeded as e:
+                print(e)
+                return BUDGET_EXHAUSTED_ANSWER
+
+    @observe()
+    def stream(self, user_query: str) -> Iterator[str]:
+        """Answers the user query like __call__ but yields the answer incrementally."""
+        budget = TokenBudget(name=user_query, max_tokens=self.max_query_tokens, max_cost_usd=self.max_query_cost_usd)
+        yield from budgeted_stream(budget, self._local_stream(user_query=user_query))
+
+    def _local_stream(self, user_query: str) -> Iterator[str]:
+        try:
+            llm, local_query_string = self._prepare_local(user_query=user_query)
+            yield from llm.generate_stream(client_query_string=local_query_string, stage="local")
+        except BudgetExceeded as e:
+            print(e)
+            yield BUDGET_EXHAUSTED_ANSWER
+
+    @observe()
+    def _prepare_local(self, user_query: str) -> tuple[LLMSession, str]:
+        """Retrieves the query neighborhood and returns the llm session together with the local search query string."""
+
+        obs_context.update_current_trace(
+            name="Local Query",
+            public=False
+        )
+
+        local_system = prompts.LOCAL_SEARCH_SYSTEM.format(
+            response_type="Concise and factual answer of 2-3 paragraphs with data references.")
+
+        # the context is sized for the large model, lookup questions over a small context are
+        # answered by the small model once the context is known
+        max_context_tokens = budgeted_context_tokens(self.max_context_tokens,
+                                                     model_name=budgeted_model(self.router.large_model))
+
+        # entry points into the graph are the entities with the most similar description embeddings
+        embedding_llm = LLMSession.get(system_message=local_system, model_name=self.router.large_model,
+                                       priority="interactive")
+        query_embedding = embedding_llm.embed_text(text=user_query, task="RETRIEVAL_QUERY")[0].values
+        seed_uids = self._nearest_entities(query_embedding=query_embedding, top_k=self.top_k_entities)
+
+        node_scores, nodes = self._expand_neighborhood(seed_uids=seed_uids)
+
+        entity_data, relationship_data, report_data = self._build_local_context(
+            node_scores=node_scores, nodes=nodes, max_context_tokens=max_context_tokens)
+
+        local_query_string = prompts.LOCAL_SEARCH_QUERY.format(
+            entity_data=entity_data,
+            relationship_data=relationship_data,
+            report_data=report_data,
+            user_query=user_query
+        )
+
+        llm = LLMSession.get(
+            system_message=local_system,
+            model_name=self.router.route("local",
+                                         input_tokens=LLMSession.estimate_tokens(local_query_string),
+                                         query_type=classify_query(user_query)),
+            priority="interactive"
+        )
+        return llm, local_query_string
+
+    @abstractmethod
+    def _nearest_entities(self, query_embedding: list[float], top_k: int) -> list[str]:
+        """Returns the uids of the top_k entities closest to the query embedding, nearest first."""
+        pass
+
+    @abstractmethod
+    def _get_nodes(self, node_uids: list[str]) -> dict[str, data_model.NodeData]:
+        """Returns the existing nodes among node_uids keyed by uid."""
+        pass
+
+    @abstractmethod
+    def _get_edges(self, edge_pairs: list[tuple[str, str]]) -> dict[tuple[str, str], data_model.EdgeData]:
+        """Returns the existing edges among the (source_uid, target_uid) pairs keyed by pair, in one read."""
+        pass
+
+    @abstractmethod
+    def _get_comm_reports(self) -> list[data_model.CommunityData]:
+        """Returns all community reports."""
+        pass
+
+    def _expand_neighborhood(self, seed_uids: list[str]) -> tuple[dict[str, float], dict[str, data_model.NodeData]]:
+        """
+        Expands a weighted k-hop neighborhood around the seed entities.
+
+        Seeds are weighted by similarity rank. Every hop passes a decayed share of a node's score on to
+        its neighbors, so nodes reachable from several relevant entities accumulate higher scores, while
+        the share is damped for high degree hubs. Only the best scoring nodes up to max_nodes are kept.
+
+        Returns:
+            Scores and node data of the nodes in the neighborhood, both keyed by node uid.
+        """
+        scores = {uid: 1.0 - rank / (2 * len(seed_uids)) for rank, uid in enumerate(seed_uids)}
+        nodes = self._get_nodes(seed_uids)
+        frontier = list(nodes.keys())
+
+        for _ in range(self.max_hops):
+            neighbor_scores: dict[str, float] = {}
+            for uid in frontier:
+                neighbors = set(nodes[uid].edges_to) | set(nodes[uid].edges_from)
+                share = scores[uid] * self.hop_decay / max(1, len(neighbors)) ** 0.5
+                for n in neighbors:
+                    neighbor_scores[n] = neighbor_scores.get(n, 0.0) + share
+
+            for n, score in neighbor_scores.items():
+                scores[n] = scores.get(n, 0.0) + score
+
+            new_uids = sorted([n for n in neighbor_scores if n not in nodes],
+                              key=lambda n: scores[n], reverse=True)[:max(0, self.max_nodes - len(nodes))]
+            if not new_uids:
+                break
+
+            new_nodes = self._get_nodes(new_uids)
+            nodes.update(new_nodes)
+            frontier = list(new_nodes.keys())
+
+        return {uid: scores[uid] for uid in nodes}, nodes
+
+    def _build_local_context(self, node_scores: dict[str, float],
+                             nodes: dict[str, data_model.NodeData],
+                             max_context_tokens: Optional[int] = None) -> tuple[str, str, str]:
+        """
+        Packs entity descriptions, relationship descriptions and member community reports into the token budget.
+
+        Entities get 40% and relationships 30% of the budget, community reports the rest. Budget left
+        unused by one table is passed on to the next.
+        """
+        max_context_tokens = max_context_tokens if max_context_tokens is not None else self.max_context_tokens
+        ranked_uids = sorted(nodes, key=lambda uid: node_scores[uid], reverse=True)
+
+        entity_lines = (f"{nodes[uid].node_title} ({nodes[uid].node_type}): {nodes[uid].node_description}"
+                        for uid in ranked_uids)
+        entity_data, used_tokens = self._pack_lines(entity_lines, int(max_context_tokens * 0.4))
+
+        # rank edges inside the neighborhood by the scores of both ends
+        ranked_edges = sorted([(uid, target) for uid in nodes for target in nodes[uid].edges_to if target in nodes],
+                              key=lambda e: node_scores[e[0]] + node_scores[e[1]], reverse=True)
+        relationship_budget = int(max_context_tokens * 0.7) - used_tokens
+        # a line is never shorter than its "source -> target: " head, only edges whose heads fit are read
+        candidate_edges, head_tokens = [], 0
+        for source, target in ranked_edges:
+            head_tokens += LLMSession.estimate_tokens(f"{source} -> {target}: ")
+            if head_tokens > relationship_budget:
+                break
+            candidate_edges.append((source, target))
+        edges = self._get_edges(candidate_edges) if candidate_edges else {}
+        relationship_lines = (f"{source} -> {target}: {edges[(source, target)].description}"
+                              for source, target in candidate_edges if (source, target) in edges)
+        relationship_data, relationship_tokens = self._pack_lines(relationship_lines, relationship_budget)
+        used_tokens += relationship_tokens
+
+        # member communities ranked by the summed scores of their members in the neighborhood
+        report_relevance = []
+        for report in self._get_comm_reports():
+            relevance = sum(node_scores.get(n, 0.0) for n in report.community_nodes)
+            if relevance > 0:
+                report_relevance.append((relevance, report))
+        report_relevance.sort(key=lambda r: r[0], reverse=True)
+        report_lines = (f"{report.title}: {report.summary}" for _, report in report_relevance)
+        report_data, _ = self._pack_lines(report_lines, max_context_tokens - used_tokens)
+
+        return entity_data, relationship_data, report_data
+
+    def _pack_lines(self, lines: Iterator[str], max_tokens: int) -> tuple[str, int]:
+        """Adds lines in the given order until the next one would exceed max_tokens."""
+        packed, used_tokens = [], 0
+        for line in lines:
+            if len(line) > self.max_line_chars:
+                line = line[:self.max_line_chars].rsplit(" ", 1)[0] + " ..."
+            line_tokens = LLMSession.estimate_tokens(line)
+            if used_tokens + line_tokens > max_tokens:
+                break
+            packed.append(line)
+            used_tokens += line_tokens
+        return "\n".join(packed), used_tokens
+
+
+class LocalQueryGCP(KGraphLocalQuery):
+    def __init__(self, secrets: dict, fskg: FirestoreKG, **kwargs) -> None:
+        super().__init__(**kwargs)
+
+        self.secrets = secrets
+
+        os.environ["LANGFUSE_SECRET_KEY"] = str(
+                self.secrets["LANGFUSE_SECRET_KEY"])
+        os.environ["LANGFUSE_PUBLIC_KEY"] = str(
+                self.secrets["LANGFUSE_PUBLIC_KEY"])
+        os.environ["LANGFUSE_HOST"] = "https://cloud.langfuse.com"
+
+        self.fskg = fskg
+
+        self.comm_snapshot = CommunityReportSnapshot.for_collection(
+            fskg=self.fskg,
+            database_id=str(self.secrets["FIRESTORE_DB_ID"]),
+            comm_coll_id=str(self.secrets["COMM_COLL_ID"]))
+
+    def _nearest_entities(self, query_embedding: list[float], top_k: int) -> list[str]:
+        """Firestore vector search over the node description embeddings (requires a vector index)."""
+        emb_coll = self.fskg.db.collection(node_embedding_collection_id(self.secrets))
+        vector_query = emb_coll.find_nearest(
+            vector_field="description_embedding",
+            query_vector=Vector(query_embedding),
+            distance_measure=DistanceMeasure.COSINE,
+            limit=top_k)
+        return [doc.id for doc in vector_query.stream()]
+
+    def _get_nodes(self, node_uids: list[str]) -> dict[str, data_model.NodeData]:
+        """Fetches all node documents in one batched read."""
+        if not node_uids:
+            return {}
+        nodes_coll = self.fskg.db.collection(str(self.secrets["NODE_COLL_ID"]))
+        nodes = {}
+        for doc in self.fskg.db.get_all([nodes_coll.document(uid) for uid in node_uids]):
+            if doc.exists:
+                nodes[doc.id] = data_model.NodeData(**doc.to_dict())
+            else:
+                print(f"Warning: Node '{doc.id}' not found in Firestore. Skipping.")
+        return nodes
+
+    def _get_edges(self, edge_pairs: list[tuple[str, str]]) -> dict[tuple[str, str], data_model.EdgeData]:
+        """Fetches all edge documents in one batched read (graph2nosql stores edges as '<source>_to_<target>')."""
+        edges_coll = self.fskg.db.collection(str(self.secrets["EDGES_COLL_ID"]))
+        doc_refs = [edges_coll.document(f"{source}_to_{target}") for source, target in edge_pairs]
+        edges = {}
+        for doc in self.fskg.db.get_all(doc_refs):
+            if doc.exists:
+                edge = data_model.EdgeData(**doc.to_dict())
+                edges[(edge.source_uid, edge.target_uid)] = edge
+        return edges
+
+    def _get_comm_reports(self) -> list[data_model.CommunityData]:
+        return self.comm_snapshot.reports()
+
 
 if __name__ == "__main__":
     secrets = dotenv_values(".env")
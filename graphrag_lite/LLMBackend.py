@@ -0,0 +1,846 @@
+# Copyright 2024 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import graphrag_lite.prompts as prompts
+from graphrag_lite.LLMCache import LLMResponseCache
+
+from dotenv import dotenv_values
+import vertexai
+from vertexai.generative_models import GenerativeModel, Part, GenerationConfig, SafetySetting, FunctionDeclaration, Tool, Content
+from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel
+from vertexai.preview import caching
+from vertexai.preview.generative_models import GenerativeModel as PreviewGenerativeModel
+from google.api_core.exceptions import ResourceExhausted, NotFound, FailedPrecondition
+
+from abc import ABC, abstractmethod
+import asyncio
+import datetime
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local token estimate (~4 characters per token for gemini models)."""
+    return max(1, len(text) // 4) if text else 0
+
+
+class UsageMetadata:
+    def __init__(self, prompt_token_count: int, candidates_token_count: int,
+                 cached_content_token_count: int = 0) -> None:
+        # like vertex, prompt tokens include the tokens served from a cached prefix
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.cached_content_token_count = cached_content_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class BackendResponse:
+    """
+    Response of a non vertex backend.
+
+    Mirrors the parts of a vertex GenerationResponse the pipeline reads (text and usage_metadata),
+    so sessions handle responses of every backend the same way.
+    """
+
+    def __init__(self, text: str, prompt_token_count: int, candidates_token_count: int,
+                 cached_content_token_count: int = 0) -> None:
+        self.text = text
+        self.usage_metadata = UsageMetadata(prompt_token_count, candidates_token_count, cached_content_token_count)
+
+
+class BackendEmbedding:
+    def __init__(self, values: List[float]) -> None:
+        self.values = values
+
+
+class LLMChat(ABC):
+    """Multi turn conversation on one backend model."""
+
+    @abstractmethod
+    def send_message(self, content: str, generation_config: Dict[str, Any]) -> Any:
+        pass
+
+    @abstractmethod
+    async def send_message_async(self, content: str, generation_config: Dict[str, Any]) -> Any:
+        pass
+
+    @abstractmethod
+    def append_turn(self, user_text: str, model_text: str) -> None:
+        """Appends a turn answered outside of the backend (e.g. from the response cache) to the history."""
+        pass
+
+
+class LLMBackend(ABC):
+    """
+    Model provider behind LLMSession.
+
+    Generation configs are passed as plain dicts (max_output_tokens, temperature, top_p,
+    response_mime_type, response_schema). Responses expose .text and .usage_metadata,
+    embeddings expose .values, like the vertex ai sdk types.
+    """
+
+    name = "base"
+
+    @abstractmethod
+    def generate(self, model_name: str, system_message: str, contents: List[str],
+                 generation_config: Dict[str, Any],
+                 function_schema: Optional[Dict[str, Any]] = None) -> Any:
+        pass
+
+    @abstractmethod
+    async def agenerate(self, model_name: str, system_message: str, contents: List[str],
+                        generation_config: Dict[str, Any]) -> Any:
+        pass
+
+    @abstractmethod
+    def generate_stream(self, model_name: str, system_message: str, contents: List[str],
+                        generation_config: Dict[str, Any]) -> Iterator[Any]:
+        """Yields response chunks, usage metadata is complete on the last chunk."""
+        pass
+
+    @abstractmethod
+    def start_chat(self, model_name: str, system_message: str) -> LLMChat:
+        pass
+
+    @abstractmethod
+    def embed(self, model_name: str, texts: List[str], task: str,
+              dimensionality: Optional[int]) -> List[Any]:
+        pass
+
+    @abstractmethod
+    async def aembed(self, model_name: str, texts: List[str], task: str,
+                     dimensionality: Optional[int]) -> List[Any]:
+        pass
+
+    def prefix_cache_stats(self) -> Dict[str, int]:
+        """Counters of the cached system prompt prefixes, empty for backends without prefix caching."""
+        return {}
+
+
+# ----- Vertex AI -----
+
+# cached content needs a minimum prefix size (32k tokens on gemini 1.5), smaller prompts are sent in full
+PREFIX_CACHE_MIN_TOKENS = int(os.environ.get("LLM_PREFIX_CACHE_MIN_TOKENS", 32768))
+PREFIX_CACHE_TTL_SECONDS = int(os.environ.get("LLM_PREFIX_CACHE_TTL", 3600))
+# errors of requests referencing an expired or deleted cached content
+CACHED_CONTENT_ERRORS = (NotFound, FailedPrecondition)
+
+SAFETY_SETTINGS = [
+    SafetySetting(
+        category=SafetySetting.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
+        threshold=SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH
+    ),
+    SafetySetting(
+        category=SafetySetting.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
+        threshold=SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH
+    ),
+    SafetySetting(
+        category=SafetySetting.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
+        threshold=SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH
+    ),
+    SafetySetting(
+        category=SafetySetting.HarmCategory.HARM_CATEGORY_HARASSMENT,
+        threshold=SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH
+    )
+]
+
+_pool_lock = threading.Lock()
+_secrets: Optional[Dict[str, Any]] = None
+_model_pool: Dict[tuple[str, str], GenerativeModel] = {}
+_embedding_model_pool: Dict[str, TextEmbeddingModel] = {}
+
+
+def _init_vertex() -> Dict[str, Any]:
+    """Reads .env and initializes the vertex ai sdk once per process."""
+    global _secrets
+    with _pool_lock:
+        if _secrets is None:
+            secrets = dotenv_values(".env")
+            vertexai.init(project=secrets["GCP_PROJECT_ID"], location=secrets["GCP_REGION"])
+            _secrets = secrets
+    return _secrets
+
+
+def _pooled_model(model_name: str, system_message: str) -> GenerativeModel:
+    """
+    Returns the process wide GenerativeModel for (model name, system message).
+
+    Sharing the model instance shares its prediction client and with it the transport connections.
+    """
+    key = (model_name, system_message)
+    with _pool_lock:
+        if key not in _model_pool:
+            _model_pool[key] = GenerativeModel(model_name, system_instruction=[system_message])
+        return _model_pool[key]
+
+
+def _pooled_embedding_model(model_name: str) -> TextEmbeddingModel:
+    with _pool_lock:
+        if model_name not in _embedding_model_pool:
+            _embedding_model_pool[model_name] = TextEmbeddingModel.from_pretrained(model_name)
+        return _embedding_model_pool[model_name]
+
+
+class VertexChat(LLMChat):
+    def __init__(self, chat_session, safety_settings) -> None:
+        self.chat_session = chat_session
+        self.safety_settings = safety_settings
+
+    def send_message(self, content: str, generation_config: Dict[str, Any]) -> Any:
+        return self.chat_session.send_message(content,
+                                              stream=False,
+                                              safety_settings=self.safety_settings,
+                                              generation_config=GenerationConfig(**generation_config))
+
+    async def send_message_async(self, content: str, generation_config: Dict[str, Any]) -> Any:
+        return await self.chat_session.send_message_async(content,
+                                                          stream=False,
+                                                          safety_settings=self.safety_settings,
+                                                          generation_config=GenerationConfig(**generation_config))
+
+    def append_turn(self, user_text: str, model_text: str) -> None:
+        self.chat_session.history.append(Content(role="user", parts=[Part.from_text(user_text)]))
+        self.chat_session.history.append(Content(role="model", parts=[Part.from_text(model_text)]))
+
+
+class VertexBackend(LLMBackend):
+    """
+    Vertex AI gemini and text embedding models. The sdk and model clients are shared process wide.
+
+    With prefix_caching, the system prompt of every (model, system prompt) pair of at least
+    min_prefix_tokens is stored once as vertex cached content and referenced by all later calls
+    instead of being re-sent. Whenever a cached content can not be created or has expired, calls
+    transparently fall back to sending the full system prompt. Function calls always send the full
+    system prompt, vertex does not accept tools next to cached content.
+    """
+
+    name = "vertex"
+
+    def __init__(self, prefix_caching: bool = True,
+                 min_prefix_tokens: int = PREFIX_CACHE_MIN_TOKENS,
+                 prefix_ttl_seconds: int = PREFIX_CACHE_TTL_SECONDS) -> None:
+        self.secrets = _init_vertex()
+        self.safety_settings = SAFETY_SETTINGS
+
+        self.prefix_caching = prefix_caching
+        self.min_prefix_tokens = min_prefix_tokens
+        self.prefix_ttl_seconds = prefix_ttl_seconds
+        # (model, system prompt) -> (model bound to the cached content or None if unavailable, expiry time)
+        self._prefix_models: Dict[tuple[str, str], tuple[Optional[GenerativeModel], float]] = {}
+        # guards _prefix_models, _prefix_key_locks and the stats, never held while calling vertex
+        self._prefix_lock = threading.Lock()
+        # one lock per (model, system prompt), so a slow cached content creation only blocks its own prefix
+        self._prefix_key_locks: Dict[tuple[str, str], threading.Lock] = {}
+        self._prefix_stats = {"handles": 0, "fallbacks": 0, "expired": 0}
+
+    def prefix_cache_stats(self) -> Dict[str, int]:
+        return dict(self._prefix_stats)
+
+    def _prefix_model(self, model_name: str, system_message: str) -> Optional[GenerativeModel]:
+        """Returns the model bound to the cached system prompt, creating the cached content once, None if unavailable."""
+        if not self.prefix_caching or estimate_tokens(system_message) < self.min_prefix_tokens:
+            return None
+
+        key = (model_name, system_message)
+        with self._prefix_lock:
+            model, expires_at = self._prefix_models.get(key, (None, 0.0))
+            # renew a minute ahead of expiry so no request races the ttl
+            if time.time() < expires_at - 60:
+                return model
+            key_lock = self._prefix_key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            # another caller may have created the cached content while this one waited
+            with self._prefix_lock:
+                model, expires_at = self._prefix_models.get(key, (None, 0.0))
+            if time.time() < expires_at - 60:
+                return model
+
+            try:
+                cached_content = caching.CachedContent.create(
+                    model_name=model_name,
+                    system_instruction=system_message,
+                    ttl=datetime.timedelta(seconds=self.prefix_ttl_seconds))
+                model = PreviewGenerativeModel.from_cached_content(cached_content=cached_content)
+                expires_at = time.time() + self.prefix_ttl_seconds
+                stat = "handles"
+            except Exception as e:
+                # do not retry before the ttl is over
+                print(f"Warning: Prefix caching unavailable for {model_name}, sending full system prompts: {e}")
+                model, expires_at = None, time.time() + self.prefix_ttl_seconds
+                stat = "fallbacks"
+            with self._prefix_lock:
+                self._prefix_models[key] = (model, expires_at)
+                self._prefix_stats[stat] += 1
+            return model
+
+    def _drop_prefix(self, model_name: str, system_message: str) -> None:
+        with self._prefix_lock:
+            self._prefix_models.pop((model_name, system_message), None)
+            self._prefix_stats["expired"] += 1
+
+    def _model(self, model_name: str, system_message: str) -> GenerativeModel:
+        prefix_model = self._prefix_model(model_name, system_message)
+        return prefix_model if prefix_model is not None else _pooled_model(model_name, system_message)
+
+    def _call_with_prefix(self, model_name: str, system_message: str, call: Callable[[GenerativeModel], Any]) -> Any:
+        prefix_model = self._prefix_model(model_name, system_message)
+        if prefix_model is None:
+            return call(_pooled_model(model_name, system_message))
+        try:
+            return call(prefix_model)
+        except CACHED_CONTENT_ERRORS:
+            self._drop_prefix(model_name, system_message)
+            return call(_pooled_model(model_name, system_message))
+
+    async def _acall_with_prefix(self, model_name: str, system_message: str, call: Callable[[GenerativeModel], Any]) -> Any:
+        prefix_model = self._prefix_model(model_name, system_message)
+        if prefix_model is None:
+            return await call(_pooled_model(model_name, system_message))
+        try:
+            return await call(prefix_model)
+        except CACHED_CONTENT_ERRORS:
+            self._drop_prefix(model_name, system_message)
+            return await call(_pooled_model(model_name, system_message))
+
+    def generate(self, model_name: str, system_message: str, contents: List[str],
+                 generation_config: Dict[str, Any],
+                 function_schema: Optional[Dict[str, Any]] = None) -> Any:
+        if function_schema is not None:
+            function_decl = FunctionDeclaration(
+                name="extract_json_schema",
+                description="Record user question response and the estimated relevance score using well-structured JSON.",
+                parameters=function_schema
+            )
+            # requests with cached content reject tools (InvalidArgument), so they bypass the prefix model
+            return _pooled_model(model_name, system_message).generate_content(
+                contents,
+                generation_config=GenerationConfig(**generation_config),
+                tools=[Tool(function_declarations=[function_decl])],
+                safety_settings=self.safety_settings,
+                stream=False
+            )
+
+        return self._call_with_prefix(model_name, system_message, lambda model: model.generate_content(
+            contents,
+            generation_config=GenerationConfig(**generation_config),
+            safety_settings=self.safety_settings,
+            stream=False
+        ))
+
+    async def agenerate(self, model_name: str, system_message: str, contents: List[str],
+                        generation_config: Dict[str, Any]) -> Any:
+        return await self._acall_with_prefix(model_name, system_message, lambda model: model.generate_content_async(
+            contents,
+            generation_config=GenerationConfig(**generation_config),
+            safety_settings=self.safety_settings,
+            stream=False
+        ))
+
+    def generate_stream(self, model_name: str, system_message: str, contents: List[str],
+                        generation_config: Dict[str, Any]) -> Iterator[Any]:
+        return self._model(model_name, system_message).generate_content(
+            contents,
+            generation_config=GenerationConfig(**generation_config),
+            safety_settings=self.safety_settings,
+            stream=True
+        )
+
+    def start_chat(self, model_name: str, system_message: str) -> LLMChat:
+        return VertexChat(self._model(model_name, system_message).start_chat(), self.safety_settings)
+
+    def embed(self, model_name: str, texts: List[str], task: str,
+              dimensionality: Optional[int]) -> List[Any]:
+        inputs = [TextEmbeddingInput(text, task) for text in texts]
+        return _pooled_embedding_model(model_name).get_embeddings(texts=inputs, output_dimensionality=dimensionality)
+
+    async def aembed(self, model_name: str, texts: List[str], task: str,
+                     dimensionality: Optional[int]) -> List[Any]:
+        inputs = [TextEmbeddingInput(text, task) for text in texts]
+        return await _pooled_embedding_model(model_name).get_embeddings_async(
+            texts=inputs, output_dimensionality=dimensionality)
+
+
+# ----- Offline fake -----
+
+def heavy_tailed_latency(median: float = 0.5, sigma: float = 1.0) -> Callable[[random.Random], float]:
+    """Lognormal latency distribution for FakeBackend: most calls near median, a long tail of slow ones."""
+    return lambda rng: rng.lognormvariate(math.log(median), sigma)
+
+
+class FakeChat(LLMChat):
+    def __init__(self, backend: "FakeBackend", model_name: str, system_message: str) -> None:
+        self.backend = backend
+        self.model_name = model_name
+        self.system_message = system_message
+        self.history: List[List[str]] = []
+
+    def send_message(self, content: str, generation_config: Dict[str, Any]) -> Any:
+        self.backend._simulate_call()
+        response = self.backend._respond(self.system_message, content, generation_config, self.history,
+                                         model_name=self.model_name)
+        self.append_turn(content, response.text)
+        return response
+
+    async def send_message_async(self, content: str, generation_config: Dict[str, Any]) -> Any:
+        await self.backend._asimulate_call()
+        response = self.backend._respond(self.system_message, content, generation_config, self.history,
+                                         model_name=self.model_name)
+        self.append_turn(content, response.text)
+        return response
+
+    def append_turn(self, user_text: str, model_text: str) -> None:
+        self.history.append(["user", user_text])
+        self.history.append(["model", model_text])
+
+
+class FakeBackend(LLMBackend):
+    """
+    Deterministic offline backend for benchmarks and CI.
+
+    Responses are synthesized from the prompt: graph extraction conversations get well-formed entity and
+    relationship tuples (and a NO on the gleaning check), community reports get report JSON, calls with a
+    response schema get JSON matching the schema and embeddings are stable unit vectors per text.
+    The same inputs always produce the same outputs.
+
+    latency is either fixed seconds per call or a callable drawing seconds from the backend's seeded
+    random generator. throttle_rate is the probability of a call failing with a quota error (http 429).
+    With prefix_caching, calls behave like vertex cached content: the first call per (model, system
+    prompt) of at least min_prefix_tokens (the vertex minimum by default) creates the cached prefix,
+    later calls report its tokens as cached content tokens.
+    Function calls never use the cached prefix, like on vertex.
+    """
+
+    name = "fake"
+
+    def __init__(self,
+                 latency: Union[float, Callable[[random.Random], float]] = 0.0,
+                 throttle_rate: float = 0.0,
+                 max_entities: int = 8,
+                 seed: int = 0,
+                 prefix_caching: bool = False,
+                 min_prefix_tokens: int = PREFIX_CACHE_MIN_TOKENS) -> None:
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.max_entities = max_entities
+        self.prefix_caching = prefix_caching
+        self.min_prefix_tokens = min_prefix_tokens
+        self._prefixes: set[tuple[str, str]] = set()
+        self._prefix_stats = {"handles": 0, "fallbacks": 0, "expired": 0, "cached_tokens": 0}
+
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.call_count = 0
+        self.throttled_count = 0
+
+    def _draw_latency(self) -> float:
+        with self._rng_lock:
+            self.call_count += 1
+            throttled = self.throttle_rate > 0 and self._rng.random() < self.throttle_rate
+            if throttled:
+                self.throttled_count += 1
+            latency = self.latency(self._rng) if callable(self.latency) else self.latency
+        if throttled:
+            raise ResourceExhausted("Fake backend quota exceeded.")
+        return max(0.0, latency)
+
+    def _simulate_call(self) -> None:
+        latency = self._draw_latency()
+        if latency > 0:
+            time.sleep(latency)
+
+    async def _asimulate_call(self) -> None:
+        latency = self._draw_latency()
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    def generate(self, model_name: str, system_message: str, contents: List[str],
+                 generation_config: Dict[str, Any],
+                 function_schema: Optional[Dict[str, Any]] = None) -> Any:
+        self._simulate_call()
+        if function_schema is not None:
+            generation_config = dict(generation_config, response_schema=function_schema)
+        return self._respond(system_message, "\n".join(contents), generation_config, model_name=model_name,
+                             use_prefix=function_schema is None)
+
+    async def agenerate(self, model_name: str, system_message: str, contents: List[str],
+                        generation_config: Dict[str, Any]) -> Any:
+        await self._asimulate_call()
+        return self._respond(system_message, "\n".join(contents), generation_config, model_name=model_name)
+
+    def generate_stream(self, model_name: str, system_message: str, contents: List[str],
+                        generation_config: Dict[str, Any]) -> Iterator[Any]:
+        self._simulate_call()
+        response = self._respond(system_message, "\n".join(contents), generation_config, model_name=model_name)
+        words = response.text.split(" ")
+        for i in range(0, len(words), 8):
+            yield BackendResponse(" ".join(words[i:i + 8]) + (" " if i + 8 < len(words) else ""), 0, 0)
+        yield BackendResponse("", response.usage_metadata.prompt_token_count,
+                              response.usage_metadata.candidates_token_count,
+                              response.usage_metadata.cached_content_token_count)
+
+    def start_chat(self, model_name: str, system_message: str) -> LLMChat:
+        return FakeChat(self, model_name, system_message)
+
+    def prefix_cache_stats(self) -> Dict[str, int]:
+        with self._rng_lock:
+            return dict(self._prefix_stats)
+
+    def _cached_prefix_tokens(self, model_name: str, system_message: str) -> int:
+        """Tokens of the system prompt served from the (simulated) cached prefix, 0 on the creating call."""
+        system_tokens = estimate_tokens(system_message)
+        if not self.prefix_caching or system_tokens < self.min_prefix_tokens:
+            return 0
+        key = (model_name, system_message)
+        with self._rng_lock:
+            if key not in self._prefixes:
+                self._prefixes.add(key)
+                self._prefix_stats["handles"] += 1
+                return 0
+            self._prefix_stats["cached_tokens"] += system_tokens
+        return system_tokens
+
+    def embed(self, model_name: str, texts: List[str], task: str,
+              dimensionality: Optional[int]) -> List[Any]:
+        self._simulate_call()
+        return [BackendEmbedding(self._embedding(text, dimensionality or 768)) for text in texts]
+
+    async def aembed(self, model_name: str, texts: List[str], task: str,
+                     dimensionality: Optional[int]) -> List[Any]:
+        await self._asimulate_call()
+        return [BackendEmbedding(self._embedding(text, dimensionality or 768)) for text in texts]
+
+    def _embedding(self, text: str, dimensionality: int) -> List[float]:
+        rng = random.Random(hashlib.sha256(text.encode("utf-8")).hexdigest())
+        values = [rng.gauss(0, 1) for _ in range(dimensionality)]
+        norm = math.sqrt(sum(v * v for v in values)) or 1.0
+        return [v / norm for v in values]
+
+    def _respond(self, system_message: str, prompt: str, generation_config: Dict[str, Any],
+                 history: Optional[List[List[str]]] = None, model_name: str = "",
+                 use_prefix: bool = True) -> BackendResponse:
+        history = history or []
+        if generation_config.get("response_schema"):
+            text = json.dumps(self._from_schema(generation_config["response_schema"], prompt))
+        elif system_message == prompts.COMMUNITY_REPORT_SYSTEM:
+            text = json.dumps(self._community_report(prompt))
+        elif '("entity"' in system_message:
+            text = self._extraction(system_message, prompt, history)
+        else:
+            text = self._text(prompt)
+
+        prompt_tokens = estimate_tokens(system_message) + estimate_tokens(prompt) + \
+            sum(estimate_tokens(t) for _, t in history)
+        return BackendResponse(text, prompt_tokens, estimate_tokens(text),
+                               self._cached_prefix_tokens(model_name, system_message) if use_prefix else 0)
+
+    def _words(self, prompt: str, n: int) -> str:
+        """Deterministic filler text of n words drawn from the prompt."""
+        words = re.findall(r"[A-Za-z]{3,}", prompt) or ["lorem", "ipsum", "dolor"]
+        rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).hexdigest())
+        return " ".join(rng.choice(words) for _ in range(n))
+
+    def _text(self, prompt: str) -> str:
+        return self._words(prompt, 60)
+
+    def _extraction(self, system_message: str, prompt: str, history: List[List[str]]) -> str:
+        tuple_delimiter = re.search(r'\("entity"(.+?)<entity_name>', system_message).group(1)
+        record_delimiter_match = re.search(r"Use \*\*(.+?)\*\* as the list delimiter", system_message)
+        completion_match = re.search(r"When finished, output (\S+)", system_message)
+        record_delimiter = record_delimiter_match.group(1) if record_delimiter_match else "##"
+        completion_delimiter = completion_match.group(1) if completion_match else "<|COMPLETE|>"
+
+        if prompt == prompts.LOOP_PROMPT:
+            return "NO"
+        if prompt == prompts.CONTINUE_PROMPT or history:
+            # everything was found in the first round
+            return completion_delimiter
+
+        types_match = re.search(r"Entity_types: (.+)", prompt)
+        entity_types = [t.strip() for t in types_match.group(1).split(",")] if types_match else ["organization"]
+        text_match = re.search(r"Text: (.*?)\n#+\nOutput:", prompt, re.DOTALL)
+        text = text_match.group(1) if text_match else prompt
+
+        names = []
+        for name in re.findall(r"\b[A-Z][a-z]+(?: [A-Z][a-z]+)*\b", text):
+            if name not in names:
+                names.append(name)
+            if len(names) >= self.max_entities:
+                break
+
+        records = []
+        for i, name in enumerate(names):
+            records.append(f'("entity"{tuple_delimiter}"{name}"{tuple_delimiter}"{entity_types[i % len(entity_types)]}"'
+                           f'{tuple_delimiter}"{name} is mentioned in the text: {self._words(text + name, 12)}.")')
+        for source, target in zip(names, names[1:]):
+            records.append(f'("relationship"{tuple_delimiter}"{source}"{tuple_delimiter}"{target}"'
+                           f'{tuple_delimiter}"{source} and {target} appear together in the text."{tuple_delimiter}5)')
+        return record_delimiter.join(records) + completion_delimiter
+
+    def _community_report(self, prompt: str) -> Dict[str, Any]:
+        entities = re.findall(r"'entity_id': '([^']+)'", prompt) or ["Community"]
+        return {
+            "title": " and ".join(entities[:3]),
+            "summary": self._words(prompt, 40),
+            "rating": float(int(hashlib.sha256(prompt.encode("utf-8")).hexdigest(), 16) % 100) / 10,
+            "rating_explanation": self._words(prompt + "rating", 15),
+            "findings": [{"summary": f"Finding on {e}", "explanation": self._words(prompt + e, 30)}
+                         for e in entities[:5]]
+        }
+
+    def _from_schema(self, schema: Dict[str, Any], prompt: str, key: str = "", title: Optional[str] = None) -> Any:
+        """Builds a value matching a (vertex / openapi subset) json schema."""
+        schema_type = str(schema.get("type", "string")).lower()
+        if schema_type == "object":
+            return {k: self._from_schema(v, prompt, key=k, title=title)
+                    for k, v in schema.get("properties", {}).items()}
+        if schema_type == "array":
+            # map batches answer one element per community report in the prompt
+            titles = re.findall(r"-{5} Community Report: (.+?) -{5}", prompt) or [None, None]
+            return [self._from_schema(schema.get("items", {}), prompt, key=key, title=t) for t in titles]
+        if schema_type in ("integer", "int"):
+            return int(hashlib.sha256((prompt + key).encode("utf-8")).hexdigest(), 16) % 10
+        if schema_type == "number":
+            return float(int(hashlib.sha256((prompt + key).encode("utf-8")).hexdigest(), 16) % 100) / 10
+        if schema_type == "boolean":
+            return True
+        if title is not None and key in ("community", "title"):
+            return title
+        return self._words(prompt + key + (title or ""), 25)
+
+
+# ----- Record / replay -----
+
+class ReplayMissError(KeyError):
+    """Raised in replay mode for a call that was never recorded."""
+
+
+class RecordReplayChat(LLMChat):
+    def __init__(self, backend: "RecordReplayBackend", model_name: str, system_message: str) -> None:
+        self.backend = backend
+        self.model_name = model_name
+        self.system_message = system_message
+        self.transcript: List[List[str]] = []
+        self.inner_chat = backend.inner.start_chat(model_name, system_message) if backend.inner else None
+
+    def _key(self, content: str, generation_config: Dict[str, Any]) -> str:
+        return self.backend._key("chat", self.model_name, self.system_message,
+                                 self.transcript + [["user", content]], generation_config)
+
+    def send_message(self, content: str, generation_config: Dict[str, Any]) -> Any:
+        key = self._key(content, generation_config)
+        response = self.backend._lookup_or_record(
+            key, lambda: self.inner_chat.send_message(content, generation_config))
+        self.transcript.extend([["user", content], ["model", response.text]])
+        return response
+
+    async def send_message_async(self, content: str, generation_config: Dict[str, Any]) -> Any:
+        key = self._key(content, generation_config)
+        response = await self.backend._alookup_or_record(
+            key, lambda: self.inner_chat.send_message_async(content, generation_config))
+        self.transcript.extend([["user", content], ["model", response.text]])
+        return response
+
+    def append_turn(self, user_text: str, model_text: str) -> None:
+        if self.inner_chat is not None:
+            self.inner_chat.append_turn(user_text, model_text)
+        self.transcript.extend([["user", user_text], ["model", model_text]])
+
+
+class RecordReplayBackend(LLMBackend):
+    """
+    Records the responses of another backend to a jsonl file, or replays them without any backend.
+
+    In "record" mode every call goes to inner and its response text, usage and embeddings are appended
+    to the file. In "replay" mode calls are answered from the file only and unknown calls raise
+    ReplayMissError. Calls are keyed like the response cache (model, system message, contents, config).
+    """
+
+    name = "replay"
+
+    def __init__(self, path: str, mode: str = "replay", inner: Optional[LLMBackend] = None) -> None:
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown record/replay mode {mode}.")
+        if mode == "record" and inner is None:
+            raise ValueError("Record mode needs an inner backend.")
+        self.path = path
+        self.mode = mode
+        self.inner = inner if mode == "record" else None
+
+        self._lock = threading.Lock()
+        self._records: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._records[record["key"]] = record
+        print(f"{mode.capitalize()} backend on {path} with {len(self._records)} recorded calls.")
+
+    def _key(self, kind: str, model_name: str, system_message: str, contents: Any,
+             generation_config: Dict[str, Any]) -> str:
+        return LLMResponseCache.make_key(model_name=f"{kind}:{model_name}",
+                                         system_message=system_message,
+                                         contents=contents,
+                                         generation_config={k: v for k, v in generation_config.items()
+                                                            if k != "response_schema"},
+                                         response_schema=generation_config.get("response_schema"))
+
+    def _replay(self, key: str) -> Optional[Dict[str, Any]]:
+        record = self._records.get(key)
+        if record is None and self.mode == "replay":
+            raise ReplayMissError(f"No recorded response for call {key}.")
+        return record
+
+    def _store(self, key: str, record: Dict[str, Any]) -> None:
+        record = dict(record, key=key)
+        with self._lock:
+            self._records[key] = record
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def _response_record(self, response) -> Dict[str, Any]:
+        try:
+            text = response.text
+        except (ValueError, AttributeError):
+            # function call responses carry no text part
+            args = response.candidates[0].function_calls[0].args
+            text = json.dumps({k: args[k] for k in args}, default=str)
+        return {"text": text,
+                "prompt_tokens": int(response.usage_metadata.prompt_token_count),
+                "output_tokens": int(response.usage_metadata.candidates_token_count),
+                "cached_tokens": int(getattr(response.usage_metadata, "cached_content_token_count", 0) or 0)}
+
+    def _to_response(self, record: Dict[str, Any]) -> BackendResponse:
+        return BackendResponse(record["text"], record["prompt_tokens"], record["output_tokens"],
+                               record.get("cached_tokens", 0))
+
+    def _lookup_or_record(self, key: str, call: Callable[[], Any]) -> BackendResponse:
+        record = self._replay(key)
+        if record is None:
+            record = self._response_record(call())
+            self._store(key, record)
+        return self._to_response(record)
+
+    async def _alookup_or_record(self, key: str, call: Callable[[], Any]) -> BackendResponse:
+        record = self._replay(key)
+        if record is None:
+            record = self._response_record(await call())
+            self._store(key, record)
+        return self._to_response(record)
+
+    def generate(self, model_name: str, system_message: str, contents: List[str],
+                 generation_config: Dict[str, Any],
+                 function_schema: Optional[Dict[str, Any]] = None) -> Any:
+        key = self._key("generate", model_name, system_message, [contents, function_schema], generation_config)
+        return self._lookup_or_record(
+            key, lambda: self.inner.generate(model_name, system_message, contents, generation_config,
+                                             function_schema=function_schema))
+
+    async def agenerate(self, model_name: str, system_message: str, contents: List[str],
+                        generation_config: Dict[str, Any]) -> Any:
+        key = self._key("generate", model_name, system_message, [contents, None], generation_config)
+        return await self._alookup_or_record(
+            key, lambda: self.inner.agenerate(model_name, system_message, contents, generation_config))
+
+    def generate_stream(self, model_name: str, system_message: str, contents: List[str],
+                        generation_config: Dict[str, Any]) -> Iterator[Any]:
+        key = self._key("generate", model_name, system_message, [contents, None], generation_config)
+        record = self._replay(key)
+        if record is None:
+            text, last_chunk = "", None
+            for chunk in self.inner.generate_stream(model_name, system_message, contents, generation_config):
+                last_chunk = chunk
+                try:
+                    chunk_text = chunk.text
+                except (ValueError, IndexError, AttributeError):
+                    chunk_text = ""
+                text += chunk_text
+                yield chunk
+            if last_chunk is not None:
+                self._store(key, {"text": text,
+                                  "prompt_tokens": int(last_chunk.usage_metadata.prompt_token_count),
+                                  "output_tokens": int(last_chunk.usage_metadata.candidates_token_count)})
+            return
+        yield self._to_response(record)
+
+    def start_chat(self, model_name: str, system_message: str) -> LLMChat:
+        return RecordReplayChat(self, model_name, system_message)
+
+    def _embed_key(self, model_name: str, texts: List[str], task: str, dimensionality: Optional[int]) -> str:
+        return self._key("embed", model_name, "", texts, {"task": task, "dimensionality": dimensionality})
+
+    def embed(self, model_name: str, texts: List[str], task: str,
+              dimensionality: Optional[int]) -> List[Any]:
+        key = self._embed_key(model_name, texts, task, dimensionality)
+        record = self._replay(key)
+        if record is None:
+            embeddings = self.inner.embed(model_name, texts, task, dimensionality)
+            record = {"embeddings": [list(e.values) for e in embeddings]}
+            self._store(key, record)
+        return [BackendEmbedding(values) for values in record["embeddings"]]
+
+    async def aembed(self, model_name: str, texts: List[str], task: str,
+                     dimensionality: Optional[int]) -> List[Any]:
+        key = self._embed_key(model_name, texts, task, dimensionality)
+        record = self._replay(key)
+        if record is None:
+            embeddings = await self.inner.aembed(model_name, texts, task, dimensionality)
+            record = {"embeddings": [list(e.values) for e in embeddings]}
+            self._store(key, record)
+        return [BackendEmbedding(values) for values in record["embeddings"]]
+
+
+_default_backend: Optional[LLMBackend] = None
+_default_backend_lock = threading.Lock()
+
+
+def default_llm_backend() -> LLMBackend:
+    """
+    Process wide backend selected by LLM_BACKEND: "vertex" (default), "fake", "record" or "replay".
+
+    record and replay use the jsonl file in LLM_REPLAY_FILE (default llm_replay.jsonl), record wraps vertex.
+    FAKE_LLM_LATENCY sets the fixed latency (seconds) of the fake backend, with FAKE_LLM_LATENCY_SIGMA > 0
+    it is the median of a heavy tailed (lognormal) latency distribution instead.
+    LLM_PREFIX_CACHE=false disables caching of system prompt prefixes (vertex and fake).
+    """
+    global _default_backend
+    with _default_backend_lock:
+        if _default_backend is None:
+            backend_name = os.environ.get("LLM_BACKEND", "vertex").lower()
+            replay_file = os.environ.get("LLM_REPLAY_FILE", "llm_replay.jsonl")
+            prefix_caching = os.environ.get("LLM_PREFIX_CACHE", "true").lower() == "true"
+            if backend_name == "vertex":
+                _default_backend = VertexBackend(prefix_caching=prefix_caching)
+            elif backend_name == "fake":
+                latency: Union[float, Callable[[random.Random], float]] = float(os.environ.get("FAKE_LLM_LATENCY", 0.0))
+                latency_sigma = float(os.environ.get("FAKE_LLM_LATENCY_SIGMA", 0.0))
+                if latency > 0 and latency_sigma > 0:
+                    latency = heavy_tailed_latency(median=latency, sigma=latency_sigma)
+                _default_backend = FakeBackend(latency=latency, prefix_caching=prefix_caching)
+            elif backend_name == "record":
+                _default_backend = RecordReplayBackend(replay_file, mode="record",
+                                                       inner=VertexBackend(prefix_caching=prefix_caching))
+            elif backend_name == "replay":
+                _default_backend = RecordReplayBackend(replay_file, mode="replay")
+            else:
+                raise ValueError(f"Unknown LLM_BACKEND {backend_name}.")
+        return _default_backend
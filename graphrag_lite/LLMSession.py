@@ -14,51 +14,212 @@
 
 import graphrag_lite.prompts as prompts
 
-from optparse import Option
-from dotenv import dotenv_values
-import base64
-from google.cloud import aiplatform
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part, FinishReason, GenerationConfig, SafetySetting
-import vertexai.preview.generative_models as generative_models
-from vertexai.language_models import TextEmbeddingInput, TextEmbeddingModel
 import json
+import datetime
+import threading
+import asyncio
+import weakref
+import os
 
 
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Iterator, Callable, Awaitable
 
-from langfuse.decorators import observe, langfuse_context
+from graphrag_lite.Observability import observe, obs_context
 from langfuse.model import ModelUsage
 
+from graphrag_lite.async_utils.rate_limiter import default_rate_limiter
+from graphrag_lite.async_utils.hedging import HedgePolicy, default_hedge_policy
+from graphrag_lite.LLMCache import LLMResponseCache, default_response_cache
+from graphrag_lite.LLMBackend import LLMBackend, default_llm_backend, estimate_tokens
+from graphrag_lite.TokenBudget import budgeted_model, check_budgets, record_usage, model_price, token_cost
+
+
+_pool_lock = threading.Lock()
+_session_pool: Dict[tuple[str, str, str], "LLMSession"] = {}
+
+
+# shared cap on in-flight async model calls per event loop
+MAX_ASYNC_CONCURRENCY = int(os.environ.get("LLM_MAX_ASYNC_CONCURRENCY", 32))
+_async_limiters: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+
+def _async_limiter() -> asyncio.Semaphore:
+    """Returns the concurrency limiter of the running event loop (semaphores can not be shared across loops)."""
+    loop = asyncio.get_running_loop()
+    limiter = _async_limiters.get(loop)
+    if limiter is None:
+        limiter = asyncio.Semaphore(MAX_ASYNC_CONCURRENCY)
+        _async_limiters[loop] = limiter
+    return limiter
+
 
 class LLMSession:
-    def __init__(self, system_message: str, model_name: str):
+    """
+    Session on one model with a fixed system message.
+
+    Model calls go to an LLMBackend, by default the process wide backend selected by LLM_BACKEND
+    (vertex ai, an offline fake or record/replay, see LLMBackend.py).
+    Constructing a session is cheap: the sdk initialization and the model clients are shared process wide.
+    Each constructed session owns its own chat state, which is only started on the first generate_chat call.
+    Stateless callers (generate, generate_stream, embeddings) should use LLMSession.get to share one session.
+
+    All model calls are scheduled by the process wide rate limiter. priority is either "interactive"
+    (user facing query traffic, always served first) or "batch" (ingestion).
+
+    Every call is accounted to a pipeline stage (see TokenBudget.STAGES) and checked against the active
+    token budgets before it is sent. Under a budget that runs low calls go to the downgraded model.
+
+    With a hedge policy (by default enabled through LLM_HEDGE_PERCENTILE) slow generate and agenerate
+    calls get a duplicate request, the first response wins. Chat calls are never hedged.
+    """
+
+    def __init__(self, system_message: str, model_name: str, priority: str = "batch",
+                 cache: Optional[LLMResponseCache] = None,
+                 backend: Optional[LLMBackend] = None,
+                 hedge_policy: Optional[HedgePolicy] = None):
         self.model_name = model_name
         self.system_message = system_message
-        self.secrets = dotenv_values(".env")
-        vertexai.init(project=self.secrets["GCP_PROJECT_ID"], location=self.secrets["GCP_REGION"])
-        self.model = GenerativeModel(
-            self.model_name, system_instruction=[system_message])
-        self.model_chat = self.model.start_chat()
-
-        self.safety_settings = [
-            SafetySetting(
-                category=SafetySetting.HarmCategory.HARM_CATEGORY_HATE_SPEECH,
-                threshold=SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH
-            ),
-            SafetySetting(
-                category=SafetySetting.HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT,
-                threshold=SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH
-            ),
-            SafetySetting(
-                category=SafetySetting.HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT,
-                threshold=SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH
-            ),
-            SafetySetting(
-                category=SafetySetting.HarmCategory.HARM_CATEGORY_HARASSMENT,
-                threshold=SafetySetting.HarmBlockThreshold.BLOCK_ONLY_HIGH
+        self.priority = priority
+        self.backend = backend if backend is not None else default_llm_backend()
+        self._model_chat = None
+        self._chat_model_name = model_name
+        self._chat_history_tokens = 0
+        self._chat_transcript: List[List[str]] = []
+
+        self.rate_limiter = default_rate_limiter()
+        # opt-in response cache, by default enabled through LLM_CACHE_DIR
+        self.cache = cache if cache is not None else default_response_cache()
+        self.hedge_policy = hedge_policy if hedge_policy is not None else default_hedge_policy()
+
+    @classmethod
+    def get(cls, system_message: str, model_name: str, priority: str = "batch") -> "LLMSession":
+        """Returns the shared session for (model name, system message, priority). Do not use its chat, it is shared across callers."""
+        key = (model_name, system_message, priority)
+        session = _session_pool.get(key)
+        if session is None:
+            session = cls(system_message=system_message, model_name=model_name, priority=priority)
+            with _pool_lock:
+                session = _session_pool.setdefault(key, session)
+        return session
+
+    @property
+    def model_chat(self):
+        if self._model_chat is None:
+            # a chat stays on the model it was started on
+            self._chat_model_name = budgeted_model(self.model_name)
+            self._model_chat = self.backend.start_chat(self._chat_model_name, self.system_message)
+        return self._model_chat
+
+    def reset_chat(self) -> None:
+        """Drops the chat history, the next generate_chat call starts a fresh chat."""
+        self._model_chat = None
+        self._chat_history_tokens = 0
+        self._chat_transcript = []
+
+    def _request_tokens(self, client_query_string: str, chat: bool = False) -> int:
+        """Estimated prompt tokens of a request, chat requests resend the whole chat history."""
+        request_tokens = self.estimate_tokens(self.system_message) + self.estimate_tokens(client_query_string)
+        if chat:
+            request_tokens += self._chat_history_tokens
+        return request_tokens
+
+    def _cache_key(self, model_name: str, contents: Any, max_output_tokens: int, temperature: float, top_p: float,
+                   response_mime_type: Optional[str], response_schema: Optional[Dict[str, Any]]) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return self.cache.make_key(model_name=model_name,
+                                   system_message=self.system_message,
+                                   contents=contents,
+                                   generation_config={"max_output_tokens": max_output_tokens,
+                                                      "temperature": temperature,
+                                                      "top_p": top_p,
+                                                      "response_mime_type": response_mime_type},
+                                   response_schema=response_schema)
+
+    def _cache_lookup(self, cache_key: Optional[str], observation_name: str, query_string: str) -> Optional[str]:
+        """Returns the cached response text and logs the cache hit as zero cost langfuse generation."""
+        if cache_key is None or self.cache is None:
+            return None
+        cached = self.cache.get(cache_key)
+        if cached is None:
+            return None
+
+        if obs_context.is_recording():
+            obs_context.update_current_observation(
+                name=f"{observation_name} (cached)",
+                input=query_string,
+                output=cached["text"],
+                metadata={"cache_hit": True},
+                usage=ModelUsage(
+                    unit="TOKENS",
+                    input=cached["prompt_tokens"],
+                    output=cached["output_tokens"],
+                    total=cached["prompt_tokens"] + cached["output_tokens"],
+                    input_cost=0.0,
+                    output_cost=0.0,
+                    total_cost=0.0
+                )
             )
-        ]
+        return cached["text"]
+
+    def _cache_store(self, cache_key: Optional[str], response_text: str, vertex_model_response) -> None:
+        if cache_key is None or self.cache is None:
+            return None
+        self.cache.put(cache_key, {
+            "text": response_text,
+            "prompt_tokens": int(vertex_model_response.usage_metadata.prompt_token_count),
+            "output_tokens": int(vertex_model_response.usage_metadata.candidates_token_count)
+        })
+        return None
+
+    def _record_chat_turn(self, client_query_string: str, text_response: str, replay: bool = False) -> None:
+        """Tracks a finished chat turn. Replayed (cached) turns are appended to the backend chat history as well."""
+        if replay:
+            self.model_chat.append_turn(client_query_string, text_response)
+        self._chat_transcript.append(["user", client_query_string])
+        self._chat_transcript.append(["model", text_response])
+        self._chat_history_tokens += self.estimate_tokens(client_query_string) + self.estimate_tokens(text_response)
+
+    def _record_usage(self, stage: str, model_name: str, vertex_model_response) -> None:
+        record_usage(stage, model_name,
+                     prompt_tokens=int(vertex_model_response.usage_metadata.prompt_token_count),
+                     output_tokens=int(vertex_model_response.usage_metadata.candidates_token_count),
+                     cached_tokens=int(getattr(vertex_model_response.usage_metadata,
+                                               "cached_content_token_count", 0) or 0))
+
+    def _charge_hedge(self, stage: str, model_name: str, request_tokens: int) -> bool:
+        """
+        Checks and charges the duplicate of a hedged request, only its prompt is known to be billed.
+
+        The duplicate takes its own rate limiter slot, without one available right now it is not sent.
+        """
+        check_budgets(stage, model_name, request_tokens)
+        if not self.rate_limiter.try_acquire(model_name, request_tokens, priority=self.priority):
+            return False
+        record_usage(stage, model_name, prompt_tokens=request_tokens, output_tokens=0)
+        return True
+
+    def _hedged(self, stage: str, model_name: str, request_tokens: int, call: Callable[[], Any]) -> Any:
+        if self.hedge_policy is None:
+            return call()
+        return self.hedge_policy.run(model_name, call, tokens=request_tokens,
+                                     on_hedge=lambda: self._charge_hedge(stage, model_name, request_tokens))
+
+    async def _ahedged(self, stage: str, model_name: str, request_tokens: int,
+                       call: Callable[[], Awaitable[Any]]) -> Any:
+        if self.hedge_policy is None:
+            return await call()
+        return await self.hedge_policy.arun(model_name, call, tokens=request_tokens,
+                                            on_hedge=lambda: self._charge_hedge(stage, model_name, request_tokens))
+
+    def _generation_config(self, max_output_tokens: int, temperature: float, top_p: float,
+                           response_mime_type: Optional[str] = None,
+                           response_schema: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        return {"max_output_tokens": max_output_tokens,
+                "temperature": temperature,
+                "top_p": top_p,
+                "response_mime_type": response_mime_type,
+                "response_schema": response_schema}
 
     @observe(as_type="generation")
     def generate(
@@ -68,27 +229,40 @@ class LLMSession:
         temperature: float = 0.2,
         top_p: float = 0.5,
         response_mime_type: Optional[str] = None,
-        response_schema: Optional[Dict[str, Any]] = None
+        response_schema: Optional[Dict[str, Any]] = None,
+        stage: str = "other"
     ) -> str:
 
-        response = self.model.generate_content(
-            [client_query_string],
-            generation_config=GenerationConfig(
-                max_output_tokens=max_output_tokens,
-                temperature=temperature,
-                top_p=top_p,
-                response_mime_type=response_mime_type,
-                response_schema=response_schema,
-            ),
-            safety_settings=self.safety_settings,
-            stream=False
-        )
+        model_name = budgeted_model(self.model_name)
+        cache_key = self._cache_key(model_name, client_query_string, max_output_tokens, temperature, top_p,
+                                    response_mime_type, response_schema)
+        cached_text = self._cache_lookup(cache_key, "Text Generate", client_query_string)
+        if cached_text is not None:
+            return cached_text
+
+        request_tokens = self._request_tokens(client_query_string)
+        check_budgets(stage, model_name, request_tokens)
+
+        # the hedge runs inside the limiter, it times and duplicates only the model call
+        response = self.rate_limiter.call(
+            model_name,
+            lambda: self._hedged(stage, model_name, request_tokens, lambda: self.backend.generate(
+                model_name,
+                self.system_message,
+                [client_query_string],
+                generation_config=self._generation_config(max_output_tokens, temperature, top_p,
+                                                          response_mime_type, response_schema))),
+            tokens=request_tokens,
+            priority=self.priority)
+        self._record_usage(stage, model_name, response)
 
         response_text = response.text  # type: ignore
+        self._cache_store(cache_key, response_text, response)
 
         self._langfuse_observation_meta(observation_name="Text Generate",
                                         query_string=client_query_string,
-                                        vertex_model_response=response)
+                                        vertex_model_response=response,
+                                        model_name=model_name)
 
         return response_text
 
@@ -99,30 +273,281 @@ class LLMSession:
                       temperature: float = 0.2,
                       top_p: float = 0.5,
                       response_mime_type: Optional[str] = None,
-                      response_schema: Optional[Dict[str, Any]] = None) -> str:
-
-        generation_config = GenerationConfig(
-            max_output_tokens=max_output_tokens,
-            temperature=temperature,
-            top_p=top_p,
-            response_mime_type=response_mime_type,
-            response_schema=response_schema
-        )
-
-        response = self.model_chat.send_message(
-            client_query_string,
-            stream=False,
-            safety_settings=self.safety_settings,
-            generation_config=generation_config)
+                      response_schema: Optional[Dict[str, Any]] = None,
+                      stage: str = "other") -> str:
+
+        generation_config = self._generation_config(max_output_tokens, temperature, top_p,
+                                                    response_mime_type, response_schema)
+        model_chat = self.model_chat
+        model_name = self._chat_model_name
+
+        cache_key = self._cache_key(model_name, self._chat_transcript + [["user", client_query_string]],
+                                    max_output_tokens, temperature, top_p, response_mime_type, response_schema)
+        cached_text = self._cache_lookup(cache_key, "Chat Generate", client_query_string)
+        if cached_text is not None:
+            self._record_chat_turn(client_query_string, cached_text, replay=True)
+            return cached_text
+
+        request_tokens = self._request_tokens(client_query_string, chat=True)
+        check_budgets(stage, model_name, request_tokens)
+
+        response = self.rate_limiter.call(
+            model_name,
+            lambda: model_chat.send_message(client_query_string, generation_config=generation_config),
+            tokens=request_tokens,
+            priority=self.priority)
+        self._record_usage(stage, model_name, response)
 
         text_response = response.text  # type: ignore
+        self._cache_store(cache_key, text_response, response)
+        self._record_chat_turn(client_query_string, text_response)
 
         self._langfuse_observation_meta(observation_name="Chat Generate",
                                         query_string=client_query_string,
-                                        vertex_model_response=response)
+                                        vertex_model_response=response,
+                                        model_name=model_name)
+
+        return text_response
+
+    @observe(as_type="generation")
+    async def agenerate(
+        self,
+        client_query_string: str,
+        max_output_tokens: int = 8192,
+        temperature: float = 0.2,
+        top_p: float = 0.5,
+        response_mime_type: Optional[str] = None,
+        response_schema: Optional[Dict[str, Any]] = None,
+        timeout: Optional[float] = None,
+        stage: str = "other"
+    ) -> str:
+        """
+        Async variant of generate on the sdk's native async api.
+
+        Calls wait on the shared per event loop concurrency limiter, so thousands of calls can be gathered
+        from one process. Cancelling the awaiting task cancels the request, timeout (seconds) cancels it as well.
+        A hedged duplicate shares the concurrency slot of its request, but takes its own rate limiter slot.
+        """
+        model_name = budgeted_model(self.model_name)
+        cache_key = self._cache_key(model_name, client_query_string, max_output_tokens, temperature, top_p,
+                                    response_mime_type, response_schema)
+        cached_text = self._cache_lookup(cache_key, "Async Text Generate", client_query_string)
+        if cached_text is not None:
+            return cached_text
+
+        request_tokens = self._request_tokens(client_query_string)
+        check_budgets(stage, model_name, request_tokens)
+
+        async with _async_limiter():
+            response = await self.rate_limiter.acall(
+                model_name,
+                lambda: self._ahedged(stage, model_name, request_tokens, lambda: asyncio.wait_for(
+                    self.backend.agenerate(
+                        model_name,
+                        self.system_message,
+                        [client_query_string],
+                        generation_config=self._generation_config(max_output_tokens, temperature, top_p,
+                                                                  response_mime_type, response_schema)
+                    ), timeout=timeout)),
+                tokens=request_tokens,
+                priority=self.priority)
+        self._record_usage(stage, model_name, response)
+
+        response_text = response.text  # type: ignore
+        self._cache_store(cache_key, response_text, response)
+
+        self._langfuse_observation_meta(observation_name="Async Text Generate",
+                                        query_string=client_query_string,
+                                        vertex_model_response=response,
+                                        model_name=model_name)
+
+        return response_text
+
+    @observe(as_type="generation")
+    async def agenerate_chat(self,
+                             client_query_string: str,
+                             max_output_tokens: int = 8192,
+                             temperature: float = 0.2,
+                             top_p: float = 0.5,
+                             response_mime_type: Optional[str] = None,
+                             response_schema: Optional[Dict[str, Any]] = None,
+                             timeout: Optional[float] = None,
+                             stage: str = "other") -> str:
+        """Async variant of generate_chat. Turns of one chat have to be awaited one after another."""
+
+        generation_config = self._generation_config(max_output_tokens, temperature, top_p,
+                                                    response_mime_type, response_schema)
+
+        model_chat = self.model_chat
+        model_name = self._chat_model_name
+
+        cache_key = self._cache_key(model_name, self._chat_transcript + [["user", client_query_string]],
+                                    max_output_tokens, temperature, top_p, response_mime_type, response_schema)
+        cached_text = self._cache_lookup(cache_key, "Async Chat Generate", client_query_string)
+        if cached_text is not None:
+            self._record_chat_turn(client_query_string, cached_text, replay=True)
+            return cached_text
+
+        request_tokens = self._request_tokens(client_query_string, chat=True)
+        check_budgets(stage, model_name, request_tokens)
+
+        async with _async_limiter():
+            response = await self.rate_limiter.acall(
+                model_name,
+                lambda: asyncio.wait_for(model_chat.send_message_async(
+                    client_query_string, generation_config=generation_config), timeout=timeout),
+                tokens=request_tokens,
+                priority=self.priority)
+        self._record_usage(stage, model_name, response)
+
+        text_response = response.text  # type: ignore
+        self._cache_store(cache_key, text_response, response)
+        self._record_chat_turn(client_query_string, text_response)
+
+        self._langfuse_observation_meta(observation_name="Async Chat Generate",
+                                        query_string=client_query_string,
+                                        vertex_model_response=response,
+                                        model_name=model_name)
 
         return text_response
 
+    def generate_stream(self,
+                        client_query_string: str,
+                        max_output_tokens: int = 8192,
+                        temperature: float = 0.2,
+                        top_p: float = 0.5,
+                        stage: str = "other") -> Iterator[str]:
+        """
+        Streams the model response and yields text chunks as soon as the model produces them.
+
+        Usage metadata is only complete on the last chunk, so the langfuse generation is recorded once the stream is exhausted.
+        """
+        request_time = datetime.datetime.now(datetime.timezone.utc)
+
+        model_name = budgeted_model(self.model_name)
+        request_tokens = self._request_tokens(client_query_string)
+        check_budgets(stage, model_name, request_tokens)
+
+        self.rate_limiter.acquire(model_name,
+                                  tokens=request_tokens,
+                                  priority=self.priority)
+
+        responses = self.backend.generate_stream(
+            model_name,
+            self.system_message,
+            [client_query_string],
+            generation_config=self._generation_config(max_output_tokens, temperature, top_p))
+
+        response_text = ""
+        last_chunk = None
+        first_chunk_time = None
+        for chunk in responses:
+            last_chunk = chunk
+            chunk_text = self._chunk_text(chunk)
+            if chunk_text == "":
+                continue
+            if first_chunk_time is None:
+                first_chunk_time = datetime.datetime.now(datetime.timezone.utc)
+            response_text += chunk_text
+            yield chunk_text
+
+        if last_chunk is not None:
+            self._record_usage(stage, model_name, last_chunk)
+            self._observe_stream(model_name=model_name,
+                                 query_string=client_query_string,
+                                 vertex_model_response=last_chunk,
+                                 model_response_str=response_text,
+                                 start_time=request_time,
+                                 completion_start_time=first_chunk_time)
+
+    @observe(as_type="generation")
+    def _observe_stream(self, model_name: str,
+                        query_string: str,
+                        vertex_model_response,
+                        model_response_str: str,
+                        start_time: datetime.datetime,
+                        completion_start_time: Optional[datetime.datetime]) -> None:
+        """Records a finished streamed generation as langfuse observation."""
+        self._langfuse_observation_meta(observation_name="Stream Generate",
+                                        query_string=query_string,
+                                        vertex_model_response=vertex_model_response,
+                                        model_response_str=model_response_str,
+                                        model_name=model_name,
+                                        start_time=start_time,
+                                        completion_start_time=completion_start_time)
+        return None
+
+    def _chunk_text(self, chunk) -> str:
+        """Returns the text of one streamed chunk, empty if the chunk carries no text part (e.g. final usage chunk)."""
+        try:
+            return chunk.text
+        except (ValueError, IndexError, AttributeError):
+            return ""
+
+    @observe(as_type="generation")
+    def function_call_gen(
+        self,
+        client_query_string: str,
+        response_schema: Dict[str, Any],
+        max_output_tokens: int = 8192,
+        temperature: float = 0.0,
+        top_p: float = 0.3,
+        stage: str = "other"
+    ) -> str:
+
+        model_name = budgeted_model(self.model_name)
+        request_tokens = self._request_tokens(client_query_string)
+        check_budgets(stage, model_name, request_tokens)
+
+        response = self.rate_limiter.call(
+            model_name,
+            lambda: self.backend.generate(
+                model_name,
+                self.system_message,
+                [client_query_string],
+                generation_config=self._generation_config(max_output_tokens, temperature, top_p),
+                function_schema=response_schema),
+            tokens=request_tokens,
+            priority=self.priority)
+        self._record_usage(stage, model_name, response)
+
+        try:
+            response_text = response.text  # type: ignore
+
+            self._langfuse_observation_meta(observation_name="Function Call Text Generate",
+                                            query_string=client_query_string,
+                                            vertex_model_response=response, model_response_str=response_text,
+                                            model_name=model_name)
+
+            response_schematic = json.loads(response_text)
+        except (ValueError, AttributeError, KeyError, IndexError):
+            # a function call response has no text (ValueError) or its text is no json (JSONDecodeError)
+            response_schematic = self._extract_arguments_from_model_response(response)
+
+            self._langfuse_observation_meta(observation_name="Function Call Text Generate",
+                                            query_string=client_query_string,
+                                            vertex_model_response=response, model_response_str=str(response_schematic),
+                                            model_name=model_name)
+
+        return str(response_schematic)
+
+    def _extract_arguments_from_model_response(self, model_response) -> dict:
+        """
+        Extract the raw function name and function calling arguments from the model response.
+        """
+        res = model_response.candidates[0].function_calls[0].args
+        func_arguments = {i: res[i] for i in res}
+        return func_arguments
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """
+        Cheap local token estimate (~4 characters per token for gemini models).
+
+        Used for budgeting prompts before they are sent. Exact counts are only known from the response usage metadata.
+        """
+        return estimate_tokens(text)
+
     def parse_json_response(self, res: str) -> dict:
         # Remove the ```json\n and \n``` delimiters
         res = res.replace('```json\n', '').replace('\n```', '')
@@ -142,46 +567,99 @@ class LLMSession:
                    dimensionality: Optional[int] = 768) -> List[float]:
         """Embeds texts with a pre-trained, foundational model."""
 
-        model = TextEmbeddingModel.from_pretrained(model_name)
-        input = TextEmbeddingInput(text, task)
-        # kwargs = dict(output_dimensionality=dimensionality) if dimensionality else {}
-        embedding = model.get_embeddings(
-            texts=[input], output_dimensionality=dimensionality)
+        text_tokens = self.estimate_tokens(text)
+        check_budgets("embeddings", model_name, text_tokens)
+        embedding = self.rate_limiter.call(
+            model_name,
+            lambda: self.backend.embed(model_name, [text], task, dimensionality),
+            tokens=text_tokens,
+            priority=self.priority)
+        # the embedding api reports no usage, the local estimate is accounted
+        record_usage("embeddings", model_name, prompt_tokens=text_tokens, output_tokens=0)
         return embedding
 
-    def _vertex_price_estimation(self) -> tuple[float, float]:
-
-        if "gemini-1.5-pro" in self.model_name:
-            input_token_price = 0.00125 / 1000
-            output_token_price = 0.00375 / 1000
-
-        elif "gemini-1.5-flash" in self.model_name:
-            input_token_price = 0.00001875 / 1000
-            output_token_price = 0.000075 / 1000
-
-        else:
-            raise ValueError(f"Pricing for {self.model_name} not found.")
-
-        return input_token_price, output_token_price
-
-        pass
+    async def aembed(self, texts: List[str],
+                     task: str = "RETRIEVAL_DOCUMENT",
+                     model_name: str = "text-embedding-004",
+                     dimensionality: Optional[int] = 768,
+                     timeout: Optional[float] = None) -> List[List[float]]:
+        """Async embedding of one request worth of texts (max. 250 inputs) on the shared concurrency limiter."""
+
+        texts_tokens = sum(self.estimate_tokens(text) for text in texts)
+        check_budgets("embeddings", model_name, texts_tokens)
+        async with _async_limiter():
+            embeddings = await self.rate_limiter.acall(
+                model_name,
+                lambda: asyncio.wait_for(self.backend.aembed(
+                    model_name, texts, task, dimensionality), timeout=timeout),
+                tokens=texts_tokens,
+                priority=self.priority)
+        record_usage("embeddings", model_name, prompt_tokens=texts_tokens, output_tokens=0)
+        return [e.values for e in embeddings]
+
+    def embed_texts(self, texts: List[str],
+                    task: str = "RETRIEVAL_DOCUMENT",
+                    model_name: str = "text-embedding-004",
+                    dimensionality: Optional[int] = 768,
+                    max_batch_size: int = 250,
+                    max_batch_tokens: int = 15000) -> List[List[float]]:
+        """Embeds many texts with as few requests as the embedding api limits (inputs and tokens per request) allow."""
+
+        batches, batches_tokens = [], []
+        batch, batch_tokens = [], 0
+        for text in texts:
+            text_tokens = self.estimate_tokens(text)
+            if batch and (len(batch) >= max_batch_size or batch_tokens + text_tokens > max_batch_tokens):
+                batches.append(batch)
+                batches_tokens.append(batch_tokens)
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += text_tokens
+        if batch:
+            batches.append(batch)
+            batches_tokens.append(batch_tokens)
+
+        embeddings = []
+        for b, b_tokens in zip(batches, batches_tokens):
+            check_budgets("embeddings", model_name, b_tokens)
+            batch_embeddings = self.rate_limiter.call(
+                model_name,
+                lambda: self.backend.embed(model_name, b, task, dimensionality),
+                tokens=b_tokens,
+                priority=self.priority)
+            record_usage("embeddings", model_name, prompt_tokens=b_tokens, output_tokens=0)
+            embeddings.extend([e.values for e in batch_embeddings])
+        return embeddings
+
+    def _vertex_price_estimation(self, model_name: Optional[str] = None) -> tuple[float, float]:
+        """Price per input and output token, unknown models are estimated conservatively instead of failing."""
+        return model_price(model_name or self.model_name)
 
     def _langfuse_observation_meta(self, observation_name: str,
                                    query_string: str,
-                                   vertex_model_response) -> None:
+                                   vertex_model_response,
+                                   model_response_str: Optional[str] = None,
+                                   model_name: Optional[str] = None,
+                                   **observation_kwargs) -> None:
         """
-        Update langfuse observation with usage metadata.
+        Update langfuse observation with usage metadata, skipped for unsampled traces.
         """
-        input_token_price, output_token_price = self._vertex_price_estimation()
+        if not obs_context.is_recording():
+            return None
+
+        input_token_price, output_token_price = self._vertex_price_estimation(model_name)
         input_token_count = int(
             vertex_model_response.usage_metadata.prompt_token_count)
         output_token_count = int(
             vertex_model_response.usage_metadata.candidates_token_count)
+        cached_token_count = int(
+            getattr(vertex_model_response.usage_metadata, "cached_content_token_count", 0) or 0)
 
-        langfuse_context.update_current_observation(
+        obs_context.update_current_observation(
             name=observation_name,
+            model=model_name or self.model_name,
             input=query_string,
-            output=vertex_model_response.text,
+            output=model_response_str if model_response_str is not None else vertex_model_response.text,
             usage=ModelUsage(
                 unit="TOKENS",
                 input=input_token_count,
@@ -190,9 +668,10 @@ class LLMSession:
                     vertex_model_response.usage_metadata.total_token_count),
                 input_cost=float(input_token_price),
                 output_cost=float(output_token_price),
-                total_cost=float(input_token_price * input_token_count +
-                                 output_token_price * output_token_count)
-            )
+                total_cost=float(token_cost(model_name or self.model_name,
+                                            input_token_count, output_token_count, cached_token_count))
+            ),
+            **observation_kwargs
         )
         return None
 
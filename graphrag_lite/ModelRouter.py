@@ -0,0 +1,226 @@
+# Copyright 2024 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import re
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional, Sequence
+
+
+SMALL_MODEL = "gemini-1.5-flash-001"
+LARGE_MODEL = "gemini-1.5-pro-001"
+
+# model of every stage without routing (the models the pipeline always used)
+STAGE_DEFAULT_MODELS = {
+    "extraction": LARGE_MODEL,
+    "reports": SMALL_MODEL,
+    "map": LARGE_MODEL,
+    "reduce": LARGE_MODEL,
+    "local": LARGE_MODEL,
+}
+
+# questions asking for reasoning across facts rather than looking one up
+ANALYTICAL_QUERY_PATTERN = re.compile(
+    r"\b(why|how|compare|comparison|explain|analy[sz]e|analysis|evaluate|implications?|impact|relationship|"
+    r"differences?|trends?|summari[sz]e|overview)\b", re.IGNORECASE)
+
+
+def classify_query(user_query: str, max_lookup_words: int = 25) -> str:
+    """Classifies a user query as "lookup" (a short factual question) or "analytical"."""
+    if len(user_query.split()) > max_lookup_words or ANALYTICAL_QUERY_PATTERN.search(user_query):
+        return "analytical"
+    return "lookup"
+
+
+class ModelRouter:
+    """
+    Picks the model tier of every call from its stage and complexity signals.
+
+    Small inputs, small communities, low rated communities and lookup queries go to the small
+    (flash) model, everything else to the large (pro) model. The global query reduce step always
+    uses the large model. call_with_escalation re-runs a call on the large model only when its
+    small model response fails validation: malformed structured output, or low confidence, i.e. a
+    map answer scored below min_small_score about a community rated at least min_confident_rating
+    (see low_confidence).
+
+    Routing is opt-in, with mode "off" (the default) every stage uses its STAGE_DEFAULT_MODELS model
+    and nothing is escalated. Configured by MODEL_ROUTING (on / off), ROUTER_MAX_SMALL_INPUT_TOKENS,
+    ROUTER_MAX_SMALL_COMMUNITY, ROUTER_MIN_LARGE_RATING, ROUTER_MIN_SMALL_SCORE and
+    ROUTER_MIN_CONFIDENT_RATING.
+    """
+
+    def __init__(self,
+                 mode: str = "off",
+                 small_model: str = SMALL_MODEL,
+                 large_model: str = LARGE_MODEL,
+                 max_small_input_tokens: int = 6000,
+                 max_small_community: int = 25,
+                 min_large_rating: float = 8.0,
+                 min_small_score: float = 1.0,
+                 min_confident_rating: float = 5.0) -> None:
+        if mode not in ("on", "off"):
+            raise ValueError(f"Unknown model routing mode {mode}.")
+        self.mode = mode
+        self.small_model = small_model
+        self.large_model = large_model
+        self.max_small_input_tokens = max_small_input_tokens
+        self.max_small_community = max_small_community
+        self.min_large_rating = min_large_rating
+        self.min_small_score = min_small_score
+        self.min_confident_rating = min_confident_rating
+
+        self._lock = threading.Lock()
+        self.routed: Dict[str, Dict[str, int]] = {}
+        self.escalations: Dict[str, int] = {}
+
+    def route(self, stage: str,
+              input_tokens: int = 0,
+              community_size: Optional[int] = None,
+              community_rating: Optional[float] = None,
+              query_type: Optional[str] = None) -> str:
+        """
+        Returns the model to call for one request of a pipeline stage.
+
+        Args:
+            stage: Pipeline stage of the call (extraction, reports, map, reduce, local).
+            input_tokens: Estimated prompt tokens of the call.
+            community_size: Number of entities of the community the call is about (reports).
+            community_rating: Highest importance rating of the community reports in the call (map).
+            query_type: Query class of classify_query, analytical queries go to the large model.
+
+        Returns:
+            The model name.
+        """
+        model_name = self._select(stage, input_tokens, community_size, community_rating, query_type)
+        with self._lock:
+            stage_counts = self.routed.setdefault(stage, {})
+            stage_counts[model_name] = stage_counts.get(model_name, 0) + 1
+        return model_name
+
+    def _select(self, stage: str, input_tokens: int, community_size: Optional[int],
+                community_rating: Optional[float], query_type: Optional[str]) -> str:
+        if self.mode == "off":
+            return STAGE_DEFAULT_MODELS.get(stage, self.large_model)
+
+        # synthesizing the final answer of a global query needs the large model
+        if stage == "reduce" or query_type == "analytical":
+            return self.large_model
+        if input_tokens > self.max_small_input_tokens:
+            return self.large_model
+        if community_size is not None and community_size > self.max_small_community:
+            return self.large_model
+        if community_rating is not None and community_rating >= self.min_large_rating:
+            return self.large_model
+        return self.small_model
+
+    def escalation_model(self, model_name: str) -> Optional[str]:
+        """The larger model to re-run a failed call on, None if model_name already is the largest."""
+        if self.mode == "off" or model_name == self.large_model:
+            return None
+        return self.large_model
+
+    def low_confidence(self, score: Any, community_rating: Optional[float]) -> bool:
+        """
+        True for a map answer scored below min_small_score about a community rated at least
+        min_confident_rating: the community was only sent to the small model for its rating, so the
+        small model finding nothing relevant in it is not trusted. Unparseable scores are low confidence.
+        """
+        if self.mode == "off" or community_rating is None or community_rating < self.min_confident_rating:
+            return False
+        try:
+            return float(score) < self.min_small_score
+        except (TypeError, ValueError):
+            return True
+
+    def _count_escalation(self, stage: str, model_name: str, escalated_model: str) -> None:
+        with self._lock:
+            self.escalations[stage] = self.escalations.get(stage, 0) + 1
+        print(f"Escalating {stage} call from {model_name} to {escalated_model}")
+
+    def call_with_escalation(self, stage: str, model_name: str,
+                             call: Callable[[str], Any],
+                             validate: Callable[[Any], bool]) -> Any:
+        """
+        Runs call(model_name) and re-runs it once on the larger model if validate rejects the response.
+
+        The larger model's response is returned whether it validates or not.
+        """
+        response = call(model_name)
+        escalated_model = self.escalation_model(model_name)
+        if escalated_model is None or validate(response):
+            return response
+        self._count_escalation(stage, model_name, escalated_model)
+        return call(escalated_model)
+
+    async def acall_with_escalation(self, stage: str, model_name: str,
+                                    call: Callable[[str], Awaitable[Any]],
+                                    validate: Callable[[Any], bool]) -> Any:
+        """Async version of call_with_escalation."""
+        response = await call(model_name)
+        escalated_model = self.escalation_model(model_name)
+        if escalated_model is None or validate(response):
+            return response
+        self._count_escalation(stage, model_name, escalated_model)
+        return await call(escalated_model)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"routed": {stage: dict(counts) for stage, counts in self.routed.items()},
+                    "escalations": dict(self.escalations)}
+
+
+def valid_json_response(response: str, required_keys: Sequence[str] = (),
+                        min_items: int = 0,
+                        confident: Optional[Callable[[Dict[str, Any]], bool]] = None) -> bool:
+    """
+    Validates a structured model response: parseable json, all required_keys present and non empty
+    in the object (or every object of the array), at least min_items elements for arrays and, if
+    given, confident(item) true for every object.
+    """
+    try:
+        parsed = json.loads(response.replace('```json\n', '').replace('\n```', ''))
+    except (json.JSONDecodeError, AttributeError):
+        return False
+
+    items = parsed if isinstance(parsed, list) else [parsed]
+    if len(items) < min_items:
+        return False
+    for item in items:
+        if not isinstance(item, dict):
+            return False
+        if any(item.get(k) in (None, "", [], {}) for k in required_keys):
+            return False
+        if confident is not None and not confident(item):
+            return False
+    return True
+
+
+_default_router: Optional[ModelRouter] = None
+_default_router_lock = threading.Lock()
+
+
+def default_model_router() -> ModelRouter:
+    """Process wide model router configured from the environment."""
+    global _default_router
+    with _default_router_lock:
+        if _default_router is None:
+            _default_router = ModelRouter(
+                mode=os.environ.get("MODEL_ROUTING", "off").lower(),
+                max_small_input_tokens=int(os.environ.get("ROUTER_MAX_SMALL_INPUT_TOKENS", 6000)),
+                max_small_community=int(os.environ.get("ROUTER_MAX_SMALL_COMMUNITY", 25)),
+                min_large_rating=float(os.environ.get("ROUTER_MIN_LARGE_RATING", 8.0)),
+                min_small_score=float(os.environ.get("ROUTER_MIN_SMALL_SCORE", 1.0)),
+                min_confident_rating=float(os.environ.get("ROUTER_MIN_CONFIDENT_RATING", 5.0)))
+        return _default_router
@@ -0,0 +1,136 @@
+# Copyright 2024 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+import PyPDF2
+
+
+class PageOCRCache:
+    """
+    Disk-backed LRU cache of OCR text per PDF page.
+
+    Entries are keyed by a hash over the page serialized as a single page PDF (which does not
+    depend on the document or part the page came from) and the OCR processor, and stored in a
+    local sqlite file. Re-splitting a document with another max_pages_per_file reassembles its
+    parts from cached pages, only new or changed pages are sent to OCR. When the stored texts
+    exceed max_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 256 * 1024 * 1024) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_path = os.path.join(cache_dir, "ocr_pages.sqlite")
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.cache_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "key TEXT PRIMARY KEY, text TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS pages_last_access ON pages (last_access)")
+        self._conn.commit()
+
+    @staticmethod
+    def page_key(pdf_reader: PyPDF2.PdfReader, page_num: int, processor: str) -> str:
+        """Hashes the content of one page and the processor (id and version) that OCRs it."""
+        pdf_writer = PyPDF2.PdfWriter()
+        pdf_writer.add_page(pdf_reader.pages[page_num])
+        page_pdf = io.BytesIO()
+        pdf_writer.write(page_pdf)
+        digest = hashlib.sha256(page_pdf.getbuffer())
+        digest.update(processor.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get_many(self, keys: list[str]) -> dict[str, str]:
+        """Returns the cached texts of the keys found, counting hits and misses per page."""
+        found: dict[str, str] = {}
+        with self._lock:
+            now = time.time()
+            for key in keys:
+                row = self._conn.execute("SELECT text FROM pages WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    continue
+                self._conn.execute("UPDATE pages SET last_access = ? WHERE key = ?", (now, key))
+                self.hits += 1
+                found[key] = row[0]
+            self._conn.commit()
+        return found
+
+    def put_many(self, texts: dict[str, str]) -> None:
+        """Stores page texts and evicts least recently used entries beyond max_bytes."""
+        with self._lock:
+            now = time.time()
+            for key, text in texts.items():
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO pages (key, text, size, last_access) VALUES (?, ?, ?, ?)",
+                    (key, text, len(text.encode("utf-8")), now))
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        for key, size in self._conn.execute(
+                "SELECT key, size FROM pages ORDER BY last_access ASC").fetchall():
+            self._conn.execute("DELETE FROM pages WHERE key = ?", (key,))
+            self.evictions += 1
+            total_bytes -= size
+            if total_bytes <= self.max_bytes:
+                break
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries, total_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages").fetchone()
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": total_bytes}
+
+
+_default_cache: Optional[PageOCRCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def default_page_ocr_cache() -> Optional[PageOCRCache]:
+    """
+    Process wide page OCR cache, only enabled when OCR_CACHE_DIR is set.
+
+    OCR_CACHE_MAX_MB bounds its size on disk (default 256).
+    """
+    global _default_cache
+    cache_dir = os.environ.get("OCR_CACHE_DIR")
+    if not cache_dir:
+        return None
+    with _default_cache_lock:
+        if _default_cache is None:
+            max_mb = int(os.environ.get("OCR_CACHE_MAX_MB", 256))
+            _default_cache = PageOCRCache(cache_dir=cache_dir, max_bytes=max_mb * 1024 * 1024)
+        return _default_cache
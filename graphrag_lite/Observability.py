@@ -0,0 +1,305 @@
+# Copyright 2024 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import atexit
+import bisect
+import contextlib
+import contextvars
+import functools
+import inspect
+import os
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from langfuse.decorators import observe as langfuse_observe, langfuse_context
+
+
+class TimingHistogram:
+    """Log-bucketed latency histogram (1 ms to ~5 min, 25% wide buckets) with approximate percentiles."""
+
+    BOUNDS = [0.001 * 1.25 ** i for i in range(57)]
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds: float) -> None:
+        bucket = bisect.bisect_left(self.BOUNDS, seconds)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-th percentile (0 < q <= 100), None without samples."""
+        with self._lock:
+            if self.count == 0:
+                return None
+            rank = q / 100 * self.count
+            seen = 0
+            for bucket, bucket_count in enumerate(self.counts):
+                seen += bucket_count
+                if seen >= rank and bucket_count > 0:
+                    return min(self.BOUNDS[bucket], self.max_seconds) if bucket < len(self.BOUNDS) else self.max_seconds
+            return self.max_seconds
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"count": self.count,
+                "mean": self.total_seconds / self.count if self.count else None,
+                "p50": self.percentile(50),
+                "p95": self.percentile(95),
+                "p99": self.percentile(99),
+                "max": self.max_seconds}
+
+
+class ObservabilityContext:
+    """
+    Sampled, batched langfuse export with local timing histograms.
+
+    mode is "langfuse" (export sampled traces) or "off" (no-op, nothing is exported). The sampling
+    decision is made once per trace at its root observation and inherited by all nested observations,
+    so a trace is either complete or absent. Unsampled calls skip all langfuse bookkeeping.
+    flush() does not block, exports are flushed by a background thread every flush_interval seconds
+    and once at interpreter exit. Request handlers on cpu-throttled serverless instances (cloud run
+    without always-allocated cpu) flush with blocking=True before responding instead, the background
+    thread gets no cpu between requests; has_pending_exports tells whether there is anything to
+    export, unsampled requests and "off" mode skip the flush. Timings of all observed functions are
+    recorded locally regardless of sampling.
+
+    Configured by OBS_MODE, OBS_SAMPLE_RATE (0.0 - 1.0) and OBS_FLUSH_INTERVAL (seconds).
+    """
+
+    def __init__(self, mode: str = "langfuse", sample_rate: float = 1.0, flush_interval: float = 5.0) -> None:
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+
+        self._sampled: contextvars.ContextVar[Optional[bool]] = contextvars.ContextVar("obs_sampled", default=None)
+        self._histograms: Dict[str, TimingHistogram] = {}
+        self._histograms_lock = threading.Lock()
+
+        self._flush_requested = threading.Event()
+        self._flush_thread: Optional[threading.Thread] = None
+        self._flush_lock = threading.Lock()
+        # sampled root traces finished since the last export
+        self._pending_traces = 0
+        self._pending_lock = threading.Lock()
+
+    def configure(self, mode: Optional[str] = None,
+                  sample_rate: Optional[float] = None,
+                  flush_interval: Optional[float] = None) -> None:
+        if mode is not None:
+            if mode not in ("langfuse", "off"):
+                raise ValueError(f"Unknown observability mode {mode}.")
+            self.mode = mode
+        if sample_rate is not None:
+            self.sample_rate = min(1.0, max(0.0, sample_rate))
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+
+    def is_recording(self) -> bool:
+        """True inside a sampled trace, the only place where langfuse bookkeeping is worth doing."""
+        return self.mode != "off" and bool(self._sampled.get())
+
+    def _sample(self) -> bool:
+        return self.mode != "off" and (self.sample_rate >= 1.0 or random.random() < self.sample_rate)
+
+    def _trace_finished(self) -> None:
+        with self._pending_lock:
+            self._pending_traces += 1
+
+    def _take_pending(self) -> int:
+        with self._pending_lock:
+            pending, self._pending_traces = self._pending_traces, 0
+        return pending
+
+    def has_pending_exports(self) -> bool:
+        """True if a sampled trace finished since the last export."""
+        return self.mode != "off" and self._pending_traces > 0
+
+    # ----- langfuse passthrough -----
+
+    def update_current_observation(self, **kwargs) -> None:
+        if self.is_recording():
+            langfuse_context.update_current_observation(**kwargs)
+
+    def update_current_trace(self, **kwargs) -> None:
+        if self.is_recording():
+            langfuse_context.update_current_trace(**kwargs)
+
+    def flush(self, blocking: bool = False) -> None:
+        """
+        Schedules an export of buffered observations on the background thread, or exports them now if
+        blocking. A blocking flush returns right away if no sampled trace finished since the last export.
+        """
+        if self.mode == "off":
+            return None
+        if blocking:
+            if not self._take_pending():
+                return None
+            try:
+                with self._flush_lock:
+                    langfuse_context.flush()
+            except Exception as e:
+                print(f"Warning: Observability flush failed: {e}")
+            return None
+        self._ensure_flush_thread()
+        self._flush_requested.set()
+        return None
+
+    def _ensure_flush_thread(self) -> None:
+        if self._flush_thread is not None and self._flush_thread.is_alive():
+            return
+        with self._flush_lock:
+            if self._flush_thread is None or not self._flush_thread.is_alive():
+                self._flush_thread = threading.Thread(target=self._flush_loop, name="obs-flush", daemon=True)
+                self._flush_thread.start()
+
+    def _flush_loop(self) -> None:
+        while True:
+            self._flush_requested.wait()
+            # batch everything requested within one interval into one export
+            time.sleep(self.flush_interval)
+            self._flush_requested.clear()
+            self._take_pending()
+            try:
+                with self._flush_lock:
+                    langfuse_context.flush()
+            except Exception as e:
+                print(f"Warning: Observability flush failed: {e}")
+
+    # ----- local timings -----
+
+    def histogram(self, name: str) -> TimingHistogram:
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._histograms_lock:
+                histogram = self._histograms.setdefault(name, TimingHistogram())
+        return histogram
+
+    def record_timing(self, name: str, seconds: float) -> None:
+        self.histogram(name).record(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_timing(name, time.perf_counter() - start)
+
+    def timing_summary(self) -> Dict[str, Dict[str, Any]]:
+        with self._histograms_lock:
+            names = list(self._histograms)
+        return {name: self._histograms[name].snapshot() for name in sorted(names)}
+
+
+obs_context = ObservabilityContext(mode=os.environ.get("OBS_MODE", "langfuse"),
+                                   sample_rate=float(os.environ.get("OBS_SAMPLE_RATE", 1.0)),
+                                   flush_interval=float(os.environ.get("OBS_FLUSH_INTERVAL", 5.0)))
+
+
+@atexit.register
+def _flush_at_exit() -> None:
+    if obs_context.mode != "off":
+        try:
+            langfuse_context.flush()
+        except Exception:
+            pass
+
+
+def observe(name: Optional[str] = None, **observe_kwargs) -> Callable:
+    """
+    Drop-in replacement for langfuse's observe decorator that samples traces and records timings.
+
+    Sampled calls go through the langfuse decorated function, unsampled calls (and every call in
+    "off" mode) run the plain function with only a local timing recorded.
+    """
+
+    def decorator(fn: Callable) -> Callable:
+        traced_fn = langfuse_observe(name=name, **observe_kwargs)(fn)
+        timing_name = name or fn.__qualname__
+
+        def start_trace() -> tuple[bool, Optional[contextvars.Token]]:
+            sampled = obs_context._sampled.get()
+            if sampled is None:
+                sampled = obs_context._sample()
+                return sampled, obs_context._sampled.set(sampled)
+            return sampled, None
+
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                sampled, token = start_trace()
+                start = time.perf_counter()
+                try:
+                    if sampled and obs_context.mode != "off":
+                        return await traced_fn(*args, **kwargs)
+                    return await fn(*args, **kwargs)
+                finally:
+                    obs_context.record_timing(timing_name, time.perf_counter() - start)
+                    if token is not None:
+                        obs_context._sampled.reset(token)
+                        if sampled:
+                            obs_context._trace_finished()
+            return async_wrapper
+
+        if inspect.isgeneratorfunction(fn):
+            # every step of the generator runs in one context of its own, so its sampling decision (and
+            # langfuse's observation stack) stays active until it is exhausted or closed and never leaks
+            # into the caller while it is suspended
+            @functools.wraps(fn)
+            def generator_wrapper(*args, **kwargs):
+                context = contextvars.copy_context()
+                sampled, token = context.run(start_trace)
+                start = time.perf_counter()
+                gen = context.run(traced_fn if sampled and obs_context.mode != "off" else fn, *args, **kwargs)
+                try:
+                    while True:
+                        try:
+                            item = context.run(next, gen)
+                        except StopIteration as stop:
+                            return stop.value
+                        yield item
+                finally:
+                    context.run(gen.close)
+                    obs_context.record_timing(timing_name, time.perf_counter() - start)
+                    if token is not None and sampled:
+                        obs_context._trace_finished()
+            return generator_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            sampled, token = start_trace()
+            start = time.perf_counter()
+            try:
+                if sampled and obs_context.mode != "off":
+                    return traced_fn(*args, **kwargs)
+                return fn(*args, **kwargs)
+            finally:
+                obs_context.record_timing(timing_name, time.perf_counter() - start)
+                if token is not None:
+                    obs_context._sampled.reset(token)
+                    if sampled:
+                        obs_context._trace_finished()
+        return wrapper
+
+    return decorator
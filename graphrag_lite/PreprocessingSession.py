@@ -15,27 +15,76 @@
 
 from numpy import gradient
 from graphrag_lite.IngestionSession import IngestionSession
+from graphrag_lite.IngestionPipeline import IngestionPipeline, PartResult
+from graphrag_lite.IngestionLedger import IngestionLedger, default_ingestion_ledger
 from graph2nosql.graph2nosql.graph2nosql import NoSQLKnowledgeGraph
 from dotenv import dotenv_values
 
+import gc
+import tempfile
+import threading
 from io import BytesIO
+from typing import BinaryIO, Iterator, Optional, Union
 import PyPDF2
 
 
 class PreprocessingSession:
-    def __init__(self, graph_db: NoSQLKnowledgeGraph) -> None:
+    def __init__(self, graph_db: NoSQLKnowledgeGraph,
+                 ingestion: Optional[IngestionSession] = None,
+                 ledger: Optional[IngestionLedger] = None,
+                 stage_limits: Optional[dict[str, threading.Semaphore]] = None) -> None:
+        """
+        ingestion, ledger and stage_limits are shared by bulk ingestion across concurrent documents,
+        by default every call gets its own IngestionSession and the INGEST_LEDGER_DIR ledger.
+        """
         self.secrets = dotenv_values(".env")
         self.graph_db = graph_db
+        self.ingestion = ingestion
+        self.ledger = ledger if ledger is not None else default_ingestion_ledger()
+        self.stage_limits = stage_limits
+        # split parts larger than this are spilled to disk
+        self.spool_max_bytes = int(self.secrets.get("INGEST_SPOOL_MAX_BYTES") or 8 * 1024 * 1024)
 
     def __call__(self, new_file_name: str,
                  max_pages_per_file: int,
                  file_to_ingest=None,
                  ingest_local_file: bool = False,
-                 ingest_pdf: bool = True) -> None:
+                 ingest_pdf: bool = True) -> list[PartResult]:
+        """
+        Splits, ingests and post-processes one PDF, returns the results of its parts (none if it was already ingested).
+        The pages of the results add up to the pages of the PDF.
+
+        file_to_ingest is the PDF as bytes or as a seekable binary file object, with ingest_local_file
+        the PDF is read from the new_file_name path. Parts are produced lazily while the pipeline makes
+        room for them and spilled to temporary files above INGEST_SPOOL_MAX_BYTES, so memory stays
+        bounded by the parts in flight, not by the size of the PDF. A file object passed in as a
+        single part document is closed once it is ingested.
+        """
+        if ingest_local_file:
+            with open(new_file_name, "rb") as f:
+                return self(new_file_name=new_file_name, max_pages_per_file=max_pages_per_file,
+                            file_to_ingest=f, ingest_pdf=ingest_pdf)
+        pdf_file = IngestionSession._pdf_stream(file_to_ingest)
+
+        # identical content is ingested once, whatever name it is uploaded under
+        ledger = self.ledger
+        doc_hash = IngestionLedger.content_hash(pdf_file)
+        if ledger is not None:
+            ingested_as = ledger.completed_document(doc_hash)
+            if ingested_as is not None:
+                print(f"{new_file_name} was already ingested as {ingested_as}, skipping.")
+                return []
+
+        ingestion = self.ingestion or IngestionSession(graph_db=self.graph_db)
+        # parts are uploaded, OCR'd and extracted concurrently, the graph is post-processed once
+        pipeline = IngestionPipeline(
+            ingestion=ingestion,
+            upload_workers=int(self.secrets.get("INGEST_UPLOAD_WORKERS") or 4),
+            ocr_workers=int(self.secrets.get("INGEST_OCR_WORKERS") or 4),
+            extraction_workers=int(self.secrets.get("INGEST_EXTRACTION_WORKERS") or 1),
+            ledger=ledger,
+            stage_limits=self.stage_limits)
 
-        ingestion = IngestionSession(graph_db=self.graph_db)
-
-        pdf_file = BytesIO(file_to_ingest)
         pdf_reader = PyPDF2.PdfReader(pdf_file)
         num_pages = len(pdf_reader.pages)
         ingest_pdf = ingest_pdf
@@ -45,44 +94,64 @@ class PreprocessingSession:
 
         # check if PDF file exceeds the page limit
         if num_pages > max_pages_per_file:
-            output_file_index = 1
-            output_file_name = f"{
-                new_file_name[:-4]}-part{output_file_index}.pdf"
-            pdf_writer = PyPDF2.PdfWriter()
-            tmp = BytesIO()
-
-            for page_num in range(num_pages):
-                pdf_writer.add_page(pdf_reader.pages[page_num])
-
-                if page_num % max_pages_per_file == max_pages_per_file - 1:
-                    pdf_writer.write(tmp)
-                    output_file_bytes = tmp.getvalue()
-                    ingestion(new_file_name=output_file_name, file_to_ingest=output_file_bytes,
-                              ingest_local_file=False)
-
-                    output_file_index += 1
-                    output_file_name = f"{
-                        new_file_name[:-4]}-part{output_file_index}.pdf"
-                    pdf_writer = PyPDF2.PdfWriter()
-                    tmp = BytesIO()
-
-            # Write any remaining pages to the last output file
-            if page_num % max_pages_per_file != max_pages_per_file - 1:
-                pdf_writer.write(tmp)
-                output_file_bytes = tmp.getvalue()
-                ingestion(new_file_name=output_file_name, file_to_ingest=output_file_bytes,
-                          ingest_local_file=False)
+            results = pipeline(parts=self._split_pdf(pdf_reader=pdf_reader,
+                                                     new_file_name=new_file_name,
+                                                     max_pages_per_file=max_pages_per_file),
+                               ingest_local_file=False,
+                               document_hash=doc_hash,
+                               document_name=new_file_name)
 
             print("Splitting & Ingestion completed.")
 
         else:
-            new_file_name = f"{new_file_name[:-4]}-part0.pdf"
-            ingestion(new_file_name=new_file_name, file_to_ingest=file_to_ingest,
-                      ingest_local_file=False)
+            # a single part, still checkpointed by the pipeline
+            single_part = file_to_ingest if isinstance(file_to_ingest, bytes) else pdf_file
+            results = pipeline(parts=[(f"{new_file_name[:-4]}-part0.pdf", single_part)],
+                               ingest_local_file=False,
+                               document_hash=doc_hash,
+                               document_name=new_file_name)
             print("PDF file has", num_pages,
                   "pages or less, no splitting was needed. Ingestion completed.")
 
-        return None
+        for result in results:
+            result.pages = min(max_pages_per_file, num_pages - result.index * max_pages_per_file)
+        return results
+
+    def _split_pdf(self, pdf_reader: PyPDF2.PdfReader,
+                   new_file_name: str,
+                   max_pages_per_file: int) -> Iterator[tuple[str, Union[bytes, BinaryIO]]]:
+        """
+        Yields (file name, pdf bytes or file) parts of at most max_pages_per_file pages.
+
+        Parts above INGEST_SPOOL_MAX_BYTES are spilled to named temporary files, the IngestionPipeline
+        closes (and thereby deletes) them once the part is ingested.
+        """
+        num_pages = len(pdf_reader.pages)
+        for output_file_index, first_page in enumerate(range(0, num_pages, max_pages_per_file), start=1):
+            output_file_name = f"{new_file_name[:-4]}-part{output_file_index}.pdf"
+            pdf_writer = PyPDF2.PdfWriter()
+            for page_num in range(first_page, min(first_page + max_pages_per_file, num_pages)):
+                pdf_writer.add_page(pdf_reader.pages[page_num])
+
+            buffer = BytesIO()
+            pdf_writer.write(buffer)
+            del pdf_writer
+            if buffer.tell() <= self.spool_max_bytes:
+                part: Union[bytes, BinaryIO] = buffer.getvalue()
+            else:
+                # named, so upload and OCR can read the part concurrently through their own handles
+                part = tempfile.NamedTemporaryFile(prefix="ingest-part-", suffix=".pdf")
+                part.write(buffer.getbuffer())
+                part.flush()
+                part.seek(0)
+            del buffer
+            # the reader caches every object it parsed, dropping the cache after each part keeps
+            # the content of already split pages from piling up for the whole PDF. The parsed
+            # objects reference their reader / writer in cycles, a few large page streams never
+            # trigger the allocation count based garbage collection, so collect them explicitly.
+            pdf_reader.resolved_objects.clear()
+            gc.collect()
+            yield output_file_name, part
 
 
 if __name__ == "__main__":
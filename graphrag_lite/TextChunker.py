@@ -0,0 +1,65 @@
+# Copyright 2024 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import deque
+from typing import Iterable, Iterator
+
+# same estimate as LLMBackend.estimate_tokens
+CHARS_PER_TOKEN = 4
+
+
+def sliding_window_chunks(pages: Iterable[str],
+                          chunk_tokens: int = 1200,
+                          overlap_tokens: int = 100) -> Iterator[str]:
+    """
+    Cuts a stream of page texts into chunks of about chunk_tokens tokens.
+
+    Consecutive chunks share their last / first overlap_tokens tokens, so entities and relations
+    spanning a chunk border are seen whole by at least one extraction. Chunks are cut at word
+    boundaries and do not care about page boundaries. pages is consumed lazily: a chunk is yielded
+    as soon as enough pages arrived to fill it, only one chunk worth of words is kept in memory.
+    """
+    if chunk_tokens <= 0:
+        raise ValueError("chunk_tokens must be positive.")
+    chunk_chars = chunk_tokens * CHARS_PER_TOKEN
+    overlap_chars = min(max(0, overlap_tokens), chunk_tokens // 2) * CHARS_PER_TOKEN
+
+    window: deque[str] = deque()
+    window_chars = 0
+    # chars of the window already yielded as the overlap of the previous chunk
+    carried_chars = 0
+
+    def cut() -> str:
+        nonlocal window_chars, carried_chars
+        chunk = " ".join(window)
+        # keep the tail of the chunk as the head of the next one
+        kept: deque[str] = deque()
+        kept_chars = 0
+        while window and kept_chars + len(window[-1]) + 1 <= overlap_chars:
+            word = window.pop()
+            kept.appendleft(word)
+            kept_chars += len(word) + 1
+        window.clear()
+        window.extend(kept)
+        window_chars = carried_chars = kept_chars
+        return chunk
+
+    for page in pages:
+        for word in page.split():
+            window.append(word)
+            window_chars += len(word) + 1
+            if window_chars >= chunk_chars:
+                yield cut()
+    if window_chars > carried_chars:
+        yield " ".join(window)
@@ -0,0 +1,258 @@
+# Copyright 2024 Google
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextvars
+import threading
+from typing import Dict, Iterator, List, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+# pipeline stages token usage is accounted for
+STAGES = ("extraction", "gleaning", "reports", "map", "reduce", "local", "embeddings", "other")
+
+# usd per 1000 tokens as (input, output), matched by model name prefix
+MODEL_PRICES = {
+    "gemini-1.5-pro": (0.00125, 0.00375),
+    "gemini-1.5-flash": (0.00001875, 0.000075),
+    "text-embedding": (0.0001, 0.0),
+}
+# unknown models are priced like the most expensive known model
+FALLBACK_PRICE = MODEL_PRICES["gemini-1.5-pro"]
+
+# share of the input price billed for prompt tokens served from cached content
+CACHED_INPUT_PRICE_FACTOR = 0.25
+
+# cheaper model a budget falls back to once most of it is spent, matched by model name prefix
+MODEL_DOWNGRADES = {
+    "gemini-1.5-pro": "gemini-1.5-flash",
+}
+
+_unknown_price_models: set[str] = set()
+
+
+def model_price(model_name: str) -> tuple[float, float]:
+    """Returns the (input, output) usd price per token of a model, never raises for unknown models."""
+    matches = [prefix for prefix in MODEL_PRICES if prefix in model_name]
+    if not matches:
+        if model_name not in _unknown_price_models:
+            _unknown_price_models.add(model_name)
+            print(f"Warning: Pricing for {model_name} not found, estimating with {FALLBACK_PRICE} usd per 1k tokens.")
+        input_price, output_price = FALLBACK_PRICE
+    else:
+        input_price, output_price = MODEL_PRICES[max(matches, key=len)]
+    return input_price / 1000, output_price / 1000
+
+
+def token_cost(model_name: str, prompt_tokens: int, output_tokens: int, cached_tokens: int = 0) -> float:
+    """Estimated usd cost of a call, cached_tokens are the part of prompt_tokens served from cached content."""
+    input_price, output_price = model_price(model_name)
+    cached_tokens = min(cached_tokens, prompt_tokens)
+    return input_price * (prompt_tokens - cached_tokens) + \
+        input_price * CACHED_INPUT_PRICE_FACTOR * cached_tokens + \
+        output_price * output_tokens
+
+
+class BudgetExceeded(Exception):
+    """Raised before a model call that would exceed an active token or cost budget."""
+
+    def __init__(self, budget: "TokenBudget", stage: str, estimated_tokens: int) -> None:
+        self.budget = budget
+        self.stage = stage
+        self.estimated_tokens = estimated_tokens
+        super().__init__(f"Budget '{budget.name}' exhausted before {stage} call of ~{estimated_tokens} tokens "
+                         f"({budget.spent_tokens} tokens / {budget.spent_cost_usd:.4f} usd spent).")
+
+
+class TokenLedger:
+    """Thread safe per stage counters of calls, prompt tokens (and the cached part), output tokens and estimated cost."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.stages: Dict[str, Dict[str, float]] = {}
+
+    def record(self, stage: str, model_name: str, prompt_tokens: int, output_tokens: int,
+               cached_tokens: int = 0) -> float:
+        """Adds the usage of one call and returns its estimated cost."""
+        cost = token_cost(model_name, prompt_tokens, output_tokens, cached_tokens)
+        with self._lock:
+            counters = self.stages.setdefault(
+                stage, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "output_tokens": 0, "cost_usd": 0.0})
+            counters["calls"] += 1
+            counters["prompt_tokens"] += prompt_tokens
+            counters["cached_tokens"] += cached_tokens
+            counters["output_tokens"] += output_tokens
+            counters["cost_usd"] += cost
+        return cost
+
+    def totals(self) -> Dict[str, float]:
+        with self._lock:
+            return {k: sum(c[k] for c in self.stages.values())
+                    for k in ("calls", "prompt_tokens", "cached_tokens", "output_tokens", "cost_usd")}
+
+    def summary(self) -> str:
+        with self._lock:
+            lines = [f"{stage:<12} calls={c['calls']:<6} prompt={c['prompt_tokens']:<9} "
+                     f"cached={c['cached_tokens']:<9} output={c['output_tokens']:<8} cost={c['cost_usd']:.4f} usd"
+                     for stage, c in sorted(self.stages.items())]
+        totals = self.totals()
+        lines.append(f"{'total':<12} calls={totals['calls']:<6} prompt={totals['prompt_tokens']:<9} "
+                     f"cached={totals['cached_tokens']:<9} output={totals['output_tokens']:<8} cost={totals['cost_usd']:.4f} usd")
+        return "\n".join(lines)
+
+
+_process_ledger = TokenLedger()
+
+
+def process_ledger() -> TokenLedger:
+    """Ledger of all model calls made by this process."""
+    return _process_ledger
+
+
+_active_budgets: contextvars.ContextVar[tuple["TokenBudget", ...]] = contextvars.ContextVar(
+    "active_token_budgets", default=())
+
+
+class TokenBudget:
+    """
+    Token and cost budget of one unit of work (a document, a query), active as context manager.
+
+    All LLMSession calls made inside the with block (including asyncio tasks and asyncio.to_thread
+    calls started from it) are charged to the budget. Once downgrade_at of the budget is spent, calls
+    are routed to the cheaper model of MODEL_DOWNGRADES. A call whose estimated prompt tokens would
+    exceed the budget raises BudgetExceeded before it is sent, callers catch it to stop gracefully.
+    Budgets can be nested, every active budget is charged and checked. Generators use budgeted_stream
+    instead of a with block, which would leave the budget active in the caller while they are suspended.
+    """
+
+    def __init__(self, name: str,
+                 max_tokens: Optional[int] = None,
+                 max_cost_usd: Optional[float] = None,
+                 downgrade_at: float = 0.8) -> None:
+        self.name = name
+        self.max_tokens = max_tokens
+        self.max_cost_usd = max_cost_usd
+        self.downgrade_at = downgrade_at
+
+        self.ledger = TokenLedger()
+        self.spent_tokens = 0
+        self.spent_cost_usd = 0.0
+        self.exceeded = False
+        self._lock = threading.Lock()
+        self._tokens: List[contextvars.Token] = []
+
+    def __enter__(self) -> "TokenBudget":
+        self._tokens.append(_active_budgets.set(_active_budgets.get() + (self,)))
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        _active_budgets.reset(self._tokens.pop())
+        return None
+
+    def spent_fraction(self) -> float:
+        fractions = [0.0]
+        if self.max_tokens:
+            fractions.append(self.spent_tokens / self.max_tokens)
+        if self.max_cost_usd:
+            fractions.append(self.spent_cost_usd / self.max_cost_usd)
+        return max(fractions)
+
+    def remaining_tokens(self, model_name: str) -> Optional[int]:
+        """Prompt tokens of model_name the budget can still pay for, None if unlimited."""
+        remaining = []
+        if self.max_tokens is not None:
+            remaining.append(self.max_tokens - self.spent_tokens)
+        if self.max_cost_usd is not None:
+            input_price, _ = model_price(model_name)
+            remaining.append(int((self.max_cost_usd - self.spent_cost_usd) / input_price))
+        return max(0, min(remaining)) if remaining else None
+
+    def model_for(self, model_name: str) -> str:
+        if self.spent_fraction() < self.downgrade_at:
+            return model_name
+        for prefix, cheaper in MODEL_DOWNGRADES.items():
+            if prefix in model_name:
+                return model_name.replace(prefix, cheaper)
+        return model_name
+
+    def check(self, stage: str, model_name: str, estimated_tokens: int) -> None:
+        remaining = self.remaining_tokens(model_name)
+        if remaining is not None and estimated_tokens > remaining:
+            self.exceeded = True
+            raise BudgetExceeded(self, stage, estimated_tokens)
+
+    def charge(self, stage: str, model_name: str, prompt_tokens: int, output_tokens: int,
+               cached_tokens: int = 0) -> None:
+        cost = self.ledger.record(stage, model_name, prompt_tokens, output_tokens, cached_tokens)
+        with self._lock:
+            self.spent_tokens += prompt_tokens + output_tokens
+            self.spent_cost_usd += cost
+
+
+def active_budgets() -> tuple[TokenBudget, ...]:
+    return _active_budgets.get()
+
+
+def budgeted_stream(budget: TokenBudget, stream: Iterator[T]) -> Iterator[T]:
+    """
+    Yields from stream with budget active while stream runs.
+
+    Every step of stream runs in one context of its own, so the budget is set and reset there and is
+    never active in the caller between items, also not when the stream is abandoned.
+    """
+    context = contextvars.copy_context()
+    context.run(budget.__enter__)
+    try:
+        while True:
+            try:
+                item = context.run(next, stream)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        context.run(stream.close)
+        context.run(budget.__exit__, None, None, None)
+
+
+def budgeted_model(model_name: str) -> str:
+    """Model to call for model_name under the active budgets (downgraded once a budget runs low)."""
+    for budget in active_budgets():
+        model_name = budget.model_for(model_name)
+    return model_name
+
+
+def check_budgets(stage: str, model_name: str, estimated_tokens: int) -> None:
+    for budget in active_budgets():
+        budget.check(stage, model_name, estimated_tokens)
+
+
+def record_usage(stage: str, model_name: str, prompt_tokens: int, output_tokens: int,
+                 cached_tokens: int = 0) -> None:
+    """Charges one model call to the process ledger and all active budgets."""
+    _process_ledger.record(stage, model_name, prompt_tokens, output_tokens, cached_tokens)
+    for budget in active_budgets():
+        budget.charge(stage, model_name, prompt_tokens, output_tokens, cached_tokens)
+
+
+def budgeted_context_tokens(max_context_tokens: int, model_name: str, context_share: float = 0.8) -> int:
+    """
+    Shrinks a prompt context token budget to what the active budgets can still pay for.
+
+    Only context_share of the remaining budget goes to the context, the rest is left for the response.
+    """
+    for budget in active_budgets():
+        remaining = budget.remaining_tokens(model_name)
+        if remaining is not None:
+            max_context_tokens = min(max_context_tokens, int(remaining * context_share))
+    return max_context_tokens
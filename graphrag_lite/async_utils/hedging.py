@@ -0,0 +1,231 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+from graphrag_lite.Observability import TimingHistogram
+
+
+T = TypeVar("T")
+
+
+class HedgePolicy:
+    """
+    Hedged requests against tail latency.
+
+    A request still outstanding after the percentile latency of its model gets a duplicate, the
+    first successful response wins and the other request is cancelled (async) or abandoned (sync,
+    a running thread can not be interrupted, its response is dropped). If the first response is
+    an error the other request is still awaited.
+
+    Duplicates are capped by max_extra_fraction: the estimated prompt tokens of all hedges stay
+    below that fraction of the prompt tokens of all primary requests. No request is hedged before
+    a model has min_samples latencies, and the hedge delay never drops below min_delay seconds.
+    Only the model calls are timed, so the policy belongs inside any rate limiter: a duplicate
+    needs its own slot, which on_hedge can take (and deny the hedge when there is none).
+
+    Sync requests run on their own threads (the caller waits for the first response), so any
+    number of concurrent callers is hedged without queueing behind each other.
+
+    Configured by LLM_HEDGE_PERCENTILE (hedging is off when unset) and LLM_HEDGE_MAX_EXTRA.
+    """
+
+    def __init__(self,
+                 percentile: float = 95.0,
+                 max_extra_fraction: float = 0.05,
+                 min_samples: int = 20,
+                 min_delay: float = 0.05) -> None:
+        self.percentile = percentile
+        self.max_extra_fraction = max_extra_fraction
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, TimingHistogram] = {}
+
+        self.primary_tokens = 0
+        self.hedge_tokens = 0
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.denied = 0
+
+    # ----- latency tracking -----
+
+    def latencies(self, model_name: str) -> TimingHistogram:
+        with self._lock:
+            return self._latencies.setdefault(model_name, TimingHistogram())
+
+    def hedge_delay(self, model_name: str) -> Optional[float]:
+        """Seconds after which a request to model_name is hedged, None while too few latencies are known."""
+        histogram = self.latencies(model_name)
+        if histogram.count < self.min_samples:
+            return None
+        return max(self.min_delay, histogram.percentile(self.percentile))
+
+    async def _atimed(self, model_name: str, call: Callable[[], Awaitable[T]]) -> T:
+        start = time.perf_counter()
+        result = await call()
+        self.latencies(model_name).record(time.perf_counter() - start)
+        return result
+
+    def _timed(self, model_name: str, call: Callable[[], T]) -> T:
+        start = time.perf_counter()
+        result = call()
+        self.latencies(model_name).record(time.perf_counter() - start)
+        return result
+
+    # ----- spend cap -----
+
+    def _start_request(self, tokens: int) -> None:
+        with self._lock:
+            self.requests += 1
+            self.primary_tokens += tokens
+
+    def _reserve_hedge(self, tokens: int, on_hedge: Optional[Callable[[], None]]) -> bool:
+        with self._lock:
+            if self.hedge_tokens + tokens > self.max_extra_fraction * self.primary_tokens:
+                self.denied += 1
+                return False
+        if on_hedge is not None:
+            try:
+                allowed = on_hedge() is not False
+            except Exception as e:
+                print(f"Hedge skipped: {e}")
+                allowed = False
+            if not allowed:
+                with self._lock:
+                    self.denied += 1
+                return False
+        with self._lock:
+            self.hedged += 1
+            self.hedge_tokens += tokens
+        return True
+
+    def _count_win(self, hedge_won: bool) -> None:
+        with self._lock:
+            if hedge_won:
+                self.hedge_wins += 1
+            else:
+                self.primary_wins += 1
+
+    # ----- hedged calls -----
+
+    async def arun(self, model_name: str, call: Callable[[], Awaitable[T]], tokens: int = 0,
+                   on_hedge: Optional[Callable[[], None]] = None) -> T:
+        """
+        Awaits call(), hedged with a second call() if it is slow.
+
+        Args:
+            model_name: Model the latency percentile is tracked for.
+            call: Returns a fresh awaitable per request.
+            tokens: Estimated prompt tokens of one request, charged against the spend cap.
+            on_hedge: Called right before a duplicate is sent (e.g. to charge token budgets or take a
+                rate limiter slot), raising or returning False skips the hedge.
+        """
+        self._start_request(tokens)
+        delay = self.hedge_delay(model_name)
+        primary = asyncio.ensure_future(self._atimed(model_name, call))
+        if delay is None:
+            return await primary
+
+        hedge = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done or not self._reserve_hedge(tokens, on_hedge):
+                return await primary
+
+            hedge = asyncio.ensure_future(self._atimed(model_name, call))
+            pending = {primary, hedge}
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._count_win(hedge_won=task is hedge)
+                        return task.result()
+                if not pending:
+                    # both failed, surface the primary's error
+                    return primary.result()
+        finally:
+            for task in (primary, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    def run(self, model_name: str, call: Callable[[], T], tokens: int = 0,
+            on_hedge: Optional[Callable[[], None]] = None) -> T:
+        """Sync variant of arun, the requests run on their own threads in the caller's context."""
+        self._start_request(tokens)
+        delay = self.hedge_delay(model_name)
+        if delay is None:
+            return self._timed(model_name, call)
+
+        primary = self._start_thread(model_name, call)
+        done, _ = concurrent.futures.wait({primary}, timeout=delay)
+        if done or not self._reserve_hedge(tokens, on_hedge):
+            return primary.result()
+
+        hedge = self._start_thread(model_name, call)
+        pending = {primary, hedge}
+        while True:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self._count_win(hedge_won=future is hedge)
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
+            if not pending:
+                return primary.result()
+
+    def _start_thread(self, model_name: str, call: Callable[[], T]) -> "concurrent.futures.Future[T]":
+        """Runs one request on a new daemon thread, a shared pool would queue the requests of concurrent callers."""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        context = contextvars.copy_context()
+
+        def work() -> None:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(context.run(self._timed, model_name, call))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=work, name="llm-hedge", daemon=True).start()
+        return future
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            models = list(self._latencies)
+            stats: Dict[str, Any] = {
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "primary_wins": self.primary_wins,
+                "denied": self.denied,
+                "hedge_win_rate": self.hedge_wins / self.hedged if self.hedged else 0.0,
+                "extra_token_fraction": self.hedge_tokens / self.primary_tokens if self.primary_tokens else 0.0,
+            }
+        stats["latencies"] = {m: self.latencies(m).snapshot() for m in models}
+        return stats
+
+
+_default_hedge_policy: Optional[HedgePolicy] = None
+_default_hedge_lock = threading.Lock()
+
+
+def default_hedge_policy() -> Optional[HedgePolicy]:
+    """Process wide hedge policy, only enabled when LLM_HEDGE_PERCENTILE is set."""
+    global _default_hedge_policy
+    percentile = os.environ.get("LLM_HEDGE_PERCENTILE")
+    if not percentile:
+        return None
+    with _default_hedge_lock:
+        if _default_hedge_policy is None:
+            _default_hedge_policy = HedgePolicy(
+                percentile=float(percentile),
+                max_extra_fraction=float(os.environ.get("LLM_HEDGE_MAX_EXTRA", 0.05)))
+        return _default_hedge_policy
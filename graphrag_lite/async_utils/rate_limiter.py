@@ -0,0 +1,307 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Mapping, Optional
+
+from dotenv import dotenv_values
+from google.api_core.exceptions import ResourceExhausted, TooManyRequests
+
+
+# exceptions signalling an exhausted per-model quota (http 429)
+QUOTA_ERRORS = (ResourceExhausted, TooManyRequests)
+
+# default per-model quotas as (requests per minute, tokens per minute), matched by model name prefix,
+# overridden with LLM_QUOTAS (see quota_config)
+DEFAULT_MODEL_QUOTAS = {
+    "gemini-1.5-pro": (60, 4_000_000),
+    "gemini-1.5-flash": (200, 4_000_000),
+    "text-embedding": (600, 1_000_000),
+}
+FALLBACK_QUOTA = (60, 1_000_000)
+DEFAULT_BATCH_RESERVE = 0.2
+
+PRIORITIES = ("interactive", "batch")
+
+
+def _parse_quota(value: str) -> tuple[float, float]:
+    rpm, tpm = value.split(":")
+    return float(rpm), float(tpm)
+
+
+def quota_config(config: Mapping[str, Optional[str]]) -> tuple[dict[str, tuple[float, float]], tuple[float, float], float]:
+    """
+    Model quotas, fallback quota and batch reserve from configuration.
+
+    LLM_QUOTAS lists "prefix=rpm:tpm" entries separated by commas (e.g.
+    "gemini-1.5-pro=1000:4000000,gemini-1.5-flash=2000:4000000"), they replace the defaults of the
+    same prefix and add new prefixes. LLM_QUOTA_FALLBACK ("rpm:tpm") applies to models without a
+    matching prefix, LLM_BATCH_RESERVE (default 0.2) is the fraction of every quota kept free for
+    interactive calls.
+    """
+    quotas = dict(DEFAULT_MODEL_QUOTAS)
+    for entry in (config.get("LLM_QUOTAS") or "").split(","):
+        if entry.strip():
+            prefix, value = entry.split("=", 1)
+            quotas[prefix.strip()] = _parse_quota(value.strip())
+    fallback = _parse_quota(config["LLM_QUOTA_FALLBACK"]) if config.get("LLM_QUOTA_FALLBACK") else FALLBACK_QUOTA
+    batch_reserve = float(config.get("LLM_BATCH_RESERVE") or DEFAULT_BATCH_RESERVE)
+    return quotas, fallback, batch_reserve
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at rate_per_minute up to capacity (one minute of quota)."""
+
+    def __init__(self, rate_per_minute: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self.clock = clock
+        self.capacity = float(rate_per_minute)
+        self.rate_per_minute = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.last_refill = clock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate_per_minute / 60)
+        self.last_refill = now
+
+    def wait_time(self, amount: float, reserve: float = 0.0) -> float:
+        """Seconds until amount can be taken while keeping reserve tokens in the bucket, 0 if possible now."""
+        self._refill()
+        # requests larger than the whole bucket are let through once the bucket is full
+        amount = min(amount, self.capacity - reserve)
+        missing = amount + reserve - self.tokens
+        if missing <= 0:
+            return 0.0
+        return missing * 60 / self.rate_per_minute
+
+    def take(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+    def set_rate(self, rate_per_minute: float) -> None:
+        self._refill()
+        self.rate_per_minute = rate_per_minute
+
+
+class ModelQuota:
+    """
+    Request and token buckets of one model with an AIMD adjusted effective rate.
+
+    Quota errors multiply the effective rate by decrease_factor, every successful call adds
+    increase_fraction of the configured limit back until the configured limit is reached again.
+    """
+
+    def __init__(self, rpm: float, tpm: float,
+                 batch_reserve: float = DEFAULT_BATCH_RESERVE,
+                 decrease_factor: float = 0.5,
+                 increase_fraction: float = 0.02,
+                 min_fraction: float = 0.05,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self.batch_reserve = batch_reserve
+        self.decrease_factor = decrease_factor
+        self.increase_fraction = increase_fraction
+        self.min_fraction = min_fraction
+
+        self.request_bucket = TokenBucket(rpm, clock=clock)
+        self.token_bucket = TokenBucket(tpm, clock=clock)
+        self.rate_fraction = 1.0
+
+        self.waiting_interactive = 0
+        self.throttle_count = 0
+
+    def wait_time(self, tokens: float, priority: str) -> float:
+        """Seconds to wait before the call may be sent, 0 if it may be sent now."""
+        if priority == "batch":
+            # batch traffic leaves a reserve in both buckets and yields to waiting interactive calls
+            if self.waiting_interactive > 0:
+                return 0.05
+            request_reserve = self.request_bucket.capacity * self.batch_reserve
+            token_reserve = self.token_bucket.capacity * self.batch_reserve
+        else:
+            request_reserve, token_reserve = 0.0, 0.0
+
+        return max(self.request_bucket.wait_time(1, reserve=request_reserve),
+                   self.token_bucket.wait_time(tokens, reserve=token_reserve))
+
+    def take(self, tokens: float) -> None:
+        self.request_bucket.take(1)
+        self.token_bucket.take(tokens)
+
+    def on_success(self) -> None:
+        if self.rate_fraction < 1.0:
+            self._set_rate_fraction(self.rate_fraction + self.increase_fraction)
+
+    def on_throttle(self) -> None:
+        self.throttle_count += 1
+        self._set_rate_fraction(self.rate_fraction * self.decrease_factor)
+        # drain the buckets so the next calls wait for the reduced rate
+        self.request_bucket.tokens = min(self.request_bucket.tokens, 0.0)
+        self.token_bucket.tokens = min(self.token_bucket.tokens, 0.0)
+
+    def _set_rate_fraction(self, fraction: float) -> None:
+        self.rate_fraction = min(1.0, max(self.min_fraction, fraction))
+        self.request_bucket.set_rate(self.rpm * self.rate_fraction)
+        self.token_bucket.set_rate(self.tpm * self.rate_fraction)
+
+
+class RateLimiter:
+    """
+    Quota-aware scheduler for model calls with one RPM and one TPM bucket per model.
+
+    Calls go through call (sync) or acall (async). They wait until both buckets of their model
+    allow the request, are retried with jittered exponential backoff on quota errors, and adjust
+    the model's effective rate (AIMD). Interactive calls are always scheduled ahead of batch calls.
+    Clock, sleep and the quota errors are injectable so the limiter can be driven by a fake backend
+    and a simulated clock.
+    """
+
+    def __init__(self,
+                 quotas: Optional[dict[str, tuple[float, float]]] = None,
+                 fallback_quota: tuple[float, float] = FALLBACK_QUOTA,
+                 batch_reserve: float = DEFAULT_BATCH_RESERVE,
+                 max_retries: int = 6,
+                 base_backoff: float = 1.0,
+                 max_backoff: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep,
+                 quota_errors: tuple[type[BaseException], ...] = QUOTA_ERRORS) -> None:
+        self.quotas_config = dict(DEFAULT_MODEL_QUOTAS if quotas is None else quotas)
+        self.fallback_quota = fallback_quota
+        self.batch_reserve = batch_reserve
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.quota_errors = quota_errors
+
+        self._lock = threading.Lock()
+        self._models: dict[str, ModelQuota] = {}
+
+    def set_quota(self, model_name: str, rpm: float, tpm: float) -> None:
+        """Configures the quota of a model (or model name prefix), models now matching it start over with the new quota."""
+        with self._lock:
+            self.quotas_config[model_name] = (rpm, tpm)
+            for name in [name for name in self._models if self._quota_prefix(name) == model_name]:
+                del self._models[name]
+
+    def model_quota(self, model_name: str) -> ModelQuota:
+        with self._lock:
+            if model_name not in self._models:
+                rpm, tpm = self._quota_for(model_name)
+                self._models[model_name] = ModelQuota(rpm=rpm, tpm=tpm, batch_reserve=self.batch_reserve,
+                                                      clock=self.clock)
+            return self._models[model_name]
+
+    def _quota_prefix(self, model_name: str) -> Optional[str]:
+        """The longest configured prefix matching the model, None if only the fallback quota applies."""
+        matches = [prefix for prefix in self.quotas_config if model_name.startswith(prefix)]
+        return max(matches, key=len) if matches else None
+
+    def _quota_for(self, model_name: str) -> tuple[float, float]:
+        prefix = self._quota_prefix(model_name)
+        return self.fallback_quota if prefix is None else self.quotas_config[prefix]
+
+    def _on_throttle(self, quota: ModelQuota) -> None:
+        # rate changes and bucket draining race with _try_acquire otherwise
+        with self._lock:
+            quota.on_throttle()
+
+    def _on_success(self, quota: ModelQuota) -> None:
+        with self._lock:
+            quota.on_success()
+
+    def _try_acquire(self, quota: ModelQuota, tokens: float, priority: str) -> float:
+        with self._lock:
+            wait = quota.wait_time(tokens, priority)
+            if wait == 0:
+                quota.take(tokens)
+            return wait
+
+    def _track_interactive(self, quota: ModelQuota, priority: str, delta: int) -> None:
+        if priority == "interactive":
+            with self._lock:
+                quota.waiting_interactive += delta
+
+    def _poll_interval(self, wait: float) -> float:
+        # re-check at least every second (rates change on throttling), but never spin on tiny waits
+        return min(max(wait, 0.01), 1.0)
+
+    def _backoff(self, attempt: int) -> float:
+        backoff = min(self.max_backoff, self.base_backoff * 2 ** attempt)
+        return backoff * random.uniform(0.5, 1.5)
+
+    def try_acquire(self, model_name: str, tokens: float, priority: str = "batch") -> bool:
+        """Takes a request of tokens from the model quota if it allows one right now, never waits."""
+        return self._try_acquire(self.model_quota(model_name), tokens, priority) == 0
+
+    def acquire(self, model_name: str, tokens: float, priority: str = "batch") -> None:
+        """Blocks until the model quota allows a request of tokens."""
+        quota = self.model_quota(model_name)
+        self._track_interactive(quota, priority, 1)
+        try:
+            while (wait := self._try_acquire(quota, tokens, priority)) > 0:
+                self.sleep(self._poll_interval(wait))
+        finally:
+            self._track_interactive(quota, priority, -1)
+
+    async def aacquire(self, model_name: str, tokens: float, priority: str = "batch") -> None:
+        """Async variant of acquire."""
+        quota = self.model_quota(model_name)
+        self._track_interactive(quota, priority, 1)
+        try:
+            while (wait := self._try_acquire(quota, tokens, priority)) > 0:
+                await asyncio.sleep(self._poll_interval(wait))
+        finally:
+            self._track_interactive(quota, priority, -1)
+
+    def call(self, model_name: str, fn: Callable[[], Any], tokens: float = 0, priority: str = "batch") -> Any:
+        """Runs fn within the model quota, retrying quota errors with jittered exponential backoff."""
+        quota = self.model_quota(model_name)
+        for attempt in range(self.max_retries + 1):
+            self.acquire(model_name, tokens, priority)
+            try:
+                result = fn()
+            except self.quota_errors:
+                self._on_throttle(quota)
+                if attempt >= self.max_retries:
+                    raise
+                backoff = self._backoff(attempt)
+                print(f"Quota exceeded for {model_name}, retry {attempt + 1}/{self.max_retries} in {backoff:.1f}s")
+                self.sleep(backoff)
+                continue
+            self._on_success(quota)
+            return result
+
+    async def acall(self, model_name: str, fn: Callable[[], Awaitable[Any]], tokens: float = 0, priority: str = "batch") -> Any:
+        """Async variant of call, fn returns a fresh awaitable per attempt."""
+        quota = self.model_quota(model_name)
+        for attempt in range(self.max_retries + 1):
+            await self.aacquire(model_name, tokens, priority)
+            try:
+                result = await fn()
+            except self.quota_errors:
+                self._on_throttle(quota)
+                if attempt >= self.max_retries:
+                    raise
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            self._on_success(quota)
+            return result
+
+
+_default_rate_limiter: Optional[RateLimiter] = None
+_default_lock = threading.Lock()
+
+
+def default_rate_limiter() -> RateLimiter:
+    """Process wide rate limiter shared by all LLM sessions, configured from the environment or .env (see quota_config)."""
+    global _default_rate_limiter
+    with _default_lock:
+        if _default_rate_limiter is None:
+            quotas, fallback_quota, batch_reserve = quota_config({**dotenv_values(".env"), **os.environ})
+            _default_rate_limiter = RateLimiter(quotas=quotas, fallback_quota=fallback_quota,
+                                                batch_reserve=batch_reserve)
+        return _default_rate_limiter
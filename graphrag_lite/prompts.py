@@ -317,4 +317,56 @@ GLOBAL_SEARCH_REDUCE_QUERY = """
 {user_query}
 
 Mardown style commentary to the user question factually based on the analyst reports as appropriate for the defined length and format:
-"""
\ No newline at end of file
+"""
+
+LOCAL_SEARCH_SYSTEM = """
+---Role---
+
+You are a helpful assistant responding to questions about a dataset using the entities, relationships and community reports provided as context.
+
+
+---Goal---
+
+Generate a response of the target length and format that responds to the user's question, summarizing all information in the provided data tables appropriate for the response length and format.
+
+The data tables are ranked in the **descending order of relevance** to the user question.
+
+If you don't know the answer or if the provided data tables do not contain sufficient information to provide an answer, just say so. Do not make anything up.
+
+Points supported by data should list their data references as follows:
+
+"This is an example sentence supported by multiple data references [Data: Entities (PERSON X); Relationships (PERSON X -> COMPANY Y); Reports (COMMUNITY TITLE)]."
+
+**Do not list more than 5 record ids in a single reference**. Instead, list the top 5 most relevant record ids and add "+more" to indicate that there are more.
+
+Do not include information where the supporting evidence for it is not provided.
+
+
+---Target response length and format---
+
+{response_type}
+
+"""
+
+LOCAL_SEARCH_QUERY = """
+---Entities---
+
+{entity_data}
+
+
+---Relationships---
+
+{relationship_data}
+
+
+---Community Reports---
+
+{report_data}
+
+
+---User Question---
+
+{user_query}
+
+Mardown style response to the user question factually based on the data tables as appropriate for the defined length and format:
+"""
@@ -4,11 +4,12 @@ import logging
 import traceback
 import os
 import ast
+import asyncio
 
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 
-from langfuse.decorators import observe, langfuse_context
+from graphrag_lite.Observability import observe, obs_context
 from dotenv import dotenv_values
 
 
@@ -26,7 +27,7 @@ def generate_response(c, kg: NoSQLKnowledgeGraph):
     print(f"Unwrapped Community Record: {c}")
 
     extractor = GraphExtractor(graph_db=kg)
-    comm_data = extractor.async_generate_comm_report(c=c)
+    comm_data = extractor.async_generate_comm_report(comm_members=c)
     return comm_data
 
 
@@ -73,18 +74,23 @@ async def trigger_analysis(request: Request):
     print(f"Received Pub/Sub message for Analysis: {message_dict}")
 
     try:
-        comm_report = generate_response(
+        # report generation does blocking graph reads and llm calls, keep them off the event loop
+        comm_report = await asyncio.to_thread(
+            generate_response,
             c=community_record,
             kg=fskg
         )
 
-        fskg.store_community(community=comm_report)
+        await asyncio.to_thread(fskg.store_community, community=comm_report)
 
         print("comm report done")
-        langfuse_context.flush()
         return JSONResponse(content={"message": "File analysis completed successfully!"}, status_code=200)
     except Exception as e:
         msg = f"Something went wrong during comm reporting: {e}"
         logging.error(msg)
         traceback.print_exc()
         return JSONResponse(content={"message": msg}, status_code=500)
+    finally:
+        # cloud run throttles the cpu once the response is sent, export sampled traces before that
+        if obs_context.has_pending_exports():
+            await asyncio.to_thread(obs_context.flush, blocking=True)
@@ -3,13 +3,16 @@ import json
 import logging
 import traceback
 import os
+import hashlib
+import asyncio
 
-from LLMSession import LLMSession
+from graphrag_lite.LLMSession import LLMSession
+from graphrag_lite.ModelRouter import default_model_router, valid_json_response
 
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 
-from langfuse.decorators import observe, langfuse_context
+from graphrag_lite.Observability import observe, obs_context
 from dotenv import dotenv_values
 
 import firebase_admin
@@ -21,6 +24,15 @@ import google.auth
 
 app = FastAPI()
 
+model_router = default_model_router()
+
+
+def report_rating(community_report: dict) -> float:
+    try:
+        return float(community_report.get("rating", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
 """Prompt templates for global search pipe."""
 
 MAP_SYSTEM_PROMPT = """
@@ -52,20 +64,43 @@ Call extract_json_schema with the question response and context relevance score.
 ---Question Response & Context Relevance Score---
 """
 
+MAP_BATCH_SYSTEM_PROMPT = """
+---Role---
+You are an expert agent answering questions based on context that is organized as a knowledge graph.
+You will be provided with several community reports extracted from that same knowledge graph.
+
+---Goal---
+For every community report, generate a response consisting of a list of key points that responds to the user's question, summarizing all relevant information in that community report.
+
+Use only the data of the respective community report as context for its response, never mix information across reports.
+If you don't know the answer or if a community report does not contain sufficient information to provide an answer respond "The user question cannot be answered based on the given community context." for that report.
+
+Your response should contain exactly one element per community report with:
+- Community: The title of the community report exactly as given.
+- Query based response: A comprehensive and truthful response to the given user query, solely based on that community report.
+- Importance Score: An integer score between 0-10 that indicates how important the point is in answering the user's question. An 'I don't know' type of response should have a score of 0.
+
+"""
+
+MAP_BATCH_QUERY_PROMPT = """
+---Context Community Reports---
+{context_community_reports}
+
+---User Question---
+{user_question}
+
+---Question Responses & Context Relevance Scores per Community Report---
+"""
+
 @observe()
-def generate_response(client_query: str, community_report: dict):
+async def generate_response(client_query: str, community_report: dict):
 
-    langfuse_context.update_current_trace(
+    obs_context.update_current_trace(
         name="Community Intermediate Query Gen",
         session_id=client_query,
         public=False
     )
 
-    llm = LLMSession(
-        system_message=MAP_SYSTEM_PROMPT,
-        model_name="gemini-1.5-pro-001"
-    )
-
     # llm_flash = LLMSession(
     #     system_message=MAP_SYSTEM_PROMPT,
     #     model_name="gemini-1.5-flash-001"
@@ -89,35 +124,160 @@ def generate_response(client_query: str, community_report: dict):
     query_prompt = MAP_QUERY_PROMPT.format(
         context_community_report=community_report, user_question=client_query)
 
-    response = llm.generate(client_query_string=query_prompt,
-                 response_schema=response_schema,
-                 response_mime_type="application/json")
+    async def answer(model_name: str) -> str:
+        llm = LLMSession.get(
+            system_message=MAP_SYSTEM_PROMPT,
+            model_name=model_name,
+            priority="interactive"
+        )
+        return await llm.agenerate(client_query_string=query_prompt,
+                                   response_schema=response_schema,
+                                   response_mime_type="application/json",
+                                   stage="map")
+
+    # high rated communities go to the large model, malformed or low confidence answers are re-run on it
+    rating = report_rating(community_report)
+    model_name = model_router.route("map",
+                                    input_tokens=LLMSession.estimate_tokens(query_prompt),
+                                    community_rating=rating)
+    response = await model_router.acall_with_escalation(
+        "map", model_name, answer,
+        validate=lambda r: valid_json_response(
+            r, required_keys=["response"],
+            confident=lambda item: not model_router.low_confidence(item.get("score"), rating)))
 
     # response = llm_flash.function_call_gen(client_query_string=query_prompt,
     #                                  response_schema=response_schema)
     
     print(f"Response for Community: {community_report["title"]} & Query: {client_query}: {response}")
 
-    langfuse_context.flush()
     return response
 
 
-def store_in_fs(response: str, user_query: str, community_report: dict) -> None:
+@observe()
+async def generate_batch_response(client_query: str, community_reports: list[dict]) -> list[dict]:
+    """Answers the user query for several community reports with one structured LLM call."""
+
+    obs_context.update_current_trace(
+        name="Community Intermediate Batch Query Gen",
+        session_id=client_query,
+        public=False
+    )
+
+    response_schema = {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "community": {
+                    "type": "string",
+                    "description": "The title of the community report exactly as given.",
+                },
+                "response": {
+                    "type": "string",
+                    "description": "The response to the user question based on this community report as raw string.",
+                },
+                "score": {
+                    "type": "number",
+                    "description": "The relevance score of this community report towards answering the user question [0.0, 10.0]",
+                },
+            },
+            "required": ["community", "response", "score"],
+        },
+    }
+
+    context_community_reports = "\n\n".join(
+        f"----- Community Report: {c['title']} -----\n{json.dumps(c)}" for c in community_reports)
+
+    query_prompt = MAP_BATCH_QUERY_PROMPT.format(
+        context_community_reports=context_community_reports, user_question=client_query)
+
+    async def answer(model_name: str) -> str:
+        llm = LLMSession.get(
+            system_message=MAP_BATCH_SYSTEM_PROMPT,
+            model_name=model_name,
+            priority="interactive"
+        )
+        return await llm.agenerate(client_query_string=query_prompt,
+                                   response_schema=response_schema,
+                                   response_mime_type="application/json",
+                                   stage="map")
+
+    # a batch goes to the large model if any of its communities is high rated,
+    # answers that are malformed, skip communities or have low confidence are re-run on it
+    ratings = {c["title"]: report_rating(c) for c in community_reports}
+    model_name = model_router.route("map",
+                                    input_tokens=LLMSession.estimate_tokens(query_prompt),
+                                    community_rating=max(ratings.values()))
+    response = await model_router.acall_with_escalation(
+        "map", model_name, answer,
+        validate=lambda r: valid_json_response(
+            r, required_keys=["community", "response"], min_items=len(community_reports),
+            confident=lambda item: not model_router.low_confidence(item.get("score"),
+                                                                   ratings.get(str(item.get("community"))))))
+
+    try:
+        response_items = json.loads(response)
+    except json.JSONDecodeError as e:
+        logging.error(f"Error {e} while decoding JSON batch response: {response}")
+        response_items = None
+    if not isinstance(response_items, list):
+        # no usable batch answer (even after escalation), placeholders would hide the failure in the quorum
+        print(f"Batch response unusable, answering {len(community_reports)} communities one by one")
+        return await generate_single_records(client_query=client_query, community_reports=community_reports)
+
+    answered = {str(item.get("community")): item for item in response_items if isinstance(item, dict)}
+    records = [{"community": c["title"],
+                "response": answered[c["title"]].get("response", ""),
+                "score": answered[c["title"]].get("score", 0)}
+               for c in community_reports if c["title"] in answered]
+    print(f"Batch response for {len(records)} communities & Query: {client_query}: {list(answered.keys())}")
+
+    # communities the model skipped are asked again one by one instead of being counted as unanswerable
+    missing = [c for c in community_reports if c["title"] not in answered]
+    if missing:
+        print(f"Batch response skipped {len(missing)} communities, answering them one by one")
+        records += await generate_single_records(client_query=client_query, community_reports=missing)
+
+    return records
+
+
+async def generate_single_records(client_query: str, community_reports: list[dict]) -> list[dict]:
+    """
+    Answers every community report with its own LLM call, the fallback for an unusable batch response
+    and for communities a batch response skipped.
+
+    Like store_in_fs, a community whose answer can not be decoded gets no record. If no answer can be
+    decoded at all an error is raised, so the message is redelivered.
+    """
+    responses = await asyncio.gather(*(generate_response(client_query=client_query, community_report=c)
+                                       for c in community_reports))
+    records = []
+    for c, response in zip(community_reports, responses):
+        try:
+            response_dict = json.loads(response)
+        except json.JSONDecodeError as e:
+            logging.error(f"Error {e} while decoding JSON response: {response}")
+            continue
+        records.append({
+            "community": c["title"],
+            "response": response_dict.get("response", ""),
+            "score": response_dict.get("score", 0)
+        })
+    if community_reports and not records:
+        raise ValueError(f"No decodable response for any of {len(community_reports)} communities.")
+    return records
+
+
+def store_in_fs(response: str, query_id: str, community_report: dict) -> None:
     """
     Stores the LLM response in Firestore.
 
     Args:
         response (str): The JSON formatted LLM response.
-        user_query (str): The original user query.
+        query_id (str): The id of the query request.
         community_report (dict): The community report used for the response.
     """
-    secrets = dotenv_values(".env")
-    gcp_credentials, project_id = google.auth.load_credentials_from_file(str(secrets["GCP_CREDENTIAL_FILE"]))
-
-    db = firestore.Client(project=project_id,  # type: ignore
-                           credentials=gcp_credentials, 
-                           database=str(secrets["QUERY_FS_DB_ID"]))  
-
     # Extract community title for structuring data
     community_title = community_report.get("title", "Unknown Community")
 
@@ -129,26 +289,46 @@ def store_in_fs(response: str, user_query: str, community_report: dict) -> None:
         logging.error(f"Error {e} while decoding JSON response: {response}")
         return  # Exit early on error
 
-    # Prepare data for Firestore
-    refreshed_data = {
+    store_records_in_fs(records=[{
         "community": community_title,
         "response": response_dict.get("response", ""),
         "score": response_dict.get("score", 0)
-    }
+    }], query_id=query_id)
+
 
-    # Get a reference to the document (using user_query as key)
-    doc_ref = db.collection(secrets["QUERY_FS_INT__RESPONSE_COLL"]).document(user_query)  # Use collection ID from .env
+def store_records_in_fs(records: list[dict], query_id: str) -> None:
+    """
+    Stores intermediate community responses of one query request in Firestore.
+
+    Every community response is written as its own document below the query request
+    (<collection>/<query_id>/responses/<community>), so workers never read or contend
+    on a shared document. All records are committed in one write batch.
+
+    Args:
+        records (list[dict]): Intermediate responses with community, response and score.
+        query_id (str): The id of the query request.
+    """
+    secrets = dotenv_values(".env")
+    gcp_credentials, project_id = google.auth.load_credentials_from_file(str(secrets["GCP_CREDENTIAL_FILE"]))
 
-    # Get the existing data if any
-    doc_snapshot = doc_ref.get()
-    existing_data = doc_snapshot.to_dict() if doc_snapshot.exists else {}
+    db = firestore.Client(project=project_id,  # type: ignore
+                           credentials=gcp_credentials, 
+                           database=str(secrets["QUERY_FS_DB_ID"]))  
 
-    existing_data[community_title] = refreshed_data
+    responses_coll = (db.collection(secrets["QUERY_FS_INT__RESPONSE_COLL"])  # Use collection ID from .env
+                      .document(query_id)
+                      .collection("responses"))
 
-    # Update the document with the new list
-    doc_ref.set(existing_data, merge=True)
+    # Blind writes, retried deliveries of the same message overwrite their own records
+    batch = db.batch()
+    for record in records:
+        # community titles may contain characters that are not allowed in document ids
+        community_doc_id = hashlib.sha1(record["community"].encode("utf-8")).hexdigest()
+        batch.set(responses_coll.document(community_doc_id),
+                  {**record, "created_at": firestore.SERVER_TIMESTAMP})
+    batch.commit()
 
-    logging.info(f"Stored response for query '{user_query}' and community '{community_title}' in Firestore.")
+    logging.info(f"Stored {len(records)} responses for query request '{query_id}' in Firestore.")
     print("saving in fs done")
 
 
@@ -181,12 +361,23 @@ async def trigger_analysis(request: Request):
     print(f"Received Pub/Sub message for Analysis: {message_dict}")
 
     try:
-        response_json = generate_response(
-            client_query=message_dict["user_query"],
-            community_report=message_dict["community_report"]
-        )
-
-        store_in_fs(response=response_json, user_query=message_dict["user_query"], community_report=message_dict["community_report"])
+        if "community_reports" in message_dict:
+            # batched map request covering several communities
+            records = await generate_batch_response(
+                client_query=message_dict["user_query"],
+                community_reports=message_dict["community_reports"]
+            )
+
+            # blocking firestore client runs off the event loop
+            await asyncio.to_thread(store_records_in_fs, records=records, query_id=message_dict["query_id"])
+        else:
+            response_json = await generate_response(
+                client_query=message_dict["user_query"],
+                community_report=message_dict["community_report"]
+            )
+
+            await asyncio.to_thread(store_in_fs, response=response_json, query_id=message_dict["query_id"],
+                                    community_report=message_dict["community_report"])
 
         print("analysis done")
         return JSONResponse(content={"message": "File analysis completed successfully!"}, status_code=200)
@@ -195,6 +386,10 @@ async def trigger_analysis(request: Request):
         logging.error(msg)
         traceback.print_exc()
         return JSONResponse(content={"message": msg}, status_code=500)
+    finally:
+        # cloud run throttles the cpu once the response is sent, export sampled traces before that
+        if obs_context.has_pending_exports():
+            await asyncio.to_thread(obs_context.flush, blocking=True)
 
 
 # if __name__ == "__main__":
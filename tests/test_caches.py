@@ -0,0 +1,61 @@
+import itertools
+import time
+
+import pytest
+
+from graphrag_lite.LLMCache import LLMResponseCache
+from graphrag_lite.OCRCache import PageOCRCache
+
+
+@pytest.fixture
+def ticking_clock(monkeypatch):
+    """Every time.time() call is one second later, so access order is never a tie."""
+    ticks = itertools.count(1)
+    monkeypatch.setattr(time, "time", lambda: float(next(ticks)))
+
+
+def test_page_ocr_cache_evicts_least_recently_used_pages(tmp_path, ticking_clock):
+    cache = PageOCRCache(str(tmp_path), max_bytes=30)
+    cache.put_many({"a": "x" * 10, "b": "x" * 10, "c": "x" * 10})
+    # reading a makes b the least recently used page
+    assert cache.get_many(["a"]) == {"a": "x" * 10}
+
+    cache.put_many({"d": "x" * 10})
+
+    assert cache.get_many(["a", "b", "c", "d"]) == {"a": "x" * 10, "c": "x" * 10, "d": "x" * 10}
+    stats = cache.stats()
+    assert stats["evictions"] == 1
+    assert stats["entries"] == 3
+    assert stats["bytes"] == 30
+    assert (stats["hits"], stats["misses"]) == (4, 1)
+
+
+def test_page_ocr_cache_persists_across_instances(tmp_path):
+    PageOCRCache(str(tmp_path)).put_many({"page": "text"})
+
+    assert PageOCRCache(str(tmp_path)).get_many(["page", "other"]) == {"page": "text"}
+
+
+def test_llm_response_cache_evicts_least_recently_used_responses(tmp_path, ticking_clock):
+    record = {"text": "x" * 8}
+    cache = LLMResponseCache(str(tmp_path), max_bytes=3 * len('{"text": "xxxxxxxx"}'))
+    keys = [LLMResponseCache.make_key("gemini-1.5-flash-001", "system", [f"query {i}"], {}) for i in range(4)]
+    for key in keys[:3]:
+        cache.put(key, record)
+    assert cache.get(keys[0]) == record
+
+    cache.put(keys[3], record)
+
+    assert cache.get(keys[1]) is None
+    assert all(cache.get(key) == record for key in (keys[0], keys[2], keys[3]))
+    assert cache.stats()["evictions"] == 1
+
+
+def test_llm_response_cache_key_covers_all_inputs():
+    key = LLMResponseCache.make_key("m", "system", ["q"], {"temperature": 0.2})
+
+    assert key == LLMResponseCache.make_key("m", "system", ["q"], {"temperature": 0.2})
+    assert key != LLMResponseCache.make_key("m", "system", ["q"], {"temperature": 0.3})
+    assert key != LLMResponseCache.make_key("m", "other system", ["q"], {"temperature": 0.2})
+    assert key != LLMResponseCache.make_key("m", "system", ["q"], {"temperature": 0.2},
+                                            response_schema={"type": "object"})
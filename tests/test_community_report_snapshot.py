@@ -0,0 +1,100 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from graphrag_lite.CommunityReportCache import CommunityReportSnapshot
+
+
+class FakeWatch:
+    def __init__(self):
+        self.is_active = True
+        self.unsubscribed = False
+
+    def unsubscribe(self):
+        self.unsubscribed = True
+        self.is_active = False
+
+
+class FakeCollection:
+    def __init__(self):
+        self.streams = 0
+        self.watches = []
+        self.callback = None
+
+    def stream(self):
+        self.streams += 1
+        return []
+
+    def on_snapshot(self, callback):
+        self.callback = callback
+        self.watches.append(FakeWatch())
+        return self.watches[-1]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(time, "time", lambda: now.value)
+    return now
+
+
+def snapshot(coll, listen_for_changes=True):
+    fskg = SimpleNamespace(db=SimpleNamespace(collection=lambda coll_id: coll))
+    return CommunityReportSnapshot(fskg, "communities", ttl_seconds=60, listen_for_changes=listen_for_changes)
+
+
+def test_running_listener_keeps_the_snapshot_past_the_ttl(clock):
+    coll = FakeCollection()
+    reports = snapshot(coll)
+    reports.reports()
+
+    clock.value += 3600
+    reports.reports()
+
+    assert coll.streams == 1
+    assert len(coll.watches) == 1
+
+
+def test_ttl_reloads_without_listener(clock):
+    coll = FakeCollection()
+    reports = snapshot(coll, listen_for_changes=False)
+    reports.reports()
+
+    clock.value += 30
+    reports.reports()
+    assert coll.streams == 1
+
+    clock.value += 31
+    reports.reports()
+    assert coll.streams == 2
+    assert coll.watches == []
+
+
+def test_stopped_listener_falls_back_to_ttl_and_is_reattached(clock):
+    coll = FakeCollection()
+    reports = snapshot(coll)
+    reports.reports()
+
+    coll.watches[0].is_active = False
+    clock.value += 61
+    reports.reports()
+
+    assert coll.streams == 2
+    assert coll.watches[0].unsubscribed
+    assert len(coll.watches) == 2
+
+
+def test_failed_listener_callback_falls_back_to_ttl(clock):
+    coll = FakeCollection()
+    reports = snapshot(coll)
+    reports.reports()
+
+    broken_change = SimpleNamespace(type=SimpleNamespace(name="MODIFIED"),
+                                    document=SimpleNamespace(id="c1", to_dict=lambda: None))
+    coll.callback(None, [broken_change], None)
+    clock.value += 61
+    reports.reports()
+
+    assert coll.streams == 2
+    assert len(coll.watches) == 2
@@ -0,0 +1,93 @@
+import asyncio
+import threading
+import time
+
+from graphrag_lite.LLMBackend import FakeBackend, heavy_tailed_latency
+from graphrag_lite.LLMSession import LLMSession
+from graphrag_lite.async_utils.hedging import HedgePolicy
+from graphrag_lite.async_utils.rate_limiter import RateLimiter
+
+
+def make_session(policy, seed=0, median=0.01, sigma=1.2, rate_limiter=None):
+    backend = FakeBackend(latency=heavy_tailed_latency(median=median, sigma=sigma), seed=seed)
+    session = LLMSession("system", "gemini-1.5-flash-001", backend=backend, hedge_policy=policy)
+    session.rate_limiter = rate_limiter or RateLimiter(quotas={"gemini": (10**7, 10**9)})
+    return session, backend
+
+
+def async_latencies(session, n=400, fan_out=20):
+    latencies = []
+
+    async def one(i):
+        start = time.perf_counter()
+        await session.agenerate(f"query {i}", stage="map")
+        latencies.append(time.perf_counter() - start)
+
+    async def main():
+        for chunk in range(0, n, fan_out):
+            await asyncio.gather(*(one(i) for i in range(chunk, chunk + fan_out)))
+
+    asyncio.run(main())
+    return sorted(latencies)
+
+
+def p99(latencies):
+    return latencies[int(len(latencies) * 0.99)]
+
+
+def test_hedging_cuts_tail_latency_on_heavy_tailed_backend():
+    unhedged, _ = make_session(None, seed=1)
+    policy = HedgePolicy(percentile=90, max_extra_fraction=0.15)
+    hedged, _ = make_session(policy, seed=1)
+
+    baseline = async_latencies(unhedged)
+    with_hedging = async_latencies(hedged)
+
+    stats = policy.stats()
+    assert stats["hedged"] > 0
+    assert stats["hedge_wins"] > 0
+    assert stats["extra_token_fraction"] <= 0.15
+    assert p99(with_hedging) < p99(baseline)
+
+
+def concurrent_callers_elapsed(session, callers=64, calls=5):
+    def caller(t):
+        for i in range(calls):
+            session.generate(f"query {t}/{i}", stage="map")
+
+    # warm up the latency histogram
+    caller("warmup")
+    start = time.perf_counter()
+    threads = [threading.Thread(target=caller, args=(t,)) for t in range(callers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+
+def test_sync_hedging_does_not_queue_concurrent_callers():
+    unhedged, _ = make_session(None, seed=2, median=0.2, sigma=0.5)
+    policy = HedgePolicy(percentile=90, max_extra_fraction=0.15, min_samples=5)
+    hedged, _ = make_session(policy, seed=2, median=0.2, sigma=0.5)
+
+    baseline = concurrent_callers_elapsed(unhedged)
+    elapsed = concurrent_callers_elapsed(hedged)
+
+    # callers queued behind each other on a bounded pool take several times longer
+    assert elapsed < 1.5 * baseline
+    assert policy.stats()["requests"] == 5 + 64 * 5
+
+
+def test_duplicates_take_their_own_rate_limiter_slot():
+    # a frozen clock never refills the buckets, so every taken slot stays visible
+    rate_limiter = RateLimiter(quotas={"gemini": (1000, 10**9)}, clock=lambda: 0.0)
+    policy = HedgePolicy(percentile=50, max_extra_fraction=1.0, min_samples=5)
+    session, backend = make_session(policy, seed=3, rate_limiter=rate_limiter)
+
+    for i in range(100):
+        session.generate(f"query {i}", stage="map")
+
+    quota = rate_limiter.model_quota("gemini-1.5-flash-001")
+    assert policy.stats()["hedged"] > 0
+    assert 1000 - quota.request_bucket.tokens == backend.call_count
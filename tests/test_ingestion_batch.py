@@ -0,0 +1,116 @@
+import threading
+
+import pytest
+
+from graphrag_lite.IngestionSession import IngestionBatch, IngestionSession
+from graphrag_lite.TokenBudget import TokenBudget, check_budgets, record_usage
+
+
+class FakeIngestion(IngestionSession):
+    """IngestionSession without clients, post-processing spends post_process_tokens on the active budgets."""
+
+    def __init__(self, post_process_tokens: int = 0):
+        self.secrets = {}
+        self.streaming = False
+        self._batch = None
+        self.post_process_tokens = post_process_tokens
+        self.post_processed = 0
+        self.post_processed_event = threading.Event()
+
+    def document_budget(self, name, max_tokens=None, max_cost_usd=None) -> TokenBudget:
+        return TokenBudget(name=name, max_tokens=max_tokens, max_cost_usd=max_cost_usd)
+
+    def _run_post_process(self, async_comm_reports: bool = True) -> None:
+        check_budgets("reports", "gemini-1.5-flash-001", self.post_process_tokens)
+        record_usage("reports", "gemini-1.5-flash-001", self.post_process_tokens, 0)
+        self.post_processed += 1
+        self.post_processed_event.set()
+
+
+def test_batch_defers_post_processing_to_one_finalize():
+    ingestion = FakeIngestion()
+
+    with ingestion.batch() as batch:
+        for _ in range(3):
+            ingestion.post_process()
+        # a nested batch joins the active one
+        with ingestion.batch() as nested:
+            assert nested is batch
+        assert ingestion.post_processed == 0
+        assert batch.dirty
+
+    assert ingestion.post_processed == 1
+    assert batch.finalize_count == 1
+    assert not batch.dirty
+
+
+def test_clean_batch_does_not_post_process():
+    ingestion = FakeIngestion()
+    callbacks = []
+
+    with ingestion.batch() as batch:
+        batch.after_finalize(lambda: callbacks.append("run right away"))
+
+    assert ingestion.post_processed == 0
+    assert callbacks == ["run right away"]
+
+
+def test_after_finalize_waits_for_post_processing():
+    ingestion = FakeIngestion()
+    callbacks = []
+
+    with ingestion.batch() as batch:
+        batch.mark_dirty()
+        batch.after_finalize(lambda: callbacks.append(ingestion.post_processed))
+        assert callbacks == []
+
+    assert callbacks == [1]
+
+
+def test_budget_exceeded_keeps_the_batch_dirty():
+    ingestion = FakeIngestion(post_process_tokens=500)
+    batch = IngestionBatch(ingestion, max_tokens=100)
+    callbacks = []
+
+    batch.mark_dirty()
+    batch.after_finalize(lambda: callbacks.append("merged"))
+
+    assert batch.finalize() is False
+    assert batch.dirty
+    assert batch.finalize_count == 0
+    assert callbacks == []
+
+    # the next finalize with enough budget retries the changes and runs the queued callbacks
+    batch.max_tokens = 1000
+    assert batch.finalize() is True
+    assert not batch.dirty
+    assert ingestion.post_processed == 1
+    assert callbacks == ["merged"]
+
+
+def test_failed_post_processing_is_retried():
+    ingestion = FakeIngestion()
+    batch = IngestionBatch(ingestion)
+    batch.mark_dirty()
+
+    def fail(async_comm_reports=True):
+        raise RuntimeError("firestore unavailable")
+
+    ingestion._run_post_process, run_post_process = fail, ingestion._run_post_process
+    with pytest.raises(RuntimeError):
+        batch.finalize()
+    assert batch.dirty
+
+    ingestion._run_post_process = run_post_process
+    assert batch.finalize() is True
+
+
+def test_debounced_finalize_runs_in_the_background():
+    ingestion = FakeIngestion()
+    batch = IngestionBatch(ingestion, debounce_seconds=0.01)
+
+    batch.mark_dirty()
+
+    assert ingestion.post_processed_event.wait(timeout=10)
+    assert ingestion.post_processed == 1
+    assert not batch.dirty
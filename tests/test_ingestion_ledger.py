@@ -0,0 +1,108 @@
+from graphrag_lite.IngestionLedger import IngestionLedger
+from graphrag_lite.IngestionPipeline import IngestionPipeline
+from graphrag_lite.IngestionSession import IngestionSession
+from graphrag_lite.TokenBudget import TokenBudget
+
+GRAPH_A = "project/db/nodes-a/edges-a/communities-a"
+GRAPH_B = "project/db/nodes-b/edges-b/communities-b"
+
+
+class FakeIngestion(IngestionSession):
+    """IngestionSession recording its calls instead of uploading, OCR'ing and extracting."""
+
+    def __init__(self, fail_extraction_of: str = ""):
+        self.secrets = {}
+        self.streaming = False
+        self._batch = None
+        self.fail_extraction_of = fail_extraction_of
+        self.calls = []
+
+    def document_budget(self, name, max_tokens=None, max_cost_usd=None) -> TokenBudget:
+        return TokenBudget(name=name, max_tokens=max_tokens, max_cost_usd=max_cost_usd)
+
+    def upload(self, new_file_name, file_to_ingest=None, ingest_local_file=False):
+        self.calls.append(("upload", new_file_name))
+
+    def ocr(self, new_file_name, file_to_ingest=None, ingest_local_file=False):
+        self.calls.append(("ocr", new_file_name))
+        return f"text of {new_file_name}"
+
+    def extract(self, document_string):
+        self.calls.append(("extract", document_string))
+        if self.fail_extraction_of and self.fail_extraction_of in document_string:
+            raise RuntimeError("extraction failed")
+        self._batch.mark_dirty()
+        return True
+
+    def _run_post_process(self, async_comm_reports=True):
+        self.calls.append(("post_process", None))
+
+
+PARTS = [("doc-part1.pdf", b"%PDF part one"), ("doc-part2.pdf", b"%PDF part two")]
+
+
+def ingest(ledger, ingestion):
+    pipeline = IngestionPipeline(ingestion=ingestion, ledger=ledger)
+    return pipeline(parts=PARTS, document_hash=IngestionLedger.content_hash(b"%PDF document"),
+                    document_name="doc.pdf")
+
+
+def test_ledger_persists_documents_stages_and_artifacts(tmp_path):
+    ledger = IngestionLedger(str(tmp_path), graph_target=GRAPH_A)
+    ledger.mark_stage("part", "doc-part1.pdf", "uploaded")
+    ledger.mark_stage("part", "doc-part1.pdf", "ocr")
+    ledger.store_text("part", "ocr", "page text")
+    ledger.complete_document("doc", name="doc.pdf", num_parts=1)
+
+    reopened = IngestionLedger(str(tmp_path), graph_target=GRAPH_A)
+    assert reopened.part_stages("part") == {"uploaded", "ocr"}
+    assert reopened.load_text("part", "ocr") == "page text"
+    assert reopened.completed_document("doc") == "doc.pdf"
+    assert reopened.completed_document("other") is None
+
+
+def test_ledger_is_kept_per_graph_target(tmp_path):
+    ledger_a = IngestionLedger(str(tmp_path), graph_target=GRAPH_A)
+    ledger_a.mark_stage("part", "doc-part1.pdf", "extracted")
+    ledger_a.complete_document("doc", name="doc.pdf", num_parts=1)
+
+    ledger_b = IngestionLedger(str(tmp_path), graph_target=GRAPH_B)
+    assert ledger_b.completed_document("doc") is None
+    assert ledger_b.part_stages("part") == set()
+    assert ledger_b.stats()["documents"] == 0
+    assert IngestionLedger(str(tmp_path), graph_target=GRAPH_A).completed_document("doc") == "doc.pdf"
+
+
+def test_pipeline_resumes_from_part_checkpoints(tmp_path):
+    ledger = IngestionLedger(str(tmp_path), graph_target=GRAPH_A)
+
+    # the second part fails, the document is not recorded as ingested
+    first = FakeIngestion(fail_extraction_of="doc-part2")
+    results = ingest(ledger, first)
+    assert [r.error is None for r in results] == [True, False]
+    assert ledger.completed_document(IngestionLedger.content_hash(b"%PDF document")) is None
+    assert ledger.part_stages(results[0].part_hash) == {"uploaded", "ocr", "extracted", "merged"}
+    assert ledger.part_stages(results[1].part_hash) == {"uploaded", "ocr"}
+
+    # the re-run only extracts the failed part, from its stored OCR text
+    second = FakeIngestion()
+    results = ingest(ledger, second)
+    assert all(r.error is None for r in results)
+    assert second.calls == [("extract", "text of doc-part2.pdf"), ("post_process", None)]
+    assert set(results[0].skipped) == {"uploaded", "ocr", "extracted", "merged"}
+    assert set(results[1].skipped) == {"uploaded", "ocr"}
+    assert ledger.completed_document(IngestionLedger.content_hash(b"%PDF document")) == "doc.pdf"
+
+
+def test_completed_document_is_not_ingested_into_the_same_graph_again(tmp_path):
+    ingest(IngestionLedger(str(tmp_path), graph_target=GRAPH_A), FakeIngestion())
+
+    again = FakeIngestion()
+    results = ingest(IngestionLedger(str(tmp_path), graph_target=GRAPH_A), again)
+    assert all(set(r.skipped) == {"uploaded", "ocr", "extracted", "merged"} for r in results)
+    assert again.calls == []
+
+    # another graph gets the whole document
+    other_graph = FakeIngestion()
+    ingest(IngestionLedger(str(tmp_path), graph_target=GRAPH_B), other_graph)
+    assert [c[0] for c in other_graph.calls].count("extract") == 2
@@ -0,0 +1,71 @@
+import json
+
+from graphrag_lite.ModelRouter import (LARGE_MODEL, SMALL_MODEL, STAGE_DEFAULT_MODELS, ModelRouter,
+                                       valid_json_response)
+
+
+def test_routing_is_off_by_default():
+    router = ModelRouter()
+
+    for stage, model_name in STAGE_DEFAULT_MODELS.items():
+        assert router.route(stage, input_tokens=10, community_rating=1.0, query_type="lookup") == model_name
+    assert router.escalation_model(SMALL_MODEL) is None
+    assert not router.low_confidence(0, community_rating=9.0)
+
+
+def test_routes_by_stage_and_signals():
+    router = ModelRouter(mode="on")
+
+    assert router.route("map", input_tokens=100, community_rating=2.0) == SMALL_MODEL
+    assert router.route("map", input_tokens=100, community_rating=8.0) == LARGE_MODEL
+    assert router.route("extraction", input_tokens=7000) == LARGE_MODEL
+    assert router.route("reports", community_size=30) == LARGE_MODEL
+    assert router.route("local", query_type="analytical") == LARGE_MODEL
+    assert router.route("reduce", input_tokens=10) == LARGE_MODEL
+    assert router.stats()["routed"]["map"] == {SMALL_MODEL: 1, LARGE_MODEL: 1}
+
+
+def test_escalates_invalid_small_model_response_once():
+    router = ModelRouter(mode="on")
+    calls = []
+
+    def call(model_name):
+        calls.append(model_name)
+        return "not json"
+
+    assert router.call_with_escalation("map", SMALL_MODEL, call, validate=valid_json_response) == "not json"
+    assert calls == [SMALL_MODEL, LARGE_MODEL]
+    assert router.stats()["escalations"] == {"map": 1}
+
+
+def test_escalates_low_confidence_map_answers_of_rated_communities():
+    router = ModelRouter(mode="on", min_small_score=1.0, min_confident_rating=5.0)
+    unanswered = json.dumps({"response": "The user question cannot be answered.", "score": 0})
+    answered = json.dumps({"response": "An answer.", "score": 7})
+
+    def validate(rating):
+        return lambda r: valid_json_response(
+            r, required_keys=["response"],
+            confident=lambda item: not router.low_confidence(item.get("score"), rating))
+
+    assert not validate(6.0)(unanswered)
+    assert validate(6.0)(answered)
+    # nothing relevant in a low rated community is the expected answer, no escalation
+    assert validate(2.0)(unanswered)
+
+    calls = []
+
+    def call(model_name):
+        calls.append(model_name)
+        return unanswered if model_name == SMALL_MODEL else answered
+
+    assert router.call_with_escalation("map", SMALL_MODEL, call, validate=validate(6.0)) == answered
+    assert calls == [SMALL_MODEL, LARGE_MODEL]
+
+
+def test_valid_json_response_checks_keys_and_items():
+    assert valid_json_response('```json\n[{"community": "a", "response": "x"}]\n```',
+                               required_keys=["community", "response"], min_items=1)
+    assert not valid_json_response('[{"community": "a", "response": ""}]', required_keys=["response"])
+    assert not valid_json_response('[{"community": "a", "response": "x"}]', min_items=2)
+    assert not valid_json_response('["a"]')
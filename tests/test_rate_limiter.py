@@ -0,0 +1,111 @@
+import pytest
+from google.api_core.exceptions import ResourceExhausted
+
+from graphrag_lite.LLMBackend import FakeBackend
+from graphrag_lite.async_utils.rate_limiter import RateLimiter, quota_config
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def generate(backend, i):
+    return backend.generate("gemini-1.5-flash-001", "system", [f"query {i}"], generation_config={})
+
+
+def test_throttled_calls_back_off_and_retry():
+    clock = SimulatedClock()
+    backend = FakeBackend(throttle_rate=0.3, seed=4)
+    limiter = RateLimiter(quotas={"gemini": (10**6, 10**9)}, clock=clock, sleep=clock.sleep)
+
+    for i in range(100):
+        assert limiter.call("gemini-1.5-flash-001", lambda: generate(backend, i), tokens=100).text
+
+    quota = limiter.model_quota("gemini-1.5-flash-001")
+    assert backend.throttled_count > 0
+    assert quota.throttle_count == backend.throttled_count
+    assert backend.call_count == 100 + backend.throttled_count
+    # every quota error was followed by a backoff sleep
+    assert len([s for s in clock.sleeps if s >= 0.5]) >= backend.throttled_count
+
+
+def test_throttling_lowers_the_rate_until_successes_restore_it():
+    clock = SimulatedClock()
+    limiter = RateLimiter(quotas={"gemini": (600, 10**9)}, clock=clock, sleep=clock.sleep)
+    quota = limiter.model_quota("gemini-1.5-flash-001")
+
+    backend = FakeBackend(throttle_rate=1.0)
+    with pytest.raises(ResourceExhausted):
+        limiter.call("gemini-1.5-flash-001", lambda: generate(backend, 0))
+    assert quota.rate_fraction < 0.1
+
+    backend.throttle_rate = 0.0
+    for i in range(100):
+        limiter.call("gemini-1.5-flash-001", lambda: generate(backend, i))
+    assert quota.rate_fraction == 1.0
+
+
+def test_requests_per_minute_are_enforced():
+    clock = SimulatedClock()
+    backend = FakeBackend()
+    limiter = RateLimiter(quotas={"gemini": (60, 10**9)}, clock=clock, sleep=clock.sleep)
+
+    for i in range(120):
+        limiter.call("gemini-1.5-flash-001", lambda: generate(backend, i), priority="interactive")
+
+    # a full bucket of 60 requests, then one request per second
+    assert 55 <= clock.now <= 65
+
+
+def test_batch_calls_leave_a_reserve_for_interactive_calls():
+    limiter = RateLimiter(quotas={"gemini": (100, 10**9)}, batch_reserve=0.2, clock=lambda: 0.0)
+
+    batch = sum(limiter.try_acquire("gemini-1.5-flash-001", 1, priority="batch") for _ in range(100))
+    interactive = sum(limiter.try_acquire("gemini-1.5-flash-001", 1, priority="interactive") for _ in range(100))
+
+    assert batch == 80
+    assert interactive == 20
+
+
+def test_set_quota_resets_models_matching_the_prefix():
+    limiter = RateLimiter(quotas={"gemini-1.5-pro": (60, 10**6)})
+    assert limiter.model_quota("gemini-1.5-pro-001").rpm == 60
+
+    limiter.set_quota("gemini-1.5-pro", 1000, 10**7)
+
+    assert limiter.model_quota("gemini-1.5-pro-001").rpm == 1000
+
+
+def test_quota_prefixes_match_the_start_of_the_model_name():
+    limiter = RateLimiter(quotas={"gemini-1.5-pro": (60, 10**6)}, fallback_quota=(10, 10**5))
+    other_model = "publishers/google/models/gemini-1.5-pro-vision"
+    assert limiter.model_quota(other_model).rpm == 10
+
+    limiter.set_quota("gemini-1.5-pro", 1000, 10**7)
+
+    # the fallback quota of the unrelated model is kept
+    assert limiter.model_quota(other_model).rpm == 10
+    assert limiter.model_quota("gemini-1.5-pro-002").rpm == 1000
+
+
+def test_quotas_are_read_from_configuration():
+    quotas, fallback, batch_reserve = quota_config({
+        "LLM_QUOTAS": "gemini-1.5-pro=1000:5000000, claude=10:20000",
+        "LLM_QUOTA_FALLBACK": "30:100000",
+        "LLM_BATCH_RESERVE": "0",
+    })
+
+    assert quotas["gemini-1.5-pro"] == (1000, 5000000)
+    assert quotas["claude"] == (10, 20000)
+    assert quotas["gemini-1.5-flash"] == (200, 4000000)
+    assert fallback == (30, 100000)
+    assert batch_reserve == 0.0
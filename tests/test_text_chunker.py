@@ -0,0 +1,57 @@
+import pytest
+
+from graphrag_lite.TextChunker import sliding_window_chunks
+
+
+def words(first, last):
+    return [f"w{i:02d}" for i in range(first, last)]
+
+
+def test_chunks_overlap_by_overlap_tokens():
+    # every word is 4 chars with its separator: 10 words per 10 token chunk, 3 words per 3 token overlap
+    chunks = list(sliding_window_chunks([" ".join(words(0, 25))], chunk_tokens=10, overlap_tokens=3))
+
+    assert chunks == [" ".join(words(0, 10)),
+                      " ".join(words(7, 17)),
+                      " ".join(words(14, 24)),
+                      " ".join(words(21, 25))]
+
+
+def test_no_trailing_chunk_of_only_overlap():
+    chunks = list(sliding_window_chunks([" ".join(words(0, 24))], chunk_tokens=10, overlap_tokens=3))
+
+    assert chunks[-1] == " ".join(words(14, 24))
+    assert len(chunks) == 3
+
+
+def test_chunks_ignore_page_boundaries():
+    pages = [" ".join(words(0, 6)), " ".join(words(6, 13)), "", " ".join(words(13, 20))]
+
+    assert list(sliding_window_chunks(pages, chunk_tokens=10, overlap_tokens=0)) == [
+        " ".join(words(0, 10)), " ".join(words(10, 20))]
+
+
+def test_overlap_is_capped_at_half_a_chunk():
+    chunks = list(sliding_window_chunks([" ".join(words(0, 20))], chunk_tokens=10, overlap_tokens=50))
+
+    assert chunks[1].split()[0] == "w05"
+
+
+def test_pages_are_consumed_lazily():
+    consumed = []
+
+    def pages():
+        for i in range(10):
+            consumed.append(i)
+            yield " ".join(words(i * 5, i * 5 + 5))
+
+    chunks = sliding_window_chunks(pages(), chunk_tokens=10, overlap_tokens=0)
+    assert next(chunks) == " ".join(words(0, 10))
+    assert consumed == [0, 1]
+
+
+def test_empty_input_and_invalid_chunk_size():
+    assert list(sliding_window_chunks([], chunk_tokens=10)) == []
+    assert list(sliding_window_chunks(["", "   "], chunk_tokens=10)) == []
+    with pytest.raises(ValueError):
+        list(sliding_window_chunks(["text"], chunk_tokens=0))
@@ -0,0 +1,24 @@
+from graphrag_lite.IngestionSession import IngestionSession
+
+
+class FakeIngestion(IngestionSession):
+    """IngestionSession without clients, only the text layer checks are used."""
+
+    def __init__(self, min_text_layer_chars: int):
+        self.min_text_layer_chars = min_text_layer_chars
+
+
+def test_empty_pages_need_ocr_without_a_minimum_length():
+    ingestion = FakeIngestion(min_text_layer_chars=0)
+
+    assert ingestion._usable_text_layer("") is None
+    assert ingestion._usable_text_layer(" \n ") is None
+    assert ingestion._usable_text_layer("Plain page text.") == "Plain page text."
+
+
+def test_garbled_text_layers_need_ocr():
+    ingestion = FakeIngestion(min_text_layer_chars=10)
+
+    assert ingestion._usable_text_layer("short") is None
+    assert ingestion._usable_text_layer("(cid:12)(cid:34)(cid:56) ���") is None
+    assert ingestion._usable_text_layer("o n e c h a r a c t e r p e r w o r d") is None
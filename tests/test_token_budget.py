@@ -0,0 +1,69 @@
+import pytest
+
+from graphrag_lite.TokenBudget import (BudgetExceeded, TokenBudget, active_budgets, budgeted_model, budgeted_stream,
+                                       check_budgets, record_usage)
+
+
+def test_budget_is_charged_and_exhausted_inside_its_block():
+    with TokenBudget(name="query", max_tokens=1000) as budget:
+        record_usage("map", "gemini-1.5-flash-001", prompt_tokens=600, output_tokens=100)
+        assert budget.spent_tokens == 700
+        check_budgets("map", "gemini-1.5-flash-001", estimated_tokens=200)
+        with pytest.raises(BudgetExceeded):
+            check_budgets("map", "gemini-1.5-flash-001", estimated_tokens=400)
+    assert active_budgets() == ()
+
+
+def test_nested_budgets_are_all_charged_and_reset_in_order():
+    with TokenBudget(name="outer") as outer:
+        with TokenBudget(name="inner") as inner:
+            assert active_budgets() == (outer, inner)
+            record_usage("local", "gemini-1.5-pro-001", prompt_tokens=10, output_tokens=5)
+        assert active_budgets() == (outer,)
+    assert outer.spent_tokens == inner.spent_tokens == 15
+    assert active_budgets() == ()
+
+
+def test_budget_downgrades_once_mostly_spent():
+    with TokenBudget(name="query", max_tokens=100, downgrade_at=0.8):
+        assert budgeted_model("gemini-1.5-pro-001") == "gemini-1.5-pro-001"
+        record_usage("reduce", "gemini-1.5-pro-001", prompt_tokens=80, output_tokens=0)
+        assert budgeted_model("gemini-1.5-pro-001") == "gemini-1.5-flash-001"
+
+
+def test_budgeted_stream_does_not_leak_into_the_caller():
+    budget = TokenBudget(name="stream")
+    seen = []
+
+    def answer():
+        for chunk in ("a", "b"):
+            seen.append(active_budgets())
+            record_usage("reduce", "gemini-1.5-pro-001", prompt_tokens=1, output_tokens=1)
+            yield chunk
+
+    stream = budgeted_stream(budget, answer())
+    assert next(stream) == "a"
+    # suspended between chunks, calls of the caller are not charged to the stream's budget
+    assert active_budgets() == ()
+    record_usage("other", "gemini-1.5-pro-001", prompt_tokens=100, output_tokens=0)
+    assert list(stream) == ["b"]
+    assert seen == [(budget,), (budget,)]
+    assert budget.spent_tokens == 4
+
+
+def test_abandoned_budgeted_stream_is_closed():
+    budget = TokenBudget(name="stream")
+    closed = []
+
+    def answer():
+        try:
+            yield "a"
+            yield "b"
+        finally:
+            closed.append(active_budgets())
+
+    stream = budgeted_stream(budget, answer())
+    next(stream)
+    stream.close()
+    assert closed == [(budget,)]
+    assert active_budgets() == ()